@@ -0,0 +1,307 @@
+'''
+Feed benchmarks.
+
+Start a local redis server and run from the top of the source tree:
+
+    redis-server tests/redis.conf
+    PYTHONPATH=. python benchmarks/feed_bench.py --output results.json
+
+The database given by --db is flushed. Results are written as JSON, eg.:
+
+    {"meta": {...},
+     "results": {"publish": {"ops": 10000, "seconds": 1.2,
+                             "ops_per_sec": 8333.3}, ...}}
+
+Latency results have p50, p99, p999 and max, in milliseconds.
+
+With --fake, the benchmarks run against the in-process redis of
+txthoonk.testing instead: no sockets nor server process, the server runs in
+the same process (profile it to split client and server costs).
+'''
+import argparse
+import json
+import platform
+import sys
+import time
+
+from twisted.internet import defer, reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.endpoints import TCP4ClientEndpoint
+
+from txthoonk.batching import WriteBatching
+from txthoonk.client import ThoonkPubFactory, ThoonkSubFactory
+from txthoonk.stats import Stats
+from txthoonk.testing import FakeRedisServer, FakeRedisEndpoint
+import txthoonk
+
+
+def percentile(values, p):
+    '''
+    Return the p percentile (0 < p <= 100) of a sorted list.
+    '''
+    if not values:
+        return None
+    pos = int(round(p / 100.0 * len(values) + 0.5)) - 1
+    return values[min(max(pos, 0), len(values) - 1)]
+
+
+def run_concurrent(func, count, concurrency):
+    '''
+    Call func(i) for i in range(count), at most concurrency calls running.
+
+    @return: a defer fired when all calls are done.
+    '''
+    state = {'next': 0}
+
+    def _worker(ret=None):
+        i = state['next']
+        if i >= count:
+            return ret
+        state['next'] += 1
+        return func(i).addCallback(_worker)
+
+    return defer.DeferredList([_worker() for _ in range(concurrency)],
+                              fireOnOneErrback=True, consumeErrors=True)
+
+
+class FeedBenchmark(object):
+    """
+    Runs the benchmarks of feeds against a redis server.
+    """
+    def __init__(self, options):
+        self.options = options
+        if options.fake:
+            self.endpoint = FakeRedisEndpoint(FakeRedisServer())
+        else:
+            self.endpoint = TCP4ClientEndpoint(reactor, options.host,
+                                               options.port)
+        self.connections = []
+        self.observer = Stats() if options.stats else None
+        self.batching = WriteBatching() if options.batching else None
+
+    @inlineCallbacks
+    def connect_pub(self):
+        factory = ThoonkPubFactory(db=self.options.db,
+                                   scripting=self.options.scripting,
+                                   observer=self.observer,
+                                   write_batching=self.batching)
+        pub = yield self.endpoint.connect(factory)
+        self.connections.append(pub.redis)
+        returnValue(pub)
+
+    @inlineCallbacks
+    def connect_sub(self):
+        sub = yield self.endpoint.connect(ThoonkSubFactory(
+                                                    observer=self.observer))
+        self.connections.append(sub.redis)
+        returnValue(sub)
+
+    def disconnect(self):
+        for redis in self.connections:
+            redis.transport.loseConnection()
+
+    @inlineCallbacks
+    def new_feed(self, name, config=None):
+        yield self.pub.create_feed(name, dict(config or {}, type='feed'))
+        feed = yield self.pub.feed(name)
+        returnValue(feed)
+
+    @inlineCallbacks
+    def timed(self, func, count):
+        '''
+        Run func(i) count times, concurrently, and return the throughput.
+        '''
+        start = time.time()
+        yield run_concurrent(func, count, self.options.concurrency)
+        seconds = time.time() - start
+        returnValue({'ops': count,
+                     'seconds': seconds,
+                     'ops_per_sec': count / seconds if seconds else None})
+
+    @inlineCallbacks
+    def bench_publish(self):
+        feed = yield self.new_feed("bench.publish")
+        ret = yield self.timed(lambda i: feed.publish("item %d" % i),
+                               self.options.count)
+        returnValue(ret)
+
+    @inlineCallbacks
+    def bench_publish_max_length(self):
+        feed = yield self.new_feed("bench.publish_max_length",
+                                   {'max_length': self.options.max_length})
+        ret = yield self.timed(lambda i: feed.publish("item %d" % i),
+                               self.options.count)
+        returnValue(ret)
+
+    @inlineCallbacks
+    def bench_publish_contention(self):
+        name = "bench.publish_contention"
+        yield self.new_feed(name, {'max_length': self.options.max_length})
+        feeds = []
+        for _ in range(self.options.publishers):
+            pub = yield self.connect_pub()
+            feed = yield pub.feed(name)
+            feeds.append(feed)
+
+        n = len(feeds)
+        ret = yield self.timed(lambda i: feeds[i % n].publish("item %d" % i),
+                               self.options.count)
+        stats = [f.pub.retry_policy.get_stats(name) for f in feeds]
+        ret['publishers'] = n
+        ret['attempts'] = sum(s['attempts'] for s in stats)
+        ret['aborts'] = sum(s['aborts'] for s in stats)
+        returnValue(ret)
+
+    @inlineCallbacks
+    def bench_retract(self):
+        feed = yield self.new_feed("bench.retract")
+        ids = yield feed.publish_many([("item", str(i))
+                                       for i in range(self.options.count)])
+        ret = yield self.timed(lambda i: feed.retract(ids[i]), len(ids))
+        returnValue(ret)
+
+    @inlineCallbacks
+    def bench_get_all(self):
+        feed = yield self.new_feed("bench.get_all")
+        size = self.options.feed_size
+        for pos in range(0, size, 1000):
+            yield feed.publish_many([("x" * 100, str(i))
+                                     for i in range(pos, min(pos + 1000,
+                                                             size))])
+
+        # one call at a time, each call reads the whole feed
+        start = time.time()
+        for _ in range(self.options.repeat):
+            items = yield feed.get_all()
+            assert len(items) == size
+        seconds = time.time() - start
+        returnValue({'ops': self.options.repeat,
+                     'seconds': seconds,
+                     'ops_per_sec': self.options.repeat / seconds,
+                     'items': size,
+                     'items_per_sec': size * self.options.repeat / seconds})
+
+    @inlineCallbacks
+    def bench_latency(self):
+        '''
+        Time from publish call to the call of a publish handler.
+        '''
+        feed = yield self.new_feed("bench.latency")
+        sub = yield self.connect_sub()
+        count = self.options.count
+        latencies = []
+        done = defer.Deferred()
+
+        def on_publish(id_, item):
+            latencies.append(time.time() - float(item))
+            if len(latencies) == count:
+                done.callback(None)
+
+        yield sub.register_handler(feed.channel_publish, on_publish)
+        yield run_concurrent(lambda i: feed.publish(repr(time.time())),
+                             count, self.options.concurrency)
+        yield done
+
+        latencies.sort()
+        ms = lambda v: v * 1000.0
+        returnValue({'ops': count,
+                     'p50': ms(percentile(latencies, 50)),
+                     'p99': ms(percentile(latencies, 99)),
+                     'p999': ms(percentile(latencies, 99.9)),
+                     'max': ms(latencies[-1])})
+
+    @inlineCallbacks
+    def run(self, names):
+        self.pub = yield self.connect_pub()
+        yield self.pub.redis.flushdb()
+        results = {}
+        for name in names:
+            results[name] = yield getattr(self, 'bench_%s' % name)()
+            sys.stderr.write("%s: %s\n" % (name, json.dumps(results[name])))
+        returnValue(results)
+
+
+BENCHMARKS = ['publish', 'publish_max_length', 'publish_contention',
+              'retract', 'get_all', 'latency']
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6381)
+    parser.add_argument('--db', type=int, default=15,
+                        help='database used, it is flushed')
+    parser.add_argument('--scripting', action='store_true',
+                        help='publish by Lua scripts')
+    parser.add_argument('--fake', action='store_true',
+                        help='use the in-process redis of txthoonk.testing')
+    parser.add_argument('--stats', action='store_true',
+                        help='add command and operation latencies '
+                             '(txthoonk.stats) to the results')
+    parser.add_argument('--batching', action='store_true',
+                        help='batch the writes of publishers '
+                             '(txthoonk.batching)')
+    parser.add_argument('--count', type=int, default=10000,
+                        help='operations by benchmark')
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help='operations running at same time')
+    parser.add_argument('--max-length', type=int, default=1000)
+    parser.add_argument('--publishers', type=int, default=4,
+                        help='connections publishing to the same feed')
+    parser.add_argument('--feed-size', type=int, default=100000,
+                        help='items of the feed read by get_all')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='get_all calls')
+    parser.add_argument('--output', help='JSON file, defaults to stdout')
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='benchmarks to run, defaults to all: %s' %
+                             ', '.join(BENCHMARKS))
+    options = parser.parse_args(argv)
+    if options.fake and options.scripting:
+        parser.error("--fake does not support --scripting")
+    for name in options.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %r" % name)
+    return options
+
+
+def main(argv):
+    options = parse_args(argv)
+    bench = FeedBenchmark(options)
+    report = {'meta': {'txthoonk': txthoonk.__version__,
+                       'python': platform.python_version(),
+                       'time': time.time(),
+                       'options': vars(options)}}
+    failed = []
+
+    def _done(results):
+        report['results'] = results
+        if bench.observer is not None:
+            report['stats'] = bench.observer.get_stats()
+        if bench.batching is not None:
+            report['batching'] = bench.batching.get_stats()
+        data = json.dumps(report, indent=2, sort_keys=True)
+        if options.output:
+            with open(options.output, 'w') as f:
+                f.write(data + '\n')
+        else:
+            print(data)
+
+    def _failed(failure):
+        failed.append(failure)
+        failure.printTraceback()
+
+    def _stop(ret):
+        bench.disconnect()
+        reactor.stop()
+
+    d = bench.run(options.benchmarks or BENCHMARKS)
+    d.addCallbacks(_done, _failed)
+    d.addBoth(_stop)
+
+    reactor.run()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
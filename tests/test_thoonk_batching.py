@@ -0,0 +1,92 @@
+'''
+Tests for txthoonk.batching
+'''
+from tests.test_thoonk_pubsub import TestThoonkBase, REDIS_DB
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+
+class TestWriteBatching(unittest.TestCase):
+    def setUp(self):
+        from txthoonk.batching import WriteBatching
+        from twisted.test.proto_helpers import StringTransport
+        self.clock = task.Clock()
+        self.batching = WriteBatching(max_bytes=10, clock=self.clock)
+        self.transport = StringTransport()
+        self.wrapped = self.batching.wrap(self.transport)
+
+    def testFlush(self):
+        self.wrapped.write("abc")
+        self.wrapped.writeSequence(["de", "f"])
+        self.assertEqual(self.transport.value(), "")
+
+        self.clock.advance(0)
+        self.assertEqual(self.transport.value(), "abcdef")
+        stats = self.batching.get_stats()
+        self.assertEqual((stats['batches'], stats['writes'], stats['bytes']),
+                         (1, 3, 6))
+        self.assertEqual(stats['writes_by_batch']['max'], 3)
+
+    def testMaxBytes(self):
+        self.wrapped.write("abcde")
+        self.wrapped.write("fghijk")
+        self.assertEqual(self.transport.value(), "abcdefghijk")
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        # buffered data is written before closing
+        self.wrapped.write("l")
+        self.wrapped.loseConnection()
+        self.assertEqual(self.transport.value(), "abcdefghijkl")
+        self.assertTrue(self.transport.disconnecting)
+        self.assertEqual(self.batching.get_stats()['batches'], 2)
+
+    def testMaxDelay(self):
+        self.batching.max_delay = 0.01
+        self.wrapped.write("abc")
+        self.clock.advance(0.005)
+        self.wrapped.write("def")
+        self.assertEqual(self.transport.value(), "")
+        self.clock.advance(0.005)
+        self.assertEqual(self.transport.value(), "abcdef")
+
+    def testDiscard(self):
+        self.wrapped.write("abc")
+        self.wrapped.discard()
+        self.clock.advance(0)
+        self.assertEqual(self.transport.value(), "")
+        self.assertEqual(self.batching.get_stats()['batches'], 0)
+
+
+class TestThoonkBatching(TestThoonkBase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield TestThoonkBase.setUp(self)
+
+        from txthoonk.batching import WriteBatching
+        from txthoonk.client import ThoonkPubFactory
+        self.batching = WriteBatching()
+        self.batched_pub = yield self.endpoint.connect(
+                        ThoonkPubFactory(db=REDIS_DB,
+                                         write_batching=self.batching))
+        self.addCleanup(
+                lambda: self.batched_pub.redis.transport.loseConnection())
+
+    @defer.inlineCallbacks
+    def testConcurrentPublish(self):
+        yield self.batched_pub.create_feed("feed")
+        feed = yield self.batched_pub.feed("feed")
+        ids = [str(i) for i in range(20)]
+        yield defer.DeferredList([feed.publish("item", id_) for id_ in ids],
+                                 fireOnOneErrback=True)
+
+        items = yield self.pub.feed("feed").addCallback(
+                                                lambda f: f.get_ids())
+        self.assertEqual(sorted(items), sorted(ids))
+
+        stats = self.batching.get_stats()
+        self.assertTrue(stats['writes'] > stats['batches'])
+        self.assertTrue(stats['writes_by_batch']['max'] >= 20)
+
+
+if __name__ == "__main__":
+    pass
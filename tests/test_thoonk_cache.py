@@ -0,0 +1,483 @@
+'''
+Tests for txthoonk.cache
+'''
+from tests.test_thoonk_pubsub import TestThoonkBase
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+
+
+def wait(seconds=0.01):
+    return task.deferLater(reactor, seconds, lambda: None)
+
+
+class TestConfigCache(unittest.TestCase):
+    def setUp(self):
+        from txthoonk.cache import ConfigCache
+        self.clock = task.Clock()
+        self.cache = ConfigCache(ttl=10, clock=self.clock)
+
+    def testGetSet(self):
+        cache = self.cache
+        self.assertIsNone(cache.get("feed"))
+
+        cache.set("feed", {"max_length": "10"})
+        config = cache.get("feed")
+        self.assertEqual(config, {"max_length": "10"})
+
+        # a copy is returned
+        config["max_length"] = "20"
+        self.assertEqual(cache.get("feed"), {"max_length": "10"})
+
+        self.assertEqual(cache.get_stats(),
+                         {'size': 1, 'hits': 2, 'misses': 1})
+
+    def testExpire(self):
+        cache = self.cache
+        cache.set("feed", {})
+        self.clock.advance(9)
+        self.assertEqual(cache.get("feed"), {})
+        self.clock.advance(1)
+        self.assertIsNone(cache.get("feed"))
+
+    def testInvalidate(self):
+        cache = self.cache
+        cache.set("feed1", {})
+        cache.set("feed2", {})
+
+        cache.invalidate("feed1")
+        self.assertIsNone(cache.get("feed1"))
+        self.assertEqual(cache.get("feed2"), {})
+
+        cache.invalidate()
+        self.assertIsNone(cache.get("feed2"))
+
+    def testGeneration(self):
+        cache = self.cache
+        generation = cache.generation("feed")
+        cache.invalidate("feed")
+
+        # read before invalidation must not be stored
+        cache.set("feed", {"old": "1"}, generation)
+        self.assertIsNone(cache.get("feed"))
+
+        cache.set("feed", {"new": "1"}, cache.generation("feed"))
+        self.assertEqual(cache.get("feed"), {"new": "1"})
+
+        # also when all entries are invalidated
+        generation = cache.generation("other")
+        cache.invalidate()
+        cache.set("other", {"old": "1"}, generation)
+        self.assertIsNone(cache.get("other"))
+
+
+class TestItemCache(unittest.TestCase):
+    def setUp(self):
+        from txthoonk.cache import ItemCache
+        self.cache = ItemCache(max_items=2, max_bytes=10)
+
+    def store(self, id_, item, size):
+        self.cache.set(id_, item, size, self.cache.reading(id_))
+
+    def testLRU(self):
+        cache = self.cache
+        self.assertEqual(cache.get("1"), (False, None))
+        self.store("1", "a", 1)
+        self.store("2", "b", 1)
+        self.assertEqual(cache.get("1"), (True, "a"))
+
+        # "2" is the least recently used
+        self.store("3", "c", 1)
+        self.assertEqual(cache.get("2"), (False, None))
+        self.assertEqual(cache.get("1"), (True, "a"))
+
+        # max_bytes
+        self.store("4", "d", 9)
+        self.assertEqual(cache.get("3"), (False, None))
+        self.assertEqual(cache.get("4"), (True, "d"))
+        self.store("5", "e", 11)
+        self.assertEqual(cache.get("5"), (False, None))
+
+        self.assertEqual(cache.get_stats(),
+                         {'size': 2, 'bytes': 10, 'hits': 3, 'misses': 4,
+                          'evictions': 2})
+
+    def testInvalidate(self):
+        cache = self.cache
+        self.store("1", "a", 1)
+        self.store("2", "b", 1)
+        cache.invalidate("1")
+        self.assertEqual(cache.get("1"), (False, None))
+        self.assertEqual(cache.get("2"), (True, "b"))
+        cache.invalidate()
+        self.assertEqual(cache.get("2"), (False, None))
+        self.assertEqual(cache.get_stats()['bytes'], 0)
+
+    def testInvalidateWhileReading(self):
+        cache = self.cache
+        token = cache.reading("1")
+        cache.invalidate("1")
+
+        # read before invalidation must not be stored
+        cache.set("1", "old", 1, token)
+        self.assertEqual(cache.get("1"), (False, None))
+
+        self.store("1", "new", 1)
+        self.assertEqual(cache.get("1"), (True, "new"))
+
+        # disabled
+        cache.enabled = False
+        self.store("2", "b", 1)
+        self.assertEqual(cache.get("1"), (False, None))
+        self.assertEqual(cache.get_stats()['size'], 1)
+
+
+class TestFeedRegistry(unittest.TestCase):
+    def setUp(self):
+        from txthoonk.cache import FeedRegistry
+        self.registry = FeedRegistry(max_feeds=2)
+
+    def handle(self, name):
+        from txthoonk.types import Feed
+        return Feed(pub=None, name=name)
+
+    def testLRU(self):
+        from txthoonk.types import Feed, Queue
+        registry = self.registry
+        feeds = dict((name, self.handle(name)) for name in ("1", "2", "3"))
+        registry.set(feeds["1"])
+        registry.set(feeds["2"])
+        # "2" becomes the least recently used
+        self.assertIs(registry.get("1", Feed), feeds["1"])
+        registry.set(feeds["3"])
+
+        self.assertIsNone(registry.get("2", Feed))
+        self.assertIs(registry.get("3", Feed), feeds["3"])
+        # handle of another type
+        self.assertIsNone(registry.get("1", Queue))
+        self.assertEqual(registry.get_stats(),
+                         {'size': 2, 'hits': 2, 'misses': 2, 'evictions': 1})
+
+    def testInvalidate(self):
+        from txthoonk.types import Feed
+        registry = self.registry
+        feed = self.handle("1")
+
+        generation = registry.generation()
+        registry.invalidate("1")
+        # resolved before invalidation must not be stored
+        registry.set(feed, generation)
+        self.assertIsNone(registry.get("1", Feed))
+
+        registry.set(feed, registry.generation())
+        self.assertIs(registry.get("1", Feed), feed)
+        registry.invalidate()
+        self.assertIsNone(registry.get("1", Feed))
+
+
+class TestFeedCatalogue(unittest.TestCase):
+    def testNames(self):
+        from txthoonk.cache import FeedCatalogue
+        catalogue = FeedCatalogue()
+        catalogue.loaded = True
+        for name in ("b.2", "a", "b.1", "c"):
+            catalogue.add(name)
+        catalogue.discard("c")
+        catalogue.discard("d")
+
+        self.assertTrue("a" in catalogue)
+        self.assertFalse("c" in catalogue)
+        self.assertEqual(len(catalogue), 3)
+        self.assertEqual(catalogue.get_names(), ["a", "b.1", "b.2"])
+        self.assertEqual(catalogue.get_names("b."), ["b.1", "b.2"])
+        self.assertEqual(catalogue.get_names("z"), [])
+
+
+class TestThoonkConfigCache(TestThoonkBase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield TestThoonkBase.setUp(self)
+
+        from txthoonk.client import ThoonkPub
+        from txthoonk.cache import ConfigCache
+        self.cache = ConfigCache()
+        self.cached_pub = ThoonkPub(self.pub.redis, config_cache=self.cache)
+        yield self.cache.listen(self.sub)
+
+        self.conf_events = []
+        yield self.sub.register_handler("conffeed",
+                                        lambda *args: self.conf_events.append(args))
+
+        self.feed_name = "test_feed"
+        yield self.wait_conffeed(self.pub.create_feed(self.feed_name,
+                                                      {'type': 'feed'}))
+
+    @defer.inlineCallbacks
+    def wait_conffeed(self, d):
+        '''Wait until the conffeed event of a config change is received.'''
+        received = len(self.conf_events)
+        yield d
+        while len(self.conf_events) == received:
+            yield wait()
+
+    @defer.inlineCallbacks
+    def testGetConfigCached(self):
+        pub = self.cached_pub
+        config = yield pub.get_config(self.feed_name)
+        self.assertEqual(config, {'type': 'feed'})
+
+        # changed behind cache
+        yield self.pub.redis.hset("feed.config:%s" % self.feed_name,
+                                  "max_length", "1")
+        config = yield pub.get_config(self.feed_name)
+        self.assertEqual(config, {'type': 'feed'})
+        self.assertEqual(self.cache.hits, 1)
+
+        # local set_config invalidates it
+        yield pub.set_config(self.feed_name, {"max_length": "2"})
+        config = yield pub.get_config(self.feed_name)
+        self.assertEqual(config, {'type': 'feed', "max_length": "2"})
+
+    @defer.inlineCallbacks
+    def testInvalidateOnDelete(self):
+        from txthoonk.client import FeedDoesNotExist
+        pub = self.cached_pub
+        yield pub.get_config(self.feed_name)
+
+        # deleted by another publisher
+        yield self.pub.delete_feed(self.feed_name)
+        while self.cache.get(self.feed_name) is not None:
+            yield wait()
+
+        yield self.assertFailure(pub.get_config(self.feed_name),
+                                 FeedDoesNotExist)
+
+    @defer.inlineCallbacks
+    def testDisconnected(self):
+        pub = self.cached_pub
+        yield pub.get_config(self.feed_name)
+
+        # events are lost while disconnected
+        self.sub._connection_changed(False)
+        self.assertFalse(self.cache.enabled)
+        self.assertEqual(self.cache.get_stats()['size'], 0)
+        yield pub.get_config(self.feed_name)
+        self.assertEqual(self.cache.get_stats()['size'], 0)
+
+        self.sub._connection_changed(True)
+        yield pub.get_config(self.feed_name)
+        self.assertEqual(self.cache.get(self.feed_name), {'type': 'feed'})
+
+    @defer.inlineCallbacks
+    def testFeedPublishCached(self):
+        from txthoonk.types import Feed
+        feed = Feed(pub=self.cached_pub, name=self.feed_name)
+        yield self.wait_conffeed(feed.set_config({"max_length": "2"}))
+        for i in range(4):
+            yield feed.publish(str(i), str(i))
+
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ["2", "3"])
+        self.assertEqual(self.cache.misses, 1)
+        self.assertEqual(self.cache.hits, 3)
+
+
+class TestThoonkItemCache(TestThoonkBase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield TestThoonkBase.setUp(self)
+
+        from txthoonk.cache import ItemCache
+        from txthoonk.types import Feed
+        self.feed_name = "test_feed"
+        yield self.pub.create_feed(self.feed_name, {'type': 'feed'})
+
+        self.cache = ItemCache()
+        yield self.cache.listen(self.sub, self.feed_name)
+        self.feed = Feed(pub=self.pub, name=self.feed_name,
+                         item_cache=self.cache)
+        # another publisher, changes are known by events
+        self.other = Feed(pub=self.pub, name=self.feed_name)
+
+    @defer.inlineCallbacks
+    def wait_invalidated(self, id_):
+        while self.cache.get(id_)[0]:
+            yield wait()
+
+    @defer.inlineCallbacks
+    def testGetItemCached(self):
+        feed = self.feed
+        yield feed.publish("a", "1")
+        ret = yield feed.get_item("1")
+        self.assertEqual(ret, {"1": "a"})
+        ret = yield feed.get_item("1")
+        self.assertEqual(ret, {"1": "a"})
+
+        # missing items are not cached
+        ret = yield feed.get_item("2")
+        self.assertIsNone(ret)
+
+        self.assertEqual(self.cache.get_stats(),
+                         {'size': 1, 'bytes': 1, 'hits': 1, 'misses': 2,
+                          'evictions': 0})
+
+        # local changes
+        yield feed.publish("b", "1")
+        ret = yield feed.get_item("1")
+        self.assertEqual(ret, {"1": "b"})
+        yield feed.retract("1")
+        ret = yield feed.get_item("1")
+        self.assertIsNone(ret)
+
+    @defer.inlineCallbacks
+    def testInvalidateOnEvents(self):
+        feed = self.feed
+        yield feed.publish("a", "1")
+        yield feed.publish("b", "2")
+        yield feed.get_item("1")
+        yield feed.get_item("2")
+
+        yield self.other.publish("c", "1")
+        yield self.wait_invalidated("1")
+        ret = yield feed.get_item("1")
+        self.assertEqual(ret, {"1": "c"})
+
+        yield self.other.retract("2")
+        yield self.wait_invalidated("2")
+        ret = yield feed.get_item("2")
+        self.assertIsNone(ret)
+
+        yield self.pub.delete_feed(self.feed_name)
+        yield self.wait_invalidated("1")
+        self.assertEqual(self.cache.get_stats()['size'], 0)
+
+    @defer.inlineCallbacks
+    def testDisconnected(self):
+        feed = self.feed
+        yield feed.publish("a", "1")
+        yield feed.get_item("1")
+
+        # events are lost while disconnected
+        self.sub._connection_changed(False)
+        self.assertFalse(self.cache.enabled)
+        self.assertEqual(self.cache.get_stats()['size'], 0)
+        yield feed.get_item("1")
+        self.assertEqual(self.cache.get_stats()['size'], 0)
+
+        self.sub._connection_changed(True)
+        yield feed.get_item("1")
+        self.assertEqual(self.cache.get("1"), (True, "a"))
+
+
+class TestThoonkFeedRegistry(TestThoonkBase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield TestThoonkBase.setUp(self)
+
+        from txthoonk.client import ThoonkPub
+        from txthoonk.cache import FeedRegistry
+        self.registry = FeedRegistry()
+        self.registered_pub = ThoonkPub(self.pub.redis,
+                                        feed_registry=self.registry)
+        yield self.registry.listen(self.sub)
+
+    @defer.inlineCallbacks
+    def testFeedRegistered(self):
+        pub = self.registered_pub
+        feed = yield pub.feed("feed")
+        self.assertEqual(self.registry.misses, 1)
+
+        # a fired defer of the same handle, no round trip
+        d = pub.feed("feed")
+        self.assertIs(self.successResultOf(d), feed)
+        self.assertEqual(self.registry.hits, 1)
+
+        # local delete_feed invalidates it
+        yield pub.delete_feed("feed")
+        self.assertEqual(self.registry.get_stats()['size'], 0)
+        ret = yield pub.feed_exists("feed")
+        self.assertFalse(ret)
+        other = yield pub.feed("feed")
+        self.assertIsNot(other, feed)
+        ret = yield pub.feed_exists("feed")
+        self.assertTrue(ret)
+
+    @defer.inlineCallbacks
+    def testInvalidateOnDelete(self):
+        yield self.registered_pub.queue("queue")
+
+        # deleted by another publisher
+        yield self.pub.delete_feed("queue")
+        while self.registry.get_stats()['size']:
+            yield wait()
+
+        # disconnected
+        yield self.registered_pub.queue("queue")
+        self.sub._connection_changed(False)
+        self.assertEqual(self.registry.get_stats()['size'], 0)
+        yield self.registered_pub.queue("queue")
+        self.assertEqual(self.registry.get_stats()['size'], 0)
+        self.sub._connection_changed(True)
+        yield self.registered_pub.queue("queue")
+        self.assertEqual(self.registry.get_stats()['size'], 1)
+
+
+class TestThoonkFeedCatalogue(TestThoonkBase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield TestThoonkBase.setUp(self)
+
+        from txthoonk.client import ThoonkPub
+        from txthoonk.cache import FeedCatalogue
+        self.names = ["feed%d" % i for i in range(5)]
+        for name in self.names:
+            yield self.pub.create_feed(name)
+
+        self.catalogue = FeedCatalogue(page_size=2)
+        self.catalogue_pub = ThoonkPub(self.pub.redis,
+                                       feed_catalogue=self.catalogue)
+        yield self.catalogue.listen(self.sub)
+
+    @defer.inlineCallbacks
+    def testLoad(self):
+        catalogue = self.catalogue
+        d = catalogue.load(self.catalogue_pub)
+        self.assertFalse(catalogue.loaded)
+        # deleted while loading
+        catalogue.discard("feed0")
+        ret = yield d
+        self.assertTrue(ret)
+        self.assertEqual(catalogue.get_names(), self.names[1:])
+
+        # local changes
+        yield self.catalogue_pub.create_feed("other")
+        yield self.catalogue_pub.delete_feed("feed1")
+        ret = yield self.catalogue_pub.get_feed_names()
+        self.assertEqual(ret, set(self.names[2:] + ["other"]))
+
+        # changes of other publishers
+        yield self.pub.create_feed("feed5")
+        yield self.pub.delete_feed("feed2")
+        while "feed5" not in catalogue or "feed2" in catalogue:
+            yield wait()
+        self.assertEqual(catalogue.get_names("feed"),
+                         ["feed3", "feed4", "feed5"])
+
+    @defer.inlineCallbacks
+    def testReload(self):
+        catalogue = self.catalogue
+        yield catalogue.load(self.catalogue_pub)
+
+        # events are lost while disconnected
+        self.sub._connection_changed(False)
+        self.assertFalse(catalogue.loaded)
+        yield self.pub.create_feed("feed5")
+
+        self.sub._connection_changed(True)
+        while not catalogue.loaded:
+            yield wait()
+        self.assertTrue("feed5" in catalogue)
+        self.assertEqual(catalogue.get_stats(), {'size': 6, 'loaded': True})
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,47 @@
+'''
+Tests for txthoonk.codec
+'''
+from twisted.trial import unittest
+
+
+class TestCodec(unittest.TestCase):
+    def testGetCodec(self):
+        from txthoonk.codec import get_codec, UnknownCodec
+        self.assertEqual(get_codec().name, 'raw')
+        self.assertEqual(get_codec('json').name, 'json')
+        self.assertEqual(get_codec('json+zlib').name, 'json+zlib')
+        self.assertIdentical(get_codec('json+zlib'), get_codec('json+zlib'))
+        self.assertRaises(UnknownCodec, get_codec, 'unknown')
+        self.assertRaises(UnknownCodec, get_codec, 'json+unknown')
+
+    def testJSON(self):
+        from txthoonk.codec import get_codec
+        codec = get_codec('json')
+        item = {'a': [1, 2], 'b': None}
+        self.assertEqual(codec.decode(codec.encode(item)), item)
+
+    def testZlib(self):
+        from txthoonk.codec import ZlibCodec, get_codec
+        codec = ZlibCodec(get_codec('raw'), threshold=10)
+
+        data = codec.encode('small')
+        self.assertEqual(data, 'rsmall')
+        self.assertEqual(codec.decode(data), 'small')
+
+        item = 'z' * 1000
+        data = codec.encode(item)
+        self.assertEqual(data[0], 'z')
+        self.assertTrue(len(data) < 100)
+        self.assertEqual(codec.decode(data), item)
+
+    def testMsgpack(self):
+        from txthoonk.codec import get_codec, msgpack
+        if msgpack is None:
+            raise unittest.SkipTest("msgpack is not installed")
+        codec = get_codec('msgpack')
+        item = {'a': [1, 2]}
+        self.assertEqual(codec.decode(codec.encode(item)), item)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,78 @@
+'''
+Tests for txthoonk.dispatch
+'''
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+
+class TestDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def testDispatch(self):
+        from txthoonk.dispatch import Dispatcher
+        dispatcher = Dispatcher(clock=self.clock)
+        received = []
+        def onMsg(*args):
+            received.append(args)
+        def onMsgFail(*args):
+            raise ValueError("fail")
+
+        # a failed handler does not stop the others
+        dispatcher.dispatch("channel", [onMsgFail, onMsg], ["a", "b"])
+        self.assertEqual(received, [("a", "b")])
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+        self.assertEqual(dispatcher.get_stats("channel"),
+                         {'messages': 1, 'calls': 2, 'errors': 1,
+                          'waiting': 0, 'latency_max': 0.0,
+                          'latency_total': 0.0})
+
+    def testDispatchDeferred(self):
+        from txthoonk.dispatch import Dispatcher
+        dispatcher = Dispatcher(clock=self.clock)
+        defers = []
+        def onMsg(*args):
+            d = defer.Deferred()
+            defers.append(d)
+            return d
+
+        dispatcher.dispatch("channel", [onMsg], ["a"])
+        self.assertEqual(dispatcher.get_stats("channel")['calls'], 0)
+
+        self.clock.advance(2)
+        defers[0].errback(ValueError("fail"))
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        stats = dispatcher.get_stats()
+        self.assertEqual(stats["channel"]['calls'], 1)
+        self.assertEqual(stats["channel"]['errors'], 1)
+        self.assertEqual(stats["channel"]['latency_max'], 2)
+
+    def testConcurrency(self):
+        from txthoonk.dispatch import Dispatcher
+        dispatcher = Dispatcher(concurrency=2, clock=self.clock)
+        defers = []
+        def onMsg(*args):
+            d = defer.Deferred()
+            defers.append((args, d))
+            return d
+
+        for i in range(4):
+            dispatcher.dispatch("channel", [onMsg], [str(i)])
+        dispatcher.dispatch("other", [onMsg], ["other"])
+
+        # 2 running for channel
+        self.assertEqual([args for args, d in defers],
+                         [("0",), ("1",), ("other",)])
+        self.assertEqual(dispatcher.get_stats("channel")['waiting'], 2)
+
+        # waiting calls run in order
+        defers[1][1].callback(None)
+        defers[0][1].callback(None)
+        self.assertEqual([args for args, d in defers[3:]], [("2",), ("3",)])
+        self.assertEqual(dispatcher.get_stats("channel")['waiting'], 0)
+        self.assertEqual(dispatcher.get_stats("channel")['calls'], 2)
+
+
+if __name__ == "__main__":
+    pass
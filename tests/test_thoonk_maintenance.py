@@ -0,0 +1,73 @@
+'''
+Tests for txthoonk.maintenance
+'''
+from tests.test_thoonk_types import TestThoonkBlockingBase
+from twisted.internet import defer, reactor, task
+
+
+class TestJobMaintenance(TestThoonkBlockingBase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield TestThoonkBlockingBase.setUp(self)
+
+        from txthoonk.maintenance import JobMaintenance
+        self.job = yield self.pub.job("job")
+        self.clock = task.Clock()
+        self.maintenance = JobMaintenance(self.job, claim_timeout=0,
+                                          interval=10, max_failures=1,
+                                          chunk=2, clock=self.clock)
+
+    @defer.inlineCallbacks
+    def run_round(self):
+        '''Run a round, advancing the clock between chunks.'''
+        done = []
+        d = self.maintenance.run()
+        d.addBoth(lambda ret: done.append(True) or ret)
+        while not done:
+            self.clock.advance(0)
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        yield d
+
+    @defer.inlineCallbacks
+    def testRun(self):
+        job = self.job
+        maintenance = self.maintenance
+        ids = yield job.put_many(["a", "b", "c"])
+        yield job.get_batch(3)
+
+        # stale claims are cancelled in chunks
+        yield self.run_round()
+        self.assertEqual(maintenance.get_stats(),
+                         {'rounds': 1, 'cancelled': 3, 'stalled': 0,
+                          'requeued': 0, 'errors': 0})
+
+        yield job.get_batch(3)
+        yield self.run_round()
+        self.assertEqual(maintenance.get_stats()['stalled'], 3)
+        ret = yield self.pub.redis.smembers(job.feed_stalled)
+        self.assertEqual(ret, set(ids))
+
+    @defer.inlineCallbacks
+    def testLoop(self):
+        job = self.job
+        maintenance = self.maintenance
+        yield job.put("a")
+        yield job.get()
+
+        maintenance.start()
+        self.clock.advance(0)
+        while maintenance.get_stats()['rounds'] < 1:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(maintenance.get_stats()['cancelled'], 1)
+
+        # next round after interval
+        yield job.get()
+        self.clock.advance(10)
+        yield maintenance.stop()
+        self.assertEqual(maintenance.get_stats()['rounds'], 2)
+        self.assertEqual(maintenance.get_stats()['stalled'], 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,77 @@
+'''
+Tests for txthoonk.pool
+'''
+from twisted.trial import unittest
+from twisted.internet import defer
+
+
+class FakeRedis(object):
+    """A connection with some pending replies"""
+    def __init__(self, pending=0):
+        self.pending_replies = pending
+        self.sent = []
+
+    def get(self, key):
+        self.sent.append(('get', key))
+        return defer.succeed(key)
+
+
+class TestRedisPool(unittest.TestCase):
+    def setUp(self):
+        from txthoonk.pool import RedisPool
+        self.busy = FakeRedis(pending=3)
+        self.idle = FakeRedis()
+        self.pool = RedisPool([self.busy, self.idle])
+
+    def testLeaseLeastBusy(self):
+        pool = self.pool
+        self.assertIdentical(self.successResultOf(pool.lease()), self.idle)
+        self.assertIdentical(self.successResultOf(pool.lease()), self.busy)
+
+        # all connections are leased
+        d = pool.lease()
+        self.assertNoResult(d)
+        self.assertEqual(pool.get_stats(),
+                         {'size': 2, 'leased': 2, 'waiting': 1})
+
+        pool.release(self.busy)
+        self.assertIdentical(self.successResultOf(d), self.busy)
+
+        pool.release(self.busy)
+        pool.release(self.idle)
+        self.assertEqual(pool.get_stats(),
+                         {'size': 2, 'leased': 0, 'waiting': 0})
+
+    def testCommand(self):
+        pool = self.pool
+        self.successResultOf(pool.lease())
+
+        # leased connections are not used
+        self.assertEqual(self.successResultOf(pool.get("key")), "key")
+        self.assertEqual(self.idle.sent, [])
+        self.assertEqual(self.busy.sent, [('get', 'key')])
+        self.assertEqual(pool.get_stats()['leased'], 1)
+
+        self.assertRaises(AttributeError, getattr, pool, 'transport')
+
+    def testAddRemove(self):
+        pool = self.pool
+        pool.remove(self.busy)
+        pool.remove(self.idle)
+        d = pool.lease()
+        self.assertNoResult(d)
+
+        # a new connection is given to the waiting lease
+        redis = FakeRedis()
+        pool.add(redis)
+        self.assertIdentical(self.successResultOf(d), redis)
+
+        # a lost connection is not leased again
+        pool.remove(redis)
+        pool.release(redis)
+        self.assertEqual(pool.get_stats(),
+                         {'size': 0, 'leased': 0, 'waiting': 0})
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,111 @@
+'''
+Tests for txthoonk.protocol
+'''
+from twisted.trial import unittest
+from twisted.test.proto_helpers import StringTransport
+
+
+class TestThoonkRedis(unittest.TestCase):
+    def setUp(self):
+        from txthoonk.protocol import ThoonkRedis
+        self.redis = ThoonkRedis()
+        self.transport = StringTransport()
+        self.redis.makeConnection(self.transport)
+
+    def testSimpleReplies(self):
+        redis = self.redis
+        d1 = redis.ping()
+        d2 = redis.get("a")
+        d3 = redis.incr("b")
+        redis.dataReceived("+PONG\r\n$3\r\nabc\r\n:4")
+        redis.dataReceived("2\r\n")
+        self.assertEqual(self.successResultOf(d1), "PONG")
+        self.assertEqual(self.successResultOf(d2), "abc")
+        self.assertEqual(self.successResultOf(d3), 42)
+
+    def testNestedMultiBulk(self):
+        redis = self.redis
+        d1 = redis.send("EXEC")
+        d2 = redis.get("a")
+        redis.dataReceived("*4\r\n:1\r\n*2\r\n$1\r\na\r\n*0\r\n"
+                           "*-1\r\n$-1\r\n$1\r\nb\r\n")
+        self.assertEqual(self.successResultOf(d1), [1, ["a", []], None, None])
+        self.assertEqual(self.successResultOf(d2), "b")
+
+    def testErrors(self):
+        from txredis.protocol import ResponseError
+        redis = self.redis
+        d1 = redis.get("a")
+        d2 = redis.send("EXEC")
+        redis.dataReceived("-ERR bad\r\n*2\r\n+OK\r\n-WRONGTYPE op\r\n")
+        self.failureResultOf(d1, ResponseError)
+        ok, error = self.successResultOf(d2)
+        self.assertEqual(ok, "OK")
+        self.assertIsInstance(error, ResponseError)
+
+        from txthoonk.protocol import check_exec
+        self.assertEqual(check_exec(["OK", 1]), ["OK", 1])
+        self.assertEqual(check_exec(None), None)
+        self.assertRaises(ResponseError, check_exec, [ok, error])
+
+    def testInvalidLength(self):
+        from txredis.protocol import InvalidResponse
+        redis = self.redis
+        d1 = redis.get("a")
+        d2 = redis.send("EXEC")
+        d3 = redis.get("b")
+        redis.dataReceived("$x\r\n*y\r\n$1\r\nb\r\n")
+        self.failureResultOf(d1, InvalidResponse)
+        self.failureResultOf(d2, InvalidResponse)
+        self.assertEqual(self.successResultOf(d3), "b")
+
+    def testPendingReplies(self):
+        from twisted.internet.error import ConnectionDone
+        from twisted.python import failure
+        redis = self.redis
+        d1 = redis.get("a")
+        d2 = redis.get("b")
+        self.assertEqual(redis.pending_replies, 2)
+        redis.dataReceived("$1\r\na\r\n")
+        self.assertEqual(redis.pending_replies, 1)
+
+        # failed requests are not pending
+        redis.connectionLost(failure.Failure(ConnectionDone()))
+        self.assertEqual(self.successResultOf(d1), "a")
+        self.failureResultOf(d2, ConnectionDone)
+        self.assertEqual(redis.pending_replies, 0)
+
+    def testScan(self):
+        redis = self.redis
+        d1 = redis.hscan("h", count=10)
+        self.assertEqual(self.transport.value(),
+                         "*5\r\n$5\r\nHSCAN\r\n$1\r\nh\r\n$1\r\n0\r\n"
+                         "$5\r\nCOUNT\r\n$2\r\n10\r\n")
+        d2 = redis.sscan("s", 12)
+        d3 = redis.zscan("z", 12)
+        redis.dataReceived("*2\r\n$2\r\n12\r\n*2\r\n$1\r\na\r\n$1\r\nb\r\n")
+        redis.dataReceived("*2\r\n$1\r\n0\r\n*1\r\n$1\r\na\r\n")
+        redis.dataReceived("*2\r\n$1\r\n0\r\n*2\r\n$1\r\na\r\n$3\r\n1.5\r\n")
+        self.assertEqual(self.successResultOf(d1), (12, {"a": "b"}))
+        self.assertEqual(self.successResultOf(d2), (0, ["a"]))
+        self.assertEqual(self.successResultOf(d3), (0, [("a", 1.5)]))
+
+
+class TestThoonkRedisSubscriber(unittest.TestCase):
+    def testPatternMessage(self):
+        from txthoonk.protocol import ThoonkRedisSubscriber
+        redis = ThoonkRedisSubscriber()
+        redis.makeConnection(StringTransport())
+        received = []
+        redis.messageReceived = lambda *args: received.append(args)
+        redis.patternMessageReceived = lambda *args: received.append(args)
+
+        redis.dataReceived("*3\r\n$7\r\nmessage\r\n"
+                           "$1\r\nc\r\n$1\r\nm\r\n")
+        redis.dataReceived("*4\r\n$8\r\npmessage\r\n$2\r\nc*\r\n"
+                           "$2\r\ncd\r\n$1\r\nm\r\n")
+        self.assertEqual(received, [("c", "m"), ("c*", "cd", "m")])
+
+
+if __name__ == "__main__":
+    pass
@@ -3,15 +3,33 @@ Created on Jul 4, 2012
 
 @author: iuri
 '''
+import os
+
 from twisted.trial import unittest
 from twisted.internet import defer
 from twisted.internet import reactor
+from twisted.internet import task
 from twisted.internet.endpoints import TCP4ClientEndpoint
 
 REDIS_HOST = "localhost"
 REDIS_PORT = 6381
 REDIS_DB = 1
 
+# run the tests against txthoonk.testing.FakeRedisServer instead of a redis
+# server, eg.: THOONK_FAKE_REDIS=1 trial tests/
+FAKE_REDIS = bool(os.environ.get("THOONK_FAKE_REDIS"))
+SKIP_FAKE_REDIS = ("Not supported by the fake redis" if FAKE_REDIS
+                   else None)
+
+
+def get_endpoint():
+    """Return the endpoint of a redis server used by tests"""
+    if FAKE_REDIS:
+        from txthoonk.testing import FakeRedisServer, FakeRedisEndpoint
+        return FakeRedisEndpoint(FakeRedisServer())
+    return TCP4ClientEndpoint(reactor, REDIS_HOST, REDIS_PORT)
+
+
 class TestThoonkBase(unittest.TestCase):
     timeout = 1
 
@@ -24,13 +42,12 @@ class TestThoonkBase(unittest.TestCase):
         self.pub = ThoonkPub(Redis()) # pydev: force code completion
         self.sub = ThoonkSub(Redis()) # pydev: force code completion
 
-        endpoint = TCP4ClientEndpoint(reactor, REDIS_HOST, REDIS_PORT)
+        self.endpoint = get_endpoint()
         try:
-            self.pub = yield endpoint.connect(ThoonkPubFactory(db=REDIS_DB))
+            self.pub = yield self.endpoint.connect(ThoonkPubFactory(db=REDIS_DB))
             # flush redis database between calls
-            self.pub.redis.flushdb()
+            yield self.pub.redis.flushdb()
         except:
-            import os
             redis_conf = os.path.join(os.path.dirname(__file__), "redis.conf")
             msg = ("NOTE: Redis server not running on %s:%s. Please start \n"
                    "a local instance of Redis on this port to run unit tests \n"
@@ -39,8 +56,7 @@ class TestThoonkBase(unittest.TestCase):
                    "  redis-server %s\n") % (REDIS_HOST, REDIS_PORT, redis_conf)
             raise unittest.SkipTest(msg)
 
-        endpoint = TCP4ClientEndpoint(reactor, REDIS_HOST, REDIS_PORT)
-        self.sub = yield endpoint.connect(ThoonkSubFactory())
+        self.sub = yield self.endpoint.connect(ThoonkSubFactory())
 
         self._configure_wrappers()
 
@@ -214,6 +230,62 @@ class TestThoonkPubSub(TestThoonkBase):
         ret = yield self.pub.get_config(feed_name)
         self.assertEqual(ret, config)
 
+    @defer.inlineCallbacks
+    def testSetConfigEvent(self):
+        feed_name = "test_feed"
+        config = {'blow': '2', 'blew': '1'}
+        yield self.pub.create_feed(feed_name)
+
+        @self.check_called
+        def onConfig(ret_name, *args):
+            self.assertEqual(ret_name, feed_name)
+
+        yield self.sub.register_handler('conffeed', onConfig)
+
+        # Assuring that redis.messageReceived (sub) was called
+        cb = self.msg_rcv
+        yield self.pub.set_config(feed_name, config)
+        yield cb
+
+    @defer.inlineCallbacks
+    def testSetConfigScripting(self):
+        from txthoonk.client import ThoonkPub, FeedDoesNotExist
+        pub = ThoonkPub(self.pub.redis, scripting=True)
+        feed_name = "test_feed"
+        config = {'blow': '2', 'blew': 1}
+
+        yield self.assertFailure(pub.set_config(feed_name, config),
+                                 FeedDoesNotExist)
+
+        yield pub.create_feed(feed_name)
+        yield pub.set_config(feed_name, config)
+
+        ret = yield pub.get_config(feed_name)
+        self.assertEqual(ret, {'blow': '2', 'blew': '1'})
+    testSetConfigScripting.skip = SKIP_FAKE_REDIS
+
+    @defer.inlineCallbacks
+    def testSetConfigMany(self):
+        from txthoonk.client import FeedDoesNotExist
+        feeds = ["feed1", "feed2", "feed3"]
+        for feed in feeds[:2]:
+            yield self.pub.create_feed(feed)
+
+        configs = dict((feed, {'max_length': '10', 'name': feed})
+                       for feed in feeds)
+
+        # nothing is written if a feed does not exist
+        yield self.assertFailure(self.pub.set_config_many(configs),
+                                 FeedDoesNotExist)
+        ret = yield self.pub.get_config("feed1")
+        self.assertEqual(ret, {})
+
+        yield self.pub.create_feed("feed3")
+        yield self.pub.set_config_many(configs)
+        for feed in feeds:
+            ret = yield self.pub.get_config(feed)
+            self.assertEqual(ret, configs[feed])
+
     ############################################################################
     #  Tests for delete feed
     ############################################################################
@@ -240,6 +312,61 @@ class TestThoonkPubSub(TestThoonkBase):
         ret = yield self.pub.redis.hgetall("feed.config:%s" % feed_name)
         self.assertEqual(ret, {})
 
+    @defer.inlineCallbacks
+    def testDeleteFeedData(self):
+        feed = yield self.pub.feed("feed")
+        yield feed.publish("item", "id")
+        job = yield self.pub.job("job")
+        yield job.put("item")
+
+        yield self.pub.delete_feed("feed")
+        yield self.pub.delete_feed("job")
+        self.assertEqual(self.pub.purging, {})
+        ret = yield self.pub.redis.keys("*")
+        self.assertEqual(ret, [])
+
+    @defer.inlineCallbacks
+    def testDeleteFeedPurge(self):
+        feed = yield self.pub.feed("feed")
+        yield feed.publish_many([("item", str(i)) for i in range(25)])
+        queue = yield self.pub.queue("queue")
+        yield queue.put_many(["item"] * 25)
+
+        # redis without UNLINK
+        self.pub.unlink = False
+        reports = []
+        progress = lambda key, removed: reports.append((key, removed))
+        yield self.pub.delete_feed("feed", chunk=10, progress=progress)
+        yield self.pub.delete_feed("queue", chunk=10, progress=progress)
+        self.assertEqual(sorted(self.pub.purging), ["feed", "queue"])
+        yield defer.DeferredList(self.pub.purging.values())
+        self.assertEqual(self.pub.purging, {})
+
+        ret = yield self.pub.redis.keys("*")
+        self.assertEqual(ret, [])
+        # last report of each trash key (feed.deleted:[uuid]:[key])
+        removed = dict((key.split(":", 2)[2], count)
+                       for key, count in reports)
+        self.assertEqual(removed, {"feed.ids:feed": 25,
+                                   "feed.items:feed": 25,
+                                   "feed.publishes:feed": None,
+                                   "feed.ids:queue": 25,
+                                   "feed.items:queue": 25,
+                                   "feed.publishes:queue": None})
+        # chunks
+        self.assertEqual([count for key, count in reports
+                          if key.endswith("feed.ids:feed")], [10, 20, 25])
+
+    @defer.inlineCallbacks
+    def testDeleteFeedRetryStats(self):
+        feed_name = "test_feed"
+        yield self.pub.create_feed(feed_name)
+        yield self.pub.delete_feed(feed_name)
+
+        stats = self.pub.retry_policy.get_stats(feed_name)
+        self.assertEqual(stats['attempts'], 1)
+        self.assertEqual(stats['aborts'], 0)
+
     @defer.inlineCallbacks
     def testHandlerDeleteFeed(self):
         feed1 = 'feed1'
@@ -288,5 +415,162 @@ class TestThoonkPubSub(TestThoonkBase):
         yield self.pub.publish_channel(channel, *args)
         yield cb
 
+    ############################################################################
+    #  Tests for register_handlers
+    ############################################################################
+    @defer.inlineCallbacks
+    def testRegisterHandlers(self):
+        channels = ['channel%d' % i for i in range(50)]
+        received = []
+        def onChannel(*args):
+            received.append(args)
+
+        subscribes = []
+        subscribe = self.sub.redis.subscribe
+        def _subscribe(*args):
+            subscribes.append(args)
+            return subscribe(*args)
+        self.sub.redis.subscribe = _subscribe
+
+        # one command per subscribe_chunk channels
+        self.sub.subscribe_chunk = 40
+        ids = yield self.sub.register_handlers(dict((c, onChannel)
+                                                    for c in channels))
+        self.assertEqual(len(subscribes), 2)
+        self.assertEqual(set(ids.keys()), set(channels))
+        self.assertEqual(len(set(ids.values())), 50)
+
+        # subscribed channels are not subscribed again
+        ids = yield self.sub.register_handlers({'channel0': onChannel,
+                                                'create': onChannel})
+        self.assertEqual(subscribes[2], ('newfeed',))
+
+        for channel in channels:
+            yield self.pub.publish_channel(channel, channel)
+        while len(received) < 51:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(sorted(received),
+                         sorted([(c,) for c in channels] + [('channel0',)]))
+
+    @defer.inlineCallbacks
+    def testRegisterHandlerPending(self):
+        @self.check_called
+        def onChannel(*args):
+            pass
+
+        # registered while the subscription is pending
+        d1 = self.sub.register_handler('mychannel', onChannel)
+        d2 = self.sub.register_handler('mychannel', onChannel)
+        ids = yield defer.gatherResults([d1, d2])
+        self.assertNotEqual(ids[0], ids[1])
+
+        cb = self.msg_rcv
+        yield self.pub.publish_channel('mychannel', 'a')
+        yield cb
+
+    @defer.inlineCallbacks
+    def testPatternHandler(self):
+        received = []
+        def onPublish(*args):
+            received.append(args)
+
+        id_ = yield self.sub.register_pattern_handler("feed.publish:*",
+                                                      onPublish)
+        ids = yield self.sub.register_pattern_handlers({"*feed": onPublish})
+        self.assertNotEqual(id_, ids["*feed"])
+
+        yield self.pub.create_feed("orders-1")
+        yield self.pub.publish_channel("feed.publish:orders-1", "id", "item")
+        yield self.pub.publish_channel("feed.edit:orders-1", "id", "item")
+        while len(received) < 2:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+
+        self.assertEqual(received[0][:3], (None, "newfeed", "orders-1"))
+        self.assertEqual(received[1], ("orders-1", "feed.publish", "id",
+                                       "item"))
+
+        # removing
+        self.sub.remove_handler(id_)
+        yield self.pub.publish_channel("feed.publish:orders-1", "id", "item")
+        yield self.pub.delete_feed("orders-1")
+        while len(received) < 3:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(received[2][:3], (None, "delfeed", "orders-1"))
+
+    ############################################################################
+    #  Tests for reconnection
+    ############################################################################
+    @defer.inlineCallbacks
+    def testReconnectCatchUp(self):
+        from txthoonk.client import ThoonkSubFactory
+        factory = ThoonkSubFactory(catchup=self.pub)
+        factory.initialDelay = factory.maxDelay = 0.01
+        reactor.connectTCP(REDIS_HOST, REDIS_PORT, factory)
+        self.addCleanup(lambda: factory.sub.redis.transport.loseConnection())
+        self.addCleanup(factory.stopTrying)
+        while factory.sub is None or factory.sub.redis.transport is None:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        sub = factory.sub
+
+        feed = yield self.pub.feed("feed1")
+        published = []
+        created = []
+        yield sub.register_handlers({'feed.publish:feed1':
+                                        lambda *args: published.append(args),
+                                     'newfeed':
+                                        lambda *args: created.append(args)})
+
+        yield feed.publish("a", "1")
+        while len(published) < 1:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+
+        # published while disconnected
+        redis = sub.redis
+        redis.transport.loseConnection()
+        yield feed.publish("b", "2")
+        yield feed.publish("c", "3")
+        yield feed.retract("3")
+
+        while sub.redis is redis or len(published) < 2:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(published, [("1", "a"), ("2", "b")])
+
+        # subscriptions restored
+        yield self.pub.create_feed("feed2")
+        yield feed.publish("d", "4")
+        while len(published) < 3 or len(created) < 1:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(published[2], ("4", "d"))
+        self.assertEqual(created[0][0], "feed2")
+    testReconnectCatchUp.skip = SKIP_FAKE_REDIS
+
+    @defer.inlineCallbacks
+    def testCatchUpFeedTypes(self):
+        from txthoonk.client import ThoonkSub
+        sub = ThoonkSub(self.sub.redis, catchup=self.pub)
+        for name in ["feed", "sorted", "queue", "job"]:
+            yield sub.register_handler("feed.publish:%s" % name,
+                                       lambda *args: None)
+        feed = yield self.pub.feed("feed")
+        yield feed.publish("a", "1")
+        sorted_feed = yield self.pub.sorted_feed("sorted")
+        yield sorted_feed.append("b")
+        queue = yield self.pub.queue("queue")
+        yield queue.put("c")
+        job = yield self.pub.job("job")
+        yield job.put("d")
+        while len(sub._last_seen) < 2:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+
+        # only feeds with ids sorted by time are replayed
+        for name in ["feed", "sorted", "queue", "job"]:
+            sub._last_seen[name] = (None, 0)
+        ret = yield sub.catch_up("sorted")
+        self.assertEqual(ret, [])
+        ret = yield sub._catch_up_all()
+        self.assertEqual(sorted(value for success, value in ret),
+                         [[], [], [], ["1"]])
+
+
 if __name__ == "__main__":
     pass
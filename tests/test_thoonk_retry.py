@@ -0,0 +1,81 @@
+'''
+Tests for txthoonk.retry
+'''
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def _aborting(self, n, result="done"):
+        """Returns an attempt function aborted n times"""
+        from txthoonk.retry import TransactionAborted
+        calls = []
+        def _attempt():
+            calls.append(None)
+            if len(calls) <= n:
+                return defer.fail(TransactionAborted())
+            return defer.succeed(result)
+        return _attempt, calls
+
+    def testRunNoAbort(self):
+        from txthoonk.retry import RetryPolicy
+        policy = RetryPolicy(clock=self.clock)
+        attempt, calls = self._aborting(0)
+
+        d = policy.run("feed", attempt)
+        self.assertEqual(self.successResultOf(d), "done")
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(policy.get_stats("feed"),
+                         {'attempts': 1, 'aborts': 0, 'exhausted': 0})
+
+    def testRunRetries(self):
+        from txthoonk.retry import RetryPolicy
+        policy = RetryPolicy(base_delay=0.01, max_delay=0.04,
+                             clock=self.clock)
+        attempt, calls = self._aborting(3)
+
+        d = policy.run("feed", attempt)
+        self.assertNoResult(d)
+        self.assertEqual(len(calls), 1)
+
+        # max backoff is bounded by max_delay
+        self.clock.pump([0.04] * 3)
+        self.assertEqual(self.successResultOf(d), "done")
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(policy.get_stats(),
+                         {"feed": {'attempts': 4, 'aborts': 3,
+                                   'exhausted': 0}})
+
+    def testRunExhausted(self):
+        from txthoonk.retry import RetryPolicy, RetryLimitExceeded
+        policy = RetryPolicy(max_attempts=3, clock=self.clock)
+        attempt, calls = self._aborting(10)
+
+        d = policy.run("feed", attempt)
+        self.clock.pump([policy.max_delay] * 3)
+        self.failureResultOf(d, RetryLimitExceeded)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(policy.get_stats("feed"),
+                         {'attempts': 3, 'aborts': 3, 'exhausted': 1})
+
+    def testRunOtherErrors(self):
+        from txthoonk.retry import RetryPolicy
+        policy = RetryPolicy(clock=self.clock)
+
+        d = policy.run("feed", lambda: defer.fail(ValueError()))
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(policy.get_stats("feed")['aborts'], 0)
+
+    def testDelay(self):
+        from txthoonk.retry import RetryPolicy
+        policy = RetryPolicy(base_delay=0.001, max_delay=0.1)
+        for retry in range(1, 20):
+            delay = policy.get_delay(retry)
+            self.assertTrue(0 <= delay <= min(0.1, 0.001 * 2 ** (retry - 1)))
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,139 @@
+'''
+Tests for txthoonk.stats
+'''
+from tests.test_thoonk_pubsub import TestThoonkBase
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+
+
+class TestHistogram(unittest.TestCase):
+    def testPercentiles(self):
+        from txthoonk.stats import Histogram
+        histogram = Histogram([0.001, 0.01, 0.1])
+        self.assertEqual(histogram.percentile(50), None)
+
+        for value in [0.0005] * 90 + [0.005] * 9 + [0.5]:
+            histogram.add(value)
+        self.assertEqual(histogram.buckets, [90, 9, 0, 1])
+        self.assertEqual(histogram.percentile(50), 0.001)
+        self.assertEqual(histogram.percentile(99), 0.01)
+        # above all bounds
+        self.assertEqual(histogram.percentile(100), 0.5)
+
+        stats = histogram.get_stats()
+        self.assertEqual(stats['count'], 100)
+        self.assertEqual((stats['min'], stats['max']), (0.0005, 0.5))
+        self.assertAlmostEqual(stats['mean'], 0.0059)
+        self.assertEqual(stats['p90'], 0.001)
+
+        # never above max
+        histogram = Histogram([0.001, 0.01, 0.1])
+        histogram.add(0.002)
+        self.assertEqual(histogram.percentile(50), 0.002)
+
+
+class TestStats(unittest.TestCase):
+    def testGetStats(self):
+        from txthoonk.stats import Stats
+        clock = task.Clock()
+        stats = Stats(clock)
+
+        stats.command('HGET', 0.001, 30, False)
+        stats.command('HGET', 0.002, 30, True)
+        stats.received(100)
+        stats.operation('Feed.publish', 0.003, False)
+        stats.aborted('feed')
+        stats.message('feed.publish:feed')
+        stats.message('feed.publish:feed')
+        clock.advance(2)
+
+        ret = stats.get_stats()
+        self.assertEqual(ret['elapsed'], 2)
+        self.assertEqual(ret['commands']['HGET']['count'], 2)
+        self.assertEqual(ret['commands']['HGET']['errors'], 1)
+        self.assertEqual(ret['operations']['Feed.publish']['max'], 0.003)
+        self.assertEqual(ret['operations']['Feed.publish']['errors'], 0)
+        self.assertEqual(ret['aborts'], {'feed': 1})
+        self.assertEqual(ret['messages'],
+                         {'feed.publish:feed': {'count': 2, 'per_sec': 1.0}})
+        self.assertEqual((ret['bytes_sent'], ret['bytes_received']),
+                         (60, 100))
+
+        stats.reset()
+        ret = stats.get_stats()
+        self.assertEqual(ret['commands'], {})
+        self.assertEqual(ret['bytes_sent'], 0)
+
+
+class TestThoonkStats(TestThoonkBase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield TestThoonkBase.setUp(self)
+
+        from txthoonk.client import ThoonkPub
+        from txthoonk.retry import RetryPolicy
+        from txthoonk.stats import Stats
+        self.stats = Stats()
+        self.pub = ThoonkPub(self.pub.redis, observer=self.stats,
+                             retry_policy=RetryPolicy(base_delay=0))
+
+    @defer.inlineCallbacks
+    def testPublish(self):
+        yield self.pub.create_feed("feed")
+        feed = yield self.pub.feed("feed")
+        yield feed.publish("item", "id")
+        yield feed.get_item("id")
+
+        from txthoonk.client import ItemDoesNotExist
+        sorted_feed = yield self.pub.sorted_feed("sorted")
+        yield self.assertFailure(sorted_feed.edit("id", "item"),
+                                 ItemDoesNotExist)
+
+        ret = self.pub.get_stats()
+        self.assertEqual(ret['operations']['Feed.publish']['count'], 1)
+        self.assertEqual(ret['operations']['Feed.publish']['errors'], 0)
+        self.assertEqual(ret['operations']['Feed.get_item']['count'], 1)
+        self.assertEqual(ret['operations']['SortedFeed.edit']['errors'], 1)
+        self.assertEqual(ret['commands']['EXEC']['count'], 2)
+        self.assertEqual(ret['commands']['HGET']['count'], 1)
+        self.assertTrue(ret['bytes_sent'] > 0)
+        self.assertTrue(ret['bytes_received'] > 0)
+
+    @defer.inlineCallbacks
+    def testQueuePut(self):
+        queue = yield self.pub.queue("queue")
+        yield queue.put("item")
+        yield queue.put_many(["item", "item"])
+
+        ret = self.pub.get_stats()['operations']
+        # put is not measured again as put_many
+        self.assertEqual(ret['Queue.put']['count'], 1)
+        self.assertEqual(ret['Queue.put_many']['count'], 1)
+
+    @defer.inlineCallbacks
+    def testAborted(self):
+        from txthoonk.retry import TransactionAborted
+        results = [defer.fail(TransactionAborted()), defer.succeed(None)]
+        yield self.pub.retry("feed", lambda: results.pop(0))
+        self.assertEqual(self.stats.get_stats()['aborts'], {'feed': 1})
+
+    @defer.inlineCallbacks
+    def testMessages(self):
+        from txthoonk.client import ThoonkSub
+        sub = ThoonkSub(self.sub.redis, observer=self.stats)
+        yield sub.register_handler("feed.publish:feed", lambda *args: None)
+        yield sub.register_pattern_handler("feed.retract:*",
+                                           lambda *args: None)
+        yield self.pub.publish_channel("feed.publish:feed", "id", "item")
+        yield self.pub.publish_channel("feed.retract:feed", "id")
+
+        while sum(c['count'] for c in
+                  self.stats.get_stats()['messages'].values()) < 2:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        messages = self.stats.get_stats()['messages']
+        self.assertEqual(sorted(messages), ["feed.publish:feed",
+                                            "feed.retract:feed"])
+
+
+if __name__ == "__main__":
+    pass
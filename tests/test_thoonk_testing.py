@@ -0,0 +1,145 @@
+'''
+Tests for txthoonk.testing
+'''
+from twisted.trial import unittest
+from twisted.internet import task
+
+
+class TestFakeRedisServer(unittest.TestCase):
+    def setUp(self):
+        from txthoonk.testing import FakeRedisServer, FakeRedisEndpoint
+        from txthoonk.protocol import ThoonkRedis
+        from twisted.internet.protocol import ClientFactory
+        self.clock = task.Clock()
+        self.server = FakeRedisServer(self.clock)
+        self.endpoint = FakeRedisEndpoint(self.server)
+        self.factory = ClientFactory.forProtocol(ThoonkRedis)
+
+    def connect(self, factory=None):
+        d = self.endpoint.connect(factory or self.factory)
+        redis = self.successResultOf(d)
+        self.clock.advance(0)
+        return redis
+
+    def result(self, d):
+        '''Deliver all pending data and return the result of d.'''
+        self.clock.advance(0)
+        return self.successResultOf(d)
+
+    def testCommands(self):
+        redis = self.connect()
+        self.assertEqual(self.result(redis.ping()), "PONG")
+
+        redis.hmset("h", {"a": "1", "b": "2"})
+        redis.incr("n", 5)
+        redis.send("RPUSH", "l", "a", "b", "c")
+        redis.send("ZADD", "z", 2, "b", 1, "a", 1.5, "c")
+        self.assertEqual(self.result(redis.hgetall("h")),
+                         {"a": "1", "b": "2"})
+        self.assertEqual(self.result(redis.get("n")), "5")
+        self.assertEqual(self.result(redis.lrange("l", 1, -1)), ["b", "c"])
+        self.assertEqual(self.result(redis.zrange("z", 0, -1)),
+                         ["a", "c", "b"])
+        self.assertEqual(self.result(redis.send("ZRANGEBYSCORE", "z", "(1",
+                                                "+inf", "LIMIT", 0, 1)),
+                         ["c"])
+        self.assertEqual(self.result(redis.send("HSCAN", "h", 0, "COUNT", 1)),
+                         ["1", ["a", "1"]])
+
+        # empty values are removed
+        redis.send("HDEL", "h", "a", "b")
+        self.assertEqual(self.result(redis.exists("h")), 0)
+
+        # errors
+        from txredis.protocol import ResponseError
+        d = redis.send("LLEN", "z")
+        self.clock.advance(0)
+        f = self.failureResultOf(d, ResponseError)
+        self.assertTrue(str(f.value).startswith("WRONGTYPE"))
+
+    def testWatch(self):
+        redis1 = self.connect()
+        redis2 = self.connect()
+
+        redis1.watch("a")
+        redis1.multi()
+        redis1.incr("a")
+        d = redis1.execute()
+        self.assertEqual(self.result(d), [1])
+
+        # written by another client between WATCH and EXEC
+        redis1.watch("a")
+        redis2.incr("a")
+        self.clock.advance(0)
+        redis1.multi()
+        redis1.incr("a")
+        d = redis1.execute()
+        self.assertEqual(self.result(d), None)
+        self.assertEqual(self.result(redis1.get("a")), "2")
+
+    def testBlockingPop(self):
+        redis1 = self.connect()
+        redis2 = self.connect()
+
+        d1 = redis1.send("BRPOP", "q", 10)
+        d2 = redis1.ping()
+        self.clock.advance(0)
+        self.assertNoResult(d1)
+        self.assertNoResult(d2)
+
+        redis2.send("LPUSH", "q", "a")
+        self.assertEqual(self.result(d1), ["q", "a"])
+        self.assertEqual(self.result(d2), "PONG")
+
+        # times out
+        d = redis1.send("BRPOP", "q", 0.5)
+        self.clock.advance(0)
+        self.assertNoResult(d)
+        self.clock.advance(0.5)
+        self.assertEqual(self.result(d), None)
+
+        # popped value is pushed to the head of destination
+        d = redis1.send("BRPOPLPUSH", "q", "p", 0)
+        self.clock.advance(0)
+        self.assertNoResult(d)
+        redis2.send("LPUSH", "q", "b")
+        self.assertEqual(self.result(d), "b")
+        redis2.send("LPUSH", "q", "c")
+        self.assertEqual(self.result(redis1.send("RPOPLPUSH", "q", "p")), "c")
+        self.assertEqual(self.result(redis1.lrange("p", 0, -1)), ["c", "b"])
+
+    def testPubSub(self):
+        from txthoonk.client import ThoonkSubFactory
+        redis = self.connect()
+        sub = self.connect(ThoonkSubFactory())
+
+        received = []
+        d = sub.register_handler("feed.publish:f", lambda *args:
+                                 received.append(args))
+        self.result(d)
+        d = sub.register_pattern_handler("feed.publish:*", lambda *args:
+                                         received.append(args))
+        self.result(d)
+
+        d = redis.publish("feed.publish:f", "id\x00item")
+        self.assertEqual(self.result(d), 2)
+        self.clock.advance(0)
+        self.assertEqual(sorted(received),
+                         [("f", "feed.publish", "id", "item"),
+                          ("id", "item")])
+
+    def testDisconnect(self):
+        redis = self.connect()
+        redis.watch("a")
+        d = redis.send("BRPOP", "q", 0)
+        self.clock.advance(0)
+        redis.transport.loseConnection()
+        self.clock.advance(0)
+        self.failureResultOf(d)
+        self.assertEqual(self.server._blocked, [])
+        self.assertEqual(self.server._watchers, {})
+        self.assertEqual(self.server.get_stats(), {'WATCH': 1, 'BRPOP': 1})
+
+
+if __name__ == "__main__":
+    pass
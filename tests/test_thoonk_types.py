@@ -3,8 +3,8 @@ Created on Jul 6, 2012
 
 @author: iuri
 '''
-from tests.test_thoonk_pubsub import TestThoonkBase
-from twisted.internet import defer
+from tests.test_thoonk_pubsub import TestThoonkBase, SKIP_FAKE_REDIS
+from twisted.internet import defer, reactor, task
 
 class TestThoonkFeed(TestThoonkBase):
     @defer.inlineCallbacks
@@ -202,9 +202,146 @@ class TestThoonkFeed(TestThoonkBase):
         yield self.feed.publish("blew")
         yield cb
 
+    ############################################################################
+    #  Tests for publish_many
+    ############################################################################
+    @defer.inlineCallbacks
+    def testFeedPublishMany(self):
+        feed = self.feed
+
+        ret = yield feed.publish_many([])
+        self.assertEqual(ret, [])
+
+        items = [("item1", "id1"), ("item2", None), ("item3", "id3")]
+        ids = yield feed.publish_many(items)
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(ids[0], "id1")
+        self.assertEqual(ids[2], "id3")
+
+        # ordered by publication
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ids)
+
+        ret = yield feed.get_all()
+        self.assertEqual(ret, dict(zip(ids, ["item1", "item2", "item3"])))
+
+        n = yield self.pub.redis.get(feed.feed_publishes)
+        self.assertEqual(n, '3')
+
+    @defer.inlineCallbacks
+    def testFeedPublishManyWithMaxLength(self):
+        feed = self.feed
+        yield feed.set_config({'max_length': '5'})
+
+        ids_01 = map(str, range(0, 4))
+        yield feed.publish_many([(i, i) for i in ids_01])
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ids_01)
+
+        # re-publish oldest id and add two new ones, '1' is removed
+        yield feed.publish_many([("0", "0"), ("4", "4"), ("5", "5")])
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ["2", "3", "0", "4", "5"])
+
+        # batch bigger than max_length keeps its newest items
+        ids_02 = map(str, range(10, 17))
+        yield feed.publish_many([(i, i) for i in ids_02])
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ids_02[-5:])
+        ret = yield feed.get_all()
+        self.assertEqual(set(ret.keys()), set(ids_02[-5:]))
+
+    @defer.inlineCallbacks
+    def testFeedPublishManyEvents(self):
+        feed = self.feed
+        yield feed.set_config({'max_length': '2'})
+        yield feed.publish("old", "old")
+
+        events = []
+        def onEvent(evt):
+            return lambda *args: events.append((evt,) + args[:2])
+
+        yield self.sub.register_handler(feed.channel_publish, onEvent('pub'))
+        yield self.sub.register_handler(feed.channel_edit, onEvent('edit'))
+        yield self.sub.register_handler(feed.channel_retract,
+                                        onEvent('retract'))
+
+        yield feed.publish_many([("a", "a"), ("b", "b"), ("a2", "a")])
+        while len(events) < 4:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+
+        self.assertEqual(events, [('pub', 'a', 'a'), ('pub', 'b', 'b'),
+                                  ('edit', 'a', 'a2'), ('retract', 'old')])
+
+    @defer.inlineCallbacks
+    def testFeedPublishManyNonExistingFeed(self):
+        from txthoonk.client import FeedDoesNotExist
+        from txthoonk.types import Feed
+        feed = Feed(pub=self.pub, name="non_existing")
+        yield self.assertFailure(feed.publish_many([("item", None)]),
+                                 FeedDoesNotExist)
+
+    ############################################################################
+    #  Tests for trim
+    ############################################################################
+    @defer.inlineCallbacks
+    def testFeedTrim(self):
+        feed = self.feed
+        ids = map(str, range(10))
+        yield feed.publish_many([(i, i) for i in ids])
+
+        # unbounded feed, nothing to do
+        yield feed.trim()
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ids)
+
+        retracted = []
+        yield self.sub.register_handler(feed.channel_retract,
+                                        lambda id_, *args: retracted.append(id_))
+
+        yield feed.trim(max_length=4, chunk=3)
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ids[-4:])
+        ret = yield feed.get_all()
+        self.assertEqual(set(ret.keys()), set(ids[-4:]))
+
+        while len(retracted) < 6:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(retracted, ids[:6])
+
+    def testFeedTrimTransaction(self):
+        # redis without Lua scripts
+        self.pub.lua = False
+        return self.testFeedTrim()
+
+    @defer.inlineCallbacks
+    def testFeedPublishChunkedTrim(self):
+        feed = self.feed
+        ids = map(str, range(20))
+        yield feed.publish_many([(i, i) for i in ids])
+
+        # a single publish removes at most trim_chunk items
+        self.pub.trim_chunk = 4
+        yield feed.set_config({"max_length": "5"})
+        yield feed.publish("new", "new")
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ids[4:] + ["new"])
+
+        # the remaining is removed in background
+        self.assertNotEqual(feed.trimming, None)
+        while feed.trimming is not None:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ids[-4:] + ["new"])
+
+    def testFeedPublishChunkedTrimTransaction(self):
+        self.pub.lua = False
+        return self.testFeedPublishChunkedTrim()
+
     ############################################################################
     #  Tests for has_id
     ############################################################################
+
     @defer.inlineCallbacks
     def testFeedHasId(self):
         item = "my beautiful item"
@@ -267,6 +404,56 @@ class TestThoonkFeed(TestThoonkBase):
         self.assertEqual(set(ret_ids), set(ids))
         self.assertEqual(set(ret_items), set(items))
 
+    @defer.inlineCallbacks
+    def testFeedGetIdsPage(self):
+        feed = self.feed
+        ids = map(str, range(7))
+        yield feed.publish_many([(i, i) for i in ids])
+        # ids sharing the same score
+        for i in ("a", "b", "c"):
+            yield self.pub.redis.zadd(feed.feed_ids, i, "1e20")
+            yield self.pub.redis.hset(feed.feed_items, i, i)
+        ids += ["a", "b", "c"]
+
+        ret, cursor = yield feed.get_ids_page(count=3)
+        self.assertEqual(ret, ids[:3])
+        pages = [ret]
+        while cursor is not None:
+            ret, cursor = yield feed.get_ids_page(cursor, count=2)
+            pages.append(ret)
+        self.assertEqual(sum(pages, []), ids)
+
+    @defer.inlineCallbacks
+    def testFeedIterIds(self):
+        feed = self.feed
+        ids = map(str, range(25))
+        yield feed.publish_many([(i, i) for i in ids])
+
+        ret = []
+        for d in feed.iter_ids(page_size=10):
+            page = yield d
+            self.assertTrue(len(page) <= 10)
+            ret += page
+        self.assertEqual(ret, ids)
+
+        # previous page must be received
+        pages = feed.iter_ids(page_size=10)
+        d = pages.next()
+        self.assertRaises(RuntimeError, pages.next)
+        yield d
+
+    @defer.inlineCallbacks
+    def testFeedIterAll(self):
+        feed = self.feed
+        ids = map(str, range(25))
+        yield feed.publish_many([("item" + i, i) for i in ids])
+
+        ret = {}
+        for d in feed.iter_all(page_size=5):
+            page = yield d
+            ret.update(page)
+        self.assertEqual(ret, dict((i, "item" + i) for i in ids))
+
     ############################################################################
     #  Tests for retract
     ############################################################################
@@ -298,6 +485,865 @@ class TestThoonkFeed(TestThoonkBase):
         ret = yield feed.has_id(id_)
         self.assertFalse(ret)
 
+    @defer.inlineCallbacks
+    def testFeedRetractNonExisting(self):
+        feed = self.feed
+        yield feed.retract("nonexisting")
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, [])
+
+    @defer.inlineCallbacks
+    def testFeedPublishManyWrongType(self):
+        from txredis.protocol import ResponseError
+        # a failed command inside the transaction is not a success
+        yield self.pub.redis.rpush(self.feed.feed_ids, "x")
+        yield self.assertFailure(self.feed.publish_many([("a", "1")]),
+                                 ResponseError)
+
+    @defer.inlineCallbacks
+    def testFeedRetractMany(self):
+        feed = self.feed
+        ids = map(str, range(10))
+        yield feed.publish_many([(i, i) for i in ids])
+
+        retracted = []
+        yield self.sub.register_handler(feed.channel_retract,
+                                        lambda id_, *args: retracted.append(id_))
+
+        ret = yield feed.retract_many([])
+        self.assertEqual(ret, [])
+
+        # non existing and repeated ids are ignored
+        ret = yield feed.retract_many(["3", "1", "nonexisting", "3", 5])
+        self.assertEqual(ret, ["3", "1", "5"])
+
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ["0", "2", "4", "6", "7", "8", "9"])
+        ret = yield feed.get_all()
+        self.assertEqual(set(ret.keys()), set(["0", "2", "4", "6", "7", "8",
+                                               "9"]))
+
+        while len(retracted) < 3:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(retracted, ["3", "1", "5"])
+
+        ret = yield feed.retract_many(["nonexisting"])
+        self.assertEqual(ret, [])
+
+    @defer.inlineCallbacks
+    def testFeedCodec(self):
+        from txthoonk.codec import UnknownCodec
+        from txthoonk.types import Feed
+        self.assertEqual((yield self.feed.get_codec()).name, 'raw')
+
+        yield self.assertFailure(self.pub.create_feed("bad", {'codec': 'xx'}),
+                                 UnknownCodec)
+        ret = yield self.pub.feed_exists("bad")
+        self.assertFalse(ret)
+
+        yield self.pub.create_feed("json", {'codec': 'json+zlib'})
+        feed = Feed(pub=self.pub, name="json")
+        codec = yield feed.get_codec()
+        self.assertEqual(codec.name, 'json+zlib')
+
+        published = []
+        yield self.sub.register_handler(feed.channel_publish,
+                                        lambda *args: published.append(args),
+                                        codec='json+zlib')
+
+        big = {'big': 'x' * 10000}
+        yield feed.publish({'a': 1}, "1")
+        yield feed.publish_many([(big, "2"), ([None], "3")])
+
+        # stored compressed
+        ret = yield self.pub.redis.hget(feed.feed_items, "2")
+        self.assertEqual(ret["2"][0], "z")
+        self.assertTrue(len(ret["2"]) < 1000)
+
+        ret = yield feed.get_item("1")
+        self.assertEqual(ret, {"1": {'a': 1}})
+        ret = yield feed.get_all()
+        self.assertEqual(ret, {"1": {'a': 1}, "2": big, "3": [None]})
+        ret, cursor = yield feed.get_all_page()
+        self.assertEqual(ret, {"1": {'a': 1}, "2": big, "3": [None]})
+
+        while len(published) < 3:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(published, [("1", {'a': 1}), ("2", big),
+                                     ("3", [None])])
+
+
+class TestThoonkFeedScripting(TestThoonkFeed):
+    """Run all feed tests with a publisher using Lua scripts"""
+    skip = SKIP_FAKE_REDIS
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield TestThoonkFeed.setUp(self)
+
+        from txthoonk.client import ThoonkPub
+        from txthoonk.types import Feed
+        self.pub = ThoonkPub(self.pub.redis, scripting=True)
+        self.feed = Feed(pub=self.pub, name=self.feed_name)
+
+    @defer.inlineCallbacks
+    def testFeedPublishNoScript(self):
+        # script unknown by redis, must be loaded on demand
+        yield self.pub.redis.send('SCRIPT', 'FLUSH')
+        id_ = yield self.feed.publish("item", "myid")
+        self.assertEqual(id_, "myid")
+
+        ret = yield self.feed.get_item(id_)
+        self.assertEqual(ret, {id_: "item"})
+
+    @defer.inlineCallbacks
+    def testFeedPublishNonExistingFeed(self):
+        from txthoonk.client import FeedDoesNotExist
+        from txthoonk.types import Feed
+        feed = Feed(pub=self.pub, name="non_existing")
+        yield self.assertFailure(feed.publish("item"), FeedDoesNotExist)
+
+        ret = yield self.pub.redis.hgetall(feed.feed_items)
+        self.assertEqual(ret, {})
+
+
+class TestThoonkFeedPool(TestThoonkFeed):
+    """Run all feed tests with a publisher using a pool of connections"""
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield TestThoonkFeed.setUp(self)
+
+        from tests.test_thoonk_pubsub import REDIS_DB
+        from txthoonk.pool import connect_pool
+        from txthoonk.types import Feed
+        self.main_pub = self.pub
+        self.pub = yield connect_pool(self.endpoint, 3, db=REDIS_DB)
+        self.feed = Feed(pub=self.pub, name=self.feed_name)
+
+    def tearDown(self):
+        self.pub.pool.disconnect()
+        self.pub = self.main_pub
+        return TestThoonkFeed.tearDown(self)
+
+    @defer.inlineCallbacks
+    def testFeedPublishParallel(self):
+        from txthoonk.types import Feed
+        pool = self.pub.pool
+        feeds = [self.feed]
+        for name in ["feed1", "feed2"]:
+            yield self.pub.create_feed(name)
+            feeds.append(Feed(pub=self.pub, name=name))
+
+        leased = []
+        lease = pool.lease
+        def _lease():
+            return lease().addCallback(lambda r: leased.append(r) or r)
+        pool.lease = _lease
+
+        # each transaction has its own connection
+        yield defer.DeferredList([feed.publish("item", "id") for feed in feeds],
+                                 fireOnOneErrback=True)
+        self.assertEqual(len(set(leased)), 3)
+        self.assertEqual(pool.get_stats(),
+                         {'size': 3, 'leased': 0, 'waiting': 0})
+        for feed in feeds:
+            self.assertEqual(self.pub.retry_policy.get_stats(feed.name),
+                             {'attempts': 1, 'aborts': 0, 'exhausted': 0})
+            ret = yield feed.get_ids()
+            self.assertEqual(ret, ["id"])
+
+
+class TestThoonkSortedFeed(TestThoonkBase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield TestThoonkBase.setUp(self)
+
+        self.feed_name = "sorted"
+        self.feed = yield self.pub.sorted_feed(self.feed_name)
+
+    @defer.inlineCallbacks
+    def testSortedFeedCreate(self):
+        from txthoonk.types import SortedFeed
+        self.assertIsInstance(self.feed, SortedFeed)
+        self.assertEqual(self.feed.feed_idincr,
+                         "feed.idincr:%s" % self.feed_name)
+        self.assertEqual(self.feed.channel_position,
+                         "feed.position:%s" % self.feed_name)
+        ret = yield self.feed.get_config()
+        self.assertEqual(ret, {'type': 'sorted_feed'})
+
+    ############################################################################
+    #  Tests for append/prepend/publish_before/publish_after
+    ############################################################################
+    @defer.inlineCallbacks
+    def testSortedFeedAppendPrepend(self):
+        feed = self.feed
+        id1 = yield feed.append("a")
+        id2 = yield feed.publish("b")
+        id3 = yield feed.prepend("c")
+        self.assertEqual([id1, id2, id3], ["1", "2", "3"])
+
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ["3", "1", "2"])
+        ret = yield feed.get_all()
+        self.assertEqual(ret, {"1": "a", "2": "b", "3": "c"})
+        ret = yield self.pub.redis.get(feed.feed_publishes)
+        self.assertEqual(int(ret), 3)
+
+    @defer.inlineCallbacks
+    def testSortedFeedPublishBeforeAfter(self):
+        from txthoonk.client import ItemDoesNotExist
+        feed = self.feed
+        yield feed.append("a")
+        yield feed.append("b")
+        id_ = yield feed.publish_before("2", "c")
+        self.assertEqual(id_, "3")
+        id_ = yield feed.publish_after("1", "d")
+        self.assertEqual(id_, "4")
+
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ["1", "4", "3", "2"])
+
+        yield self.assertFailure(feed.publish_after("99", "e"),
+                                 ItemDoesNotExist)
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ["1", "4", "3", "2"])
+
+    @defer.inlineCallbacks
+    def testSortedFeedAppendMany(self):
+        feed = self.feed
+        yield feed.append("a")
+        ids = yield feed.append_many(["b", "c", "d"])
+        self.assertEqual(ids, ["2", "3", "4"])
+
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ["1", "2", "3", "4"])
+        ret = yield feed.get_all()
+        self.assertEqual(ret, {"1": "a", "2": "b", "3": "c", "4": "d"})
+
+        ret = yield feed.append_many([])
+        self.assertEqual(ret, [])
+
+    @defer.inlineCallbacks
+    def testSortedFeedAppendNonExistingFeed(self):
+        from txthoonk.client import FeedDoesNotExist
+        from txthoonk.types import SortedFeed
+        feed = SortedFeed(pub=self.pub, name="non_existing")
+        yield self.assertFailure(feed.append("item"), FeedDoesNotExist)
+        yield self.assertFailure(feed.append_many(["item"]), FeedDoesNotExist)
+        ret = yield self.pub.redis.exists(feed.feed_items)
+        self.assertFalse(ret)
+
+    @defer.inlineCallbacks
+    def testSortedFeedAppendManyAborted(self):
+        from tests.test_thoonk_pubsub import REDIS_DB
+        from txthoonk.client import ThoonkPubFactory
+        other = yield self.endpoint.connect(ThoonkPubFactory(db=REDIS_DB))
+        self.addCleanup(lambda: other.redis.transport.loseConnection())
+
+        # the shared connection is watching a key changed by another one
+        yield self.pub.redis.watch("feeds")
+        yield other.create_feed("other")
+
+        ids = yield self.feed.append_many(["a", "b"])
+        ret = yield self.feed.get_ids()
+        self.assertEqual(ret, ids)
+
+    @defer.inlineCallbacks
+    def testSortedFeedEvents(self):
+        feed = self.feed
+        published = []
+        positions = []
+        yield self.sub.register_handler(feed.channel_publish,
+                                        lambda *args: published.append(args))
+        yield self.sub.register_handler(feed.channel_position,
+                                        lambda *args: positions.append(args))
+
+        yield feed.append("a")
+        yield feed.prepend("b")
+        yield feed.publish_before("1", "c")
+        yield feed.publish_after("1", "d")
+        yield feed.edit("1", "e")
+        while len(published) < 5 or len(positions) < 4:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+
+        self.assertEqual(published, [("1", "a"), ("2", "b"), ("3", "c"),
+                                     ("4", "d"), ("1", "e")])
+        self.assertEqual(positions, [("1", ":end"), ("2", "begin:"),
+                                     ("3", ":1"), ("4", "1:")])
+
+    ############################################################################
+    #  Tests for edit
+    ############################################################################
+    @defer.inlineCallbacks
+    def testSortedFeedEdit(self):
+        from txthoonk.client import ItemDoesNotExist
+        feed = self.feed
+        yield feed.append("a")
+        id_ = yield feed.edit("1", "b")
+        self.assertEqual(id_, "1")
+        ret = yield feed.get_item("1")
+        self.assertEqual(ret, {"1": "b"})
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ["1"])
+
+        yield self.assertFailure(feed.edit("2", "c"), ItemDoesNotExist)
+
+    ############################################################################
+    #  Tests for move
+    ############################################################################
+    @defer.inlineCallbacks
+    def testSortedFeedMove(self):
+        from txthoonk.client import ItemDoesNotExist
+        feed = self.feed
+        yield feed.append_many(["a", "b", "c", "d"])
+
+        yield feed.move_first("3")
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ["3", "1", "2", "4"])
+
+        yield feed.move_last("1")
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ["3", "2", "4", "1"])
+
+        yield feed.move_before("2", "4")
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ["3", "4", "2", "1"])
+
+        yield feed.move_after("1", "3")
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ["4", "2", "1", "3"])
+
+        yield self.assertFailure(feed.move("9", ":end"), ItemDoesNotExist)
+        yield self.assertFailure(feed.move("1", ":9"), ItemDoesNotExist)
+        yield self.assertFailure(feed.move("1", "1:"), ValueError)
+        self.assertRaises(ValueError, feed.move, "1", "end")
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ["4", "2", "1", "3"])
+
+    @defer.inlineCallbacks
+    def testSortedFeedMoveMany(self):
+        from txthoonk.client import ItemDoesNotExist
+        feed = self.feed
+        yield feed.append_many(["a", "b", "c", "d", "e"])
+        positions = []
+        yield self.sub.register_handler(feed.channel_position,
+                                        lambda *args: positions.append(args))
+
+        ret = yield feed.move_many(["5", "1"], ":3")
+        self.assertEqual(ret, ["5", "1"])
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ["2", "5", "1", "3", "4"])
+
+        yield feed.move_many(["4", "2"], "begin:")
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ["4", "2", "5", "1", "3"])
+
+        yield feed.move_many(["4"], "3:")
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ["2", "5", "1", "3", "4"])
+
+        yield feed.move_many(["2", "5"], ":end")
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ["1", "3", "4", "2", "5"])
+
+        yield self.assertFailure(feed.move_many(["1", "9"], ":end"),
+                                 ItemDoesNotExist)
+        yield self.assertFailure(feed.move_many(["1"], ":9"),
+                                 ItemDoesNotExist)
+        yield self.assertFailure(feed.move_many(["1"], "1:"), ValueError)
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ["1", "3", "4", "2", "5"])
+
+        while len(positions) < 6:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(positions[:3], [("5", ":3"), ("1", "5:"),
+                                         ("4", "begin:")])
+
+    ############################################################################
+    #  Tests for retract
+    ############################################################################
+    @defer.inlineCallbacks
+    def testSortedFeedRetract(self):
+        feed = self.feed
+        yield feed.append_many(["a", "b", "c", "d"])
+        yield feed.retract("2")
+        yield feed.retract("9")
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ["1", "3", "4"])
+
+        ret = yield feed.retract_many(["4", "9", "1"])
+        self.assertEqual(ret, ["4", "1"])
+        ret = yield feed.get_ids()
+        self.assertEqual(ret, ["3"])
+        ret = yield feed.get_all()
+        self.assertEqual(ret, {"3": "c"})
+
+    ############################################################################
+    #  Tests for get*
+    ############################################################################
+    @defer.inlineCallbacks
+    def testSortedFeedIterIds(self):
+        feed = self.feed
+        yield feed.append_many(map(str, range(5)))
+        yield feed.move_first("5")
+        pages = []
+        for d in feed.iter_ids(page_size=2):
+            page = yield d
+            pages.append(page)
+        self.assertEqual(pages, [["5", "1"], ["2", "3"], ["4"]])
+
+    @defer.inlineCallbacks
+    def testSortedFeedCodec(self):
+        yield self.pub.set_config(self.feed_name, {'codec': 'json'})
+        feed = yield self.pub.sorted_feed(self.feed_name)
+        yield feed.append({"a": 1})
+        yield feed.append_many([[1], None])
+        yield feed.edit("3", {"b": 2})
+        ret = yield feed.get_all()
+        self.assertEqual(ret, {"1": {"a": 1}, "2": [1], "3": {"b": 2}})
+
+
+class TestThoonkSortedFeedScripting(TestThoonkSortedFeed):
+    """Run all sorted feed tests with a publisher using Lua scripts"""
+    skip = SKIP_FAKE_REDIS
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield TestThoonkSortedFeed.setUp(self)
+
+        from txthoonk.client import ThoonkPub
+        self.pub = ThoonkPub(self.pub.redis, scripting=True)
+        self.feed = yield self.pub.sorted_feed(self.feed_name)
+
+
+class TestThoonkBlockingBase(TestThoonkBase):
+    """Base of tests with a publisher using a blocking pool"""
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield TestThoonkBase.setUp(self)
+
+        from tests.test_thoonk_pubsub import REDIS_DB
+        from txthoonk.client import ThoonkPub
+        from txthoonk.pool import connect_redis_pool
+        self.blocking_pool = yield connect_redis_pool(self.endpoint, 2,
+                                                      db=REDIS_DB)
+        self.pub = ThoonkPub(self.pub.redis, blocking_pool=self.blocking_pool)
+
+    def tearDown(self):
+        self.blocking_pool.disconnect()
+        return TestThoonkBase.tearDown(self)
+
+
+class TestThoonkQueue(TestThoonkBlockingBase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield TestThoonkBlockingBase.setUp(self)
+
+        self.feed_name = "queue"
+        self.queue = yield self.pub.queue(self.feed_name)
+
+    @defer.inlineCallbacks
+    def testQueueCreate(self):
+        from txthoonk.types import Queue
+        self.assertIsInstance(self.queue, Queue)
+        ret = yield self.queue.get_config()
+        self.assertEqual(ret, {'type': 'queue'})
+
+    ############################################################################
+    #  Tests for put/get
+    ############################################################################
+    @defer.inlineCallbacks
+    def testQueuePutGet(self):
+        queue = self.queue
+        id_ = yield queue.put("a")
+        yield queue.put("b")
+        yield queue.put("c", priority=True)
+        ret = yield queue.get_ids()
+        self.assertEqual(ret[1:], [id_, ret[-1]])
+        self.assertEqual(len(ret), 3)
+
+        # priority first, then in order
+        for item in ["c", "a", "b"]:
+            ret = yield queue.get()
+            self.assertEqual(ret, item)
+
+        ret = yield queue.get_ids()
+        self.assertEqual(ret, [])
+        ret = yield self.pub.redis.hgetall(queue.feed_items)
+        self.assertEqual(ret, {})
+        ret = yield self.pub.redis.get(queue.feed_publishes)
+        self.assertEqual(int(ret), 3)
+
+    @defer.inlineCallbacks
+    def testQueueGetTimeout(self):
+        from txthoonk.client import QueueEmpty
+        yield self.assertFailure(self.queue.get(timeout=0.05), QueueEmpty)
+        yield self.assertFailure(self.queue.get_batch(5, timeout=0.05),
+                                 QueueEmpty)
+        self.assertEqual(self.blocking_pool.get_stats()['leased'], 0)
+
+    @defer.inlineCallbacks
+    def testQueueGetBlocking(self):
+        queue = self.queue
+        d = queue.get()
+        yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertNoResult(d)
+
+        # publisher connection is not blocked
+        ret = yield self.pub.feed_exists(self.feed_name)
+        self.assertTrue(ret)
+
+        yield queue.put("a")
+        ret = yield d
+        self.assertEqual(ret, "a")
+
+    @defer.inlineCallbacks
+    def testQueueNoBlockingPool(self):
+        from txthoonk.client import ThoonkPub
+        from txthoonk.types import Queue
+        queue = Queue(pub=ThoonkPub(self.pub.redis), name=self.feed_name)
+        yield self.assertFailure(queue.get(), ValueError)
+
+        # available items are got without blocking
+        yield self.queue.put_many(["a", "b"])
+        ret = yield queue.get()
+        self.assertEqual(ret, "a")
+        ret = yield queue.get_batch(2)
+        self.assertEqual(ret, ["b"])
+
+    ############################################################################
+    #  Tests for put_many/get_batch
+    ############################################################################
+    @defer.inlineCallbacks
+    def testQueuePutManyGetBatch(self):
+        queue = self.queue
+        ids = yield queue.put_many(["a", "b", "c", "d", "e"])
+        self.assertEqual(len(ids), 5)
+        yield queue.put_many(["x", "y"], priority=True)
+
+        ret = yield queue.get_batch(4)
+        self.assertEqual(ret, ["y", "x", "a", "b"])
+        ret = yield queue.get_batch(4)
+        self.assertEqual(ret, ["c", "d", "e"])
+
+        ret = yield queue.get_ids()
+        self.assertEqual(ret, [])
+        ret = yield self.pub.redis.hgetall(queue.feed_items)
+        self.assertEqual(ret, {})
+
+        # waits for an item
+        d = queue.get_batch(4)
+        yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertNoResult(d)
+        yield queue.put("f")
+        ret = yield d
+        self.assertEqual(ret, ["f"])
+
+        yield self.assertFailure(queue.get_batch(0), ValueError)
+
+    ############################################################################
+    #  Tests for inherited feed methods
+    ############################################################################
+    @defer.inlineCallbacks
+    def testQueueRetract(self):
+        queue = self.queue
+        ids = yield queue.put_many(["a", "b", "c", "d"])
+        yield queue.retract(ids[0])
+        yield queue.retract("other")
+        ret = yield queue.retract_many([ids[1], ids[2], "other"])
+        self.assertEqual(ret, ids[1:3])
+
+        ret = yield queue.get_ids()
+        self.assertEqual(ret, [ids[3]])
+        ret = yield self.pub.redis.hkeys(queue.feed_items)
+        self.assertEqual(ret, [ids[3]])
+
+    @defer.inlineCallbacks
+    def testQueuePublishMany(self):
+        queue = self.queue
+        yield self.assertFailure(queue.publish_many([("a", "1")]),
+                                 ValueError)
+        ids = yield queue.publish_many([("a", None), ("b", None)])
+        self.assertEqual(len(ids), 2)
+        yield queue.trim(1)
+
+        ret = yield queue.get_ids_page(count=1)
+        self.assertEqual(ret, ([ids[1]], 1))
+        ret = yield queue.get_ids_page(1, count=1)
+        self.assertEqual(ret, ([ids[0]], 2))
+        ret = yield queue.get_ids_page(2, count=1)
+        self.assertEqual(ret, ([], None))
+
+        ret = yield queue.get_batch(2)
+        self.assertEqual(ret, ["a", "b"])
+
+        yield self.assertFailure(queue.publish("a", "1"), ValueError)
+        yield queue.publish("a")
+        yield queue.publish("b", priority=True)
+        ret = yield queue.get_batch(2)
+        self.assertEqual(ret, ["b", "a"])
+
+    @defer.inlineCallbacks
+    def testQueuePutAborted(self):
+        queue = self.queue
+        # the shared connection is watching a key changed by another one
+        yield self.pub.redis.watch(queue.feed_publishes)
+        redis = yield self.blocking_pool.lease()
+        yield redis.set(queue.feed_publishes, 10)
+        self.blocking_pool.release(redis)
+
+        yield queue.put("a")
+        ret = yield self.pub.redis.get(queue.feed_publishes)
+        self.assertEqual(int(ret), 11)
+        ret = yield queue.get()
+        self.assertEqual(ret, "a")
+
+    @defer.inlineCallbacks
+    def testQueueCodec(self):
+        yield self.pub.set_config(self.feed_name, {'codec': 'json'})
+        queue = yield self.pub.queue(self.feed_name)
+        yield queue.put({"a": 1})
+        yield queue.put_many([[1], None])
+        ret = yield queue.get()
+        self.assertEqual(ret, {"a": 1})
+        ret = yield queue.get_batch(2)
+        self.assertEqual(ret, [[1], None])
+
+
+class TestThoonkJob(TestThoonkBlockingBase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield TestThoonkBlockingBase.setUp(self)
+
+        self.feed_name = "job"
+        self.job = yield self.pub.job(self.feed_name)
+
+    @defer.inlineCallbacks
+    def testJobPutGetFinish(self):
+        job = self.job
+        finished = []
+        yield self.sub.register_handler(job.channel_finish,
+                                        lambda *args: finished.append(args))
+
+        id_ = yield job.put("a")
+        ret = yield self.pub.redis.zscore(job.feed_published, id_)
+        self.assertNotEqual(ret, None)
+
+        ret = yield job.get()
+        self.assertEqual(ret, (id_, "a"))
+        ret = yield self.pub.redis.zscore(job.feed_claimed, id_)
+        self.assertNotEqual(ret, None)
+
+        yield job.finish(id_, "done")
+        ret = yield job.get_ids()
+        self.assertEqual(ret, [])
+        ret = yield self.pub.redis.get(job.feed_finishes)
+        self.assertEqual(int(ret), 1)
+        for key in [job.feed_published, job.feed_claimed]:
+            ret = yield self.pub.redis.zcard(key)
+            self.assertEqual(ret, 0)
+
+        while not finished:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(finished, [(id_, "done")])
+
+    @defer.inlineCallbacks
+    def testJobNotClaimed(self):
+        from txthoonk.client import JobNotClaimed, JobNotStalled, \
+            ItemDoesNotExist
+        job = self.job
+        id_ = yield job.put("a")
+        yield self.assertFailure(job.finish(id_), JobNotClaimed)
+        yield self.assertFailure(job.cancel(id_), JobNotClaimed)
+        yield self.assertFailure(job.stall(id_), JobNotClaimed)
+        yield self.assertFailure(job.retry(id_), JobNotStalled)
+        yield self.assertFailure(job.retract("other"), ItemDoesNotExist)
+
+    @defer.inlineCallbacks
+    def testJobCancelStallRetry(self):
+        from txthoonk.client import QueueEmpty
+        job = self.job
+        id_ = yield job.put("a")
+        yield job.get()
+        yield job.cancel(id_)
+        ret = yield job.get_failure_count(id_)
+        self.assertEqual(ret, 1)
+
+        # cancelled job is retried
+        ret = yield job.get()
+        self.assertEqual(ret, (id_, "a"))
+        yield job.stall(id_)
+        ret = yield self.pub.redis.smembers(job.feed_stalled)
+        self.assertEqual(ret, set([id_]))
+        ret = yield job.get_failure_count(id_)
+        self.assertEqual(ret, 0)
+        yield self.assertFailure(job.get(timeout=0.05), QueueEmpty)
+
+        yield job.retry(id_)
+        ret = yield job.get()
+        self.assertEqual(ret, (id_, "a"))
+
+        yield job.retract(id_)
+        ret = yield job.get_ids()
+        self.assertEqual(ret, [])
+        ret = yield self.pub.redis.zcard(job.feed_claimed)
+        self.assertEqual(ret, 0)
+
+    @defer.inlineCallbacks
+    def testJobGetBatch(self):
+        job = self.job
+        ids = yield job.put_many(["a", "b", "c"])
+        ret = yield job.get_batch(2)
+        self.assertEqual(ret, [(ids[0], "a"), (ids[1], "b")])
+        ret = yield self.pub.redis.zrange(job.feed_claimed, 0, -1)
+        self.assertEqual(sorted(ret), sorted(ids[:2]))
+
+        ret = yield job.get_batch(2)
+        self.assertEqual(ret, [(ids[2], "c")])
+        ret = yield job.get_ids()
+        self.assertEqual(sorted(ret), sorted(ids))
+
+    @defer.inlineCallbacks
+    def testJobPublishMany(self):
+        job = self.job
+        yield self.assertFailure(job.publish_many([("a", "id")]), ValueError)
+        yield job.publish_many([("a", None), ("b", None)])
+        ret = yield job.get_batch(2)
+        self.assertEqual([item for id_, item in ret], ["a", "b"])
+
+    @defer.inlineCallbacks
+    def testJobRetractMany(self):
+        job = self.job
+        ids = yield job.put_many(["a", "b", "c", "d"])
+        # a claimed, b stalled, c cancelled once, d available
+        yield job.get_batch(3)
+        yield job.stall(ids[1])
+        yield job.cancel(ids[2])
+
+        ret = yield job.retract_many(ids[1:] + ["other"])
+        self.assertEqual(ret, ids[1:])
+        ret = yield job.get_ids()
+        self.assertEqual(ret, [ids[0]])
+        ret = yield self.pub.redis.zrange(job.feed_claimed, 0, -1)
+        self.assertEqual(ret, [ids[0]])
+        ret = yield self.pub.redis.zrange(job.feed_published, 0, -1)
+        self.assertEqual(ret, [ids[0]])
+        ret = yield self.pub.redis.smembers(job.feed_stalled)
+        self.assertEqual(ret, set())
+        ret = yield job.get_failure_count(ids[2])
+        self.assertEqual(ret, 0)
+        ret = yield self.pub.redis.lrange(job.feed_ids, 0, -1)
+        self.assertEqual(ret, [])
+
+    @defer.inlineCallbacks
+    def testJobGetIdsPage(self):
+        job = self.job
+        ids = yield job.put_many([str(i) for i in range(5)])
+        # claimed jobs are listed too
+        yield job.get_batch(2)
+
+        found = []
+        cursor = None
+        while True:
+            page, cursor = yield job.get_ids_page(cursor, count=2)
+            found.extend(page)
+            if cursor is None:
+                break
+        self.assertEqual(sorted(set(found)), sorted(ids))
+
+    ############################################################################
+    #  Tests for maintenance
+    ############################################################################
+    @defer.inlineCallbacks
+    def testJobCancelClaims(self):
+        import time
+        job = self.job
+        ids = yield job.put_many(["a", "b", "c"])
+        yield job.get_batch(3)
+
+        ret = yield job.cancel_claims(time.time() - 60)
+        self.assertEqual(ret, ([], []))
+
+        # cancelled once, then stalled
+        cancelled, stalled = yield job.cancel_claims(time.time(), count=2,
+                                                     max_failures=1)
+        self.assertEqual((len(cancelled), stalled), (2, []))
+        yield job.get_batch(2)
+        ret = yield job.cancel_claims(time.time(), max_failures=1)
+        left = list(set(ids) - set(cancelled))
+        self.assertEqual(ret[0], left)
+        self.assertEqual(sorted(ret[1]), sorted(cancelled))
+
+        ret = yield self.pub.redis.smembers(job.feed_stalled)
+        self.assertEqual(ret, set(cancelled))
+        ret = yield job.get_batch(3)
+        self.assertEqual(ret, [(left[0], "abc"[ids.index(left[0])])])
+
+    @defer.inlineCallbacks
+    def testJobRequeueLost(self):
+        job = self.job
+        ids = yield job.put_many(["a", "b"])
+        ret = yield job.requeue_lost()
+        self.assertEqual(ret, ([], set()))
+
+        # claimed by the same transaction
+        yield job.get_batch(1)
+        ret = yield job.requeue_lost()
+        self.assertEqual(ret, ([], set()))
+
+        # a blocking get claims by the transaction removing it from claiming
+        yield self.pub.redis.send('RPOP', job.feed_ids)
+        d = job.get(timeout=5)
+        yield task.deferLater(reactor, 0.01, lambda: None)
+        yield self.pub.redis.send('LPUSH', job.feed_ids, ids[1])
+        ret = yield d
+        self.assertEqual(ret, (ids[1], "b"))
+        ret = yield self.pub.redis.lrange(job.feed_claiming, 0, -1)
+        self.assertEqual(ret, [])
+        yield job.cancel(ids[1])
+
+        # taken by a worker lost before claiming, requeued on the second call
+        yield self.pub.redis.send('RPOPLPUSH', job.feed_ids,
+                                  job.feed_claiming)
+        ret = yield job.requeue_lost()
+        self.assertEqual(ret, ([], set([ids[1]])))
+        ret = yield job.requeue_lost(ret[1])
+        self.assertEqual(ret, ([ids[1]], set()))
+        ret = yield job.requeue_lost(ret[1])
+        self.assertEqual(ret, ([], set()))
+
+        ret = yield job.get_batch(2)
+        self.assertEqual(ret, [(ids[1], "b")])
+
+
+class TestThoonkQueueScripting(TestThoonkQueue):
+    """Run all queue tests with a publisher using Lua scripts"""
+    skip = SKIP_FAKE_REDIS
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield TestThoonkQueue.setUp(self)
+
+        from txthoonk.client import ThoonkPub
+        self.pub = ThoonkPub(self.pub.redis, scripting=True,
+                             blocking_pool=self.blocking_pool)
+        self.queue = yield self.pub.queue(self.feed_name)
+
+
+class TestThoonkJobScripting(TestThoonkJob):
+    """Run all job tests with a publisher using Lua scripts"""
+    skip = SKIP_FAKE_REDIS
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield TestThoonkJob.setUp(self)
+
+        from txthoonk.client import ThoonkPub
+        self.pub = ThoonkPub(self.pub.redis, scripting=True,
+                             blocking_pool=self.blocking_pool)
+        self.job = yield self.pub.job(self.feed_name)
+
 
 if __name__ == "__main__":
     pass
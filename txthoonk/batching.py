@@ -0,0 +1,140 @@
+'''
+Write batching of redis connections.
+'''
+from txthoonk.stats import Histogram
+
+
+class WriteBatching(object):
+    """
+    Batching of the writes of connections.
+
+    Commands written to a wrapped transport are buffered and flushed by a
+    single write on the next reactor iteration (or max_delay seconds after
+    the first buffered command), or right away when max_bytes are buffered.
+    A burst of concurrent operations is sent by a few large writes instead
+    of a write (and a syscall) by command.
+
+    Counters are shared by all transports wrapped by this instance.
+
+    Attributes:
+        max_bytes - Buffered bytes flushed right away.
+        max_delay - Max seconds a command waits in buffer.
+        stats     - A dict of counters: batches, writes and bytes.
+        sizes     - A Histogram of the number of writes by batch.
+    """
+    def __init__(self, max_bytes=65536, max_delay=0, clock=None):
+        '''
+        Constructor
+
+        @param max_bytes: buffered bytes flushed right away.
+        @param max_delay: max seconds a command waits in buffer, 0 to flush
+                          on the next reactor iteration.
+        @param clock: the IReactorTime used to schedule flushes, defaults to
+                      the global reactor.
+        '''
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.clock = clock
+        self.stats = {'batches': 0,
+                      'writes': 0,
+                      'bytes': 0}
+        self.sizes = Histogram([2 ** i for i in range(17)])
+
+    def _get_clock(self):
+        if self.clock is None:
+            from twisted.internet import reactor
+            return reactor
+        return self.clock
+
+    def wrap(self, transport):
+        '''
+        Return a BatchingTransport writing to transport.
+        '''
+        return BatchingTransport(transport, self)
+
+    def flushed(self, writes, size):
+        '''
+        Count a batch.
+
+        @param writes: number of buffered writes.
+        @param size: bytes written.
+        '''
+        self.stats['batches'] += 1
+        self.stats['writes'] += writes
+        self.stats['bytes'] += size
+        self.sizes.add(writes)
+
+    def get_stats(self):
+        '''
+        Return a copy of the counters, with the histogram of writes by batch
+        (see Histogram.get_stats) as writes_by_batch.
+        '''
+        stats = dict(self.stats)
+        stats['writes_by_batch'] = self.sizes.get_stats()
+        return stats
+
+
+class BatchingTransport(object):
+    """
+    Transport proxy buffering writes, see WriteBatching.
+
+    Other attributes are the ones of the wrapped transport.
+    """
+    def __init__(self, transport, batching):
+        '''
+        Constructor
+
+        @param transport: the wrapped transport.
+        @param batching: the WriteBatching instance.
+        '''
+        self.transport = transport
+        self.batching = batching
+        self._buffer = []
+        self._size = 0
+        self._call = None
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._size += len(data)
+        if self._size >= self.batching.max_bytes:
+            self.flush()
+        elif self._call is None:
+            clock = self.batching._get_clock()
+            self._call = clock.callLater(self.batching.max_delay, self.flush)
+
+    def writeSequence(self, data):
+        for chunk in data:
+            self.write(chunk)
+
+    def flush(self):
+        '''
+        Write the buffered data.
+        '''
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+        if not self._buffer:
+            return
+        data = ''.join(self._buffer)
+        self.batching.flushed(len(self._buffer), len(data))
+        self._buffer = []
+        self._size = 0
+        self.transport.write(data)
+
+    def discard(self):
+        '''
+        Drop the buffered data, eg. when the connection is lost.
+        '''
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        self._buffer = []
+        self._size = 0
+
+    def loseConnection(self):
+        self.flush()
+        self.transport.loseConnection()
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
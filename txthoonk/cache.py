@@ -0,0 +1,598 @@
+'''
+Client side caches kept coherent by Thoonk events.
+'''
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+from twisted.internet import defer
+from twisted.python import log
+
+
+class ConfigCache(object):
+    """
+    A cache of feed configurations keyed by feed name.
+
+    Entries expire after ttl seconds and are invalidated by the conffeed and
+    delfeed events when the cache listens to a ThoonkSub (see listen).
+
+    Attributes:
+        ttl     - Time to live of entries, in seconds (None for no expiration).
+        hits    - Number of lookups found on cache.
+        misses  - Number of lookups not found on cache.
+        enabled - False while events may be lost.
+    """
+    def __init__(self, ttl=60, clock=None):
+        '''
+        Constructor
+
+        @param ttl: time to live of entries, in seconds.
+        @param clock: the IReactorTime used to expire entries, defaults to
+                      the global reactor.
+        '''
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.enabled = True
+        self._entries = {}
+        # incremented on each invalidation, avoids storing a config read
+        # before an invalidation.
+        self._generations = {}
+        # incremented when all entries are invalidated
+        self._cleared = 0
+
+    def _now(self):
+        if self.clock is None:
+            from twisted.internet import reactor
+            return reactor.seconds()
+        return self.clock.seconds()
+
+    def generation(self, feed_name):
+        '''
+        Return the current generation of a feed entry.
+
+        It must be read before fetching the config from redis and passed to
+        set.
+
+        @param feed_name: the name of the feed.
+        '''
+        return self._generations.get(feed_name, 0) + self._cleared
+
+    def get(self, feed_name):
+        '''
+        Return a copy of the cached config of a feed or None.
+
+        @param feed_name: the name of the feed.
+        '''
+        entry = self._entries.get(feed_name) if self.enabled else None
+        if entry is not None:
+            expires, config = entry
+            if expires is None or expires > self._now():
+                self.hits += 1
+                return dict(config)
+            del self._entries[feed_name]
+        self.misses += 1
+        return None
+
+    def set(self, feed_name, config, generation=None):
+        '''
+        Store the config of a feed.
+
+        @param feed_name: the name of the feed.
+        @param config: the config dictionary.
+        @param generation: the generation read before fetching config, if it
+                           has changed the config is not stored.
+        '''
+        if not self.enabled:
+            return
+        if generation is not None and generation != self.generation(feed_name):
+            return
+        expires = None
+        if self.ttl is not None:
+            expires = self._now() + self.ttl
+        self._entries[feed_name] = (expires, dict(config))
+
+    def invalidate(self, feed_name=None):
+        '''
+        Remove a feed entry from cache.
+
+        @param feed_name: the name of the feed, if None all entries are
+                          removed.
+        '''
+        if feed_name is None:
+            self._entries.clear()
+            self._cleared += 1
+            return
+        self._entries.pop(feed_name, None)
+        self._generations[feed_name] = self.generation(feed_name) + 1
+
+    def get_stats(self):
+        '''
+        Return the cache counters.
+        '''
+        return {'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses}
+
+    def listen(self, sub):
+        '''
+        Invalidate entries on conffeed and delfeed events, and all entries
+        when the connection of sub is lost or made.
+
+        @param sub: the ThoonkSub object.
+
+        @return: a defer fired when the handlers are registered.
+        '''
+        def _on_event(feed_name, *args):
+            self.invalidate(feed_name)
+
+        def _on_connection(connected):
+            self.invalidate()
+            self.enabled = connected
+
+        sub.register_connection_handler(_on_connection)
+        return defer.DeferredList([sub.register_handler("conffeed", _on_event),
+                                   sub.register_handler("delfeed", _on_event)],
+                                  fireOnOneErrback=True, consumeErrors=True)
+
+
+class ItemCache(object):
+    """
+    A bounded LRU cache of the items of a feed keyed by item id.
+
+    Entries are invalidated by the edit and retract events of the feed and
+    the cache is cleared by its delfeed event when the cache listens to a
+    ThoonkSub (see listen). While the ThoonkSub is disconnected the cache is
+    disabled, since events would be lost.
+
+    Missing items are not cached; a published item with a new id has no
+    entry to be invalidated. Cached items are shared by all readers and must
+    not be modified.
+
+    Attributes:
+        max_items - Max number of entries.
+        max_bytes - Max total size of encoded items, None for no limit.
+        hits      - Number of lookups found on cache.
+        misses    - Number of lookups not found on cache.
+        evictions - Number of entries removed by the limits.
+        enabled   - False while events may be lost.
+    """
+    def __init__(self, max_items=1000, max_bytes=None):
+        '''
+        Constructor
+
+        @param max_items: max number of entries.
+        @param max_bytes: max total size of encoded items, None for no limit.
+        '''
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.enabled = True
+        self.size = 0
+        # id -> (item, size of encoded item)
+        self._entries = OrderedDict()
+        # id -> [number of reads from redis running, generation], the
+        # generation is incremented on each invalidation, avoids storing an
+        # item read before an invalidation.
+        self._reads = {}
+
+    def get(self, id_):
+        '''
+        Return a tuple (found, item) for an item id.
+
+        @param id_: the item id.
+        '''
+        if self.enabled:
+            entry = self._entries.pop(id_, None)
+            if entry is not None:
+                # most recently used
+                self._entries[id_] = entry
+                self.hits += 1
+                return True, entry[0]
+        self.misses += 1
+        return False, None
+
+    def reading(self, id_):
+        '''
+        Mark a read of an item from redis as started.
+
+        @param id_: the item id.
+
+        @return: a token to be given to set or abort.
+        '''
+        read = self._reads.get(id_)
+        if read is None:
+            read = self._reads[id_] = [0, 0]
+        read[0] += 1
+        return read[1]
+
+    def abort(self, id_, token):
+        '''
+        Mark a read of an item from redis as failed.
+
+        @param id_: the item id.
+        @param token: the token returned by reading.
+        '''
+        read = self._reads[id_]
+        read[0] -= 1
+        if not read[0]:
+            del self._reads[id_]
+        return read[1] == token
+
+    def set(self, id_, item, size, token):
+        '''
+        Store an item read from redis.
+
+        @param id_: the item id.
+        @param item: the decoded item.
+        @param size: the size of encoded item.
+        @param token: the token returned by reading, if the item was
+                      invalidated meanwhile the item is not stored.
+        '''
+        if not self.abort(id_, token) or not self.enabled:
+            return
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        self._remove(id_)
+        self._entries[id_] = (item, size)
+        self.size += size
+        while (len(self._entries) > self.max_items or
+               (self.max_bytes is not None and self.size > self.max_bytes)):
+            # least recently used
+            old_id = next(iter(self._entries))
+            self._remove(old_id)
+            self.evictions += 1
+
+    def _remove(self, id_):
+        entry = self._entries.pop(id_, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def invalidate(self, id_=None):
+        '''
+        Remove an entry from cache.
+
+        @param id_: the item id, if None all entries are removed.
+        '''
+        if id_ is None:
+            self._entries.clear()
+            self.size = 0
+            for read in self._reads.values():
+                read[1] += 1
+            return
+
+        self._remove(id_)
+        read = self._reads.get(id_)
+        if read is not None:
+            read[1] += 1
+
+    def get_stats(self):
+        '''
+        Return the cache counters.
+        '''
+        return {'size': len(self._entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+    def listen(self, sub, feed_name, sorted_feed=False):
+        '''
+        Invalidate entries on edit, retract and delfeed events of a feed.
+
+        @param sub: the ThoonkSub object.
+        @param feed_name: the name of the feed.
+        @param sorted_feed: True if the feed is a SortedFeed, which sends
+                            edit notices on its publish channel.
+
+        @return: a defer fired when the handlers are registered.
+        '''
+        def _on_change(id_, *args):
+            self.invalidate(id_)
+
+        def _on_delete(name, *args):
+            if name == feed_name:
+                self.invalidate()
+
+        def _on_connection(connected):
+            self.invalidate()
+            self.enabled = connected
+
+        if sorted_feed:
+            edit_channel = "feed.publish:%s" % feed_name
+        else:
+            edit_channel = "feed.edit:%s" % feed_name
+
+        sub.register_connection_handler(_on_connection)
+        return defer.DeferredList(
+                    [sub.register_handler(edit_channel, _on_change),
+                     sub.register_handler("feed.retract:%s" % feed_name,
+                                          _on_change),
+                     sub.register_handler("delfeed", _on_delete)],
+                    fireOnOneErrback=True, consumeErrors=True)
+
+
+class FeedRegistry(object):
+    """
+    A bounded LRU registry of feed handles (eg. Feed objects) keyed by feed
+    name.
+
+    A ThoonkPub with a registry (feed_registry option) returns registered
+    handles from pub.feed(), pub.sorted_feed(), pub.queue() and pub.job()
+    without checking the feed exists on redis. Entries are invalidated by
+    delete_feed of the publisher and by the delfeed event when the registry
+    listens to a ThoonkSub (see listen). While the ThoonkSub is disconnected
+    the registry is disabled, since events would be lost.
+
+    Attributes:
+        max_feeds - Max number of entries.
+        hits      - Number of lookups found on registry.
+        misses    - Number of lookups not found on registry.
+        evictions - Number of entries removed by the limit.
+        enabled   - False while events may be lost.
+    """
+    def __init__(self, max_feeds=10000):
+        '''
+        Constructor
+
+        @param max_feeds: max number of entries.
+        '''
+        self.max_feeds = max_feeds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.enabled = True
+        self._entries = OrderedDict()
+        # incremented on each invalidation, avoids storing a handle resolved
+        # before an invalidation. A single counter keeps the registry
+        # bounded, at the cost of dropping some handles resolved meanwhile.
+        self._generation = 0
+
+    def generation(self):
+        '''
+        Return the current generation of the registry.
+
+        It must be read before checking the feed exists and passed to set.
+        '''
+        return self._generation
+
+    def get(self, feed_name, kls):
+        '''
+        Return the registered handle of a feed or None.
+
+        @param feed_name: the name of the feed.
+        @param kls: the python class of the handle, a handle of another
+                    class is not returned.
+        '''
+        if self.enabled:
+            feed = self._entries.pop(feed_name, None)
+            if feed is not None:
+                # most recently used
+                self._entries[feed_name] = feed
+                if feed.__class__ is kls:
+                    self.hits += 1
+                    return feed
+        self.misses += 1
+        return None
+
+    def set(self, feed, generation=None):
+        '''
+        Register the handle of a feed known to exist.
+
+        @param feed: the feed handle, registered by feed.name.
+        @param generation: the generation read before checking the feed
+                           exists, if it has changed the handle is not
+                           stored.
+        '''
+        if not self.enabled:
+            return
+        if generation is not None and generation != self._generation:
+            return
+        self._entries.pop(feed.name, None)
+        self._entries[feed.name] = feed
+        while len(self._entries) > self.max_feeds:
+            # least recently used
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, feed_name=None):
+        '''
+        Remove a feed entry from registry.
+
+        @param feed_name: the name of the feed, if None all entries are
+                          removed.
+        '''
+        if feed_name is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(feed_name, None)
+        self._generation += 1
+
+    def get_stats(self):
+        '''
+        Return the registry counters.
+        '''
+        return {'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+    def listen(self, sub):
+        '''
+        Invalidate entries on delfeed events.
+
+        @param sub: the ThoonkSub object.
+
+        @return: a defer fired when the handler is registered.
+        '''
+        def _on_delete(feed_name, *args):
+            self.invalidate(feed_name)
+
+        def _on_connection(connected):
+            self.invalidate()
+            self.enabled = connected
+
+        sub.register_connection_handler(_on_connection)
+        return sub.register_handler("delfeed", _on_delete)
+
+
+class FeedCatalogue(object):
+    """
+    A local mirror of the set of feed names.
+
+    load reads the feeds set by SSCAN pages (redis >= 2.8); then the
+    catalogue is kept current by the newfeed and delfeed events when it
+    listens to a ThoonkSub (see listen), and by create_feed and delete_feed
+    of a ThoonkPub with the catalogue (feed_catalogue option), which also
+    answers get_feed_names from it. While the ThoonkSub is disconnected the
+    catalogue is not loaded, since events would be lost; it is loaded again
+    when the subscriptions are restored.
+
+    Attributes:
+        page_size - COUNT hint of each SSCAN call.
+        loaded    - True when the catalogue mirrors the feeds set, until
+                    then lookups may miss feeds.
+        pub       - The ThoonkPub used by load, or None.
+    """
+    def __init__(self, page_size=1000):
+        '''
+        Constructor
+
+        @param page_size: COUNT hint of each SSCAN call.
+        '''
+        self.page_size = page_size
+        self.loaded = False
+        self.pub = None
+        self._names = set()
+        # sorted names, for prefix lookups; built when loaded
+        self._sorted = []
+        # names deleted while loading, a page may still have them
+        self._deleted = set()
+        # incremented by each load, a superseded load stops
+        self._load_id = 0
+
+    def __contains__(self, feed_name):
+        return feed_name in self._names
+
+    def __len__(self):
+        return len(self._names)
+
+    def get_names(self, prefix=None):
+        '''
+        Return the sorted list of feed names.
+
+        @param prefix: only names starting by prefix are returned.
+        '''
+        if not prefix:
+            return list(self._sorted)
+        pos = bisect_left(self._sorted, prefix)
+        ret = []
+        for name in self._sorted[pos:]:
+            if not name.startswith(prefix):
+                break
+            ret.append(name)
+        return ret
+
+    def add(self, feed_name):
+        '''
+        Add a created feed.
+
+        @param feed_name: the name of the feed.
+        '''
+        self._deleted.discard(feed_name)
+        if feed_name in self._names:
+            return
+        self._names.add(feed_name)
+        if self.loaded:
+            insort(self._sorted, feed_name)
+
+    def discard(self, feed_name):
+        '''
+        Remove a deleted feed.
+
+        @param feed_name: the name of the feed.
+        '''
+        if not self.loaded:
+            self._deleted.add(feed_name)
+        if feed_name not in self._names:
+            return
+        self._names.remove(feed_name)
+        if self.loaded:
+            del self._sorted[bisect_left(self._sorted, feed_name)]
+
+    def load(self, pub):
+        '''
+        Read the feed names from redis and mark the catalogue as loaded.
+
+        The catalogue must already listen to the events, so feeds created or
+        deleted while loading are not missed.
+
+        @param pub: the ThoonkPub object, also used by later loads.
+
+        @return: a defer fired with True when loaded, or with False if
+                 another load superseded it.
+        '''
+        self.pub = pub
+        self.loaded = False
+        self._names = set()
+        self._sorted = []
+        self._deleted = set()
+        self._load_id += 1
+        load_id = self._load_id
+
+        def _page(ret):
+            if load_id != self._load_id:
+                return False
+            cursor, names = ret
+            for name in names:
+                if name not in self._deleted:
+                    self._names.add(name)
+            if cursor:
+                d = pub.redis.sscan("feeds", cursor, count=self.page_size)
+                return d.addCallback(_page)
+            self._sorted = sorted(self._names)
+            self._deleted = set()
+            self.loaded = True
+            return True
+
+        d = pub.redis.sscan("feeds", 0, count=self.page_size)
+        return d.addCallback(_page)
+
+    def listen(self, sub):
+        '''
+        Follow the newfeed and delfeed events, and load again when the
+        subscriptions are restored after a connection loss.
+
+        @param sub: the ThoonkSub object.
+
+        @return: a defer fired when the handlers are registered.
+        '''
+        def _on_new(feed_name, *args):
+            self.add(feed_name)
+
+        def _on_delete(feed_name, *args):
+            self.discard(feed_name)
+
+        def _on_connection(connected):
+            # stop a running load
+            self._load_id += 1
+            self.loaded = False
+            if connected and self.pub is not None:
+                self.load(self.pub).addErrback(log.err,
+                                               "Feed catalogue load failed")
+
+        sub.register_connection_handler(_on_connection)
+        return defer.DeferredList(
+                    [sub.register_handler("newfeed", _on_new),
+                     sub.register_handler("delfeed", _on_delete)],
+                    fireOnOneErrback=True, consumeErrors=True)
+
+    def get_stats(self):
+        '''
+        Return the catalogue counters.
+        '''
+        return {'size': len(self._names),
+                'loaded': self.loaded}
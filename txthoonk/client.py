@@ -2,15 +2,23 @@ from zope.interface import implements #@UnresolvedImport
 
 from twisted.internet.protocol import ReconnectingClientFactory
 
-from txredis.protocol import Redis, RedisSubscriber, defer
-from twisted.internet import interfaces
+from txredis.protocol import Redis, RedisSubscriber, ResponseError, defer
+from twisted.internet import interfaces, task
+from twisted.python import log
 
 import uuid
 import itertools
-from txthoonk.types import Feed
+import time
+from txthoonk.protocol import ThoonkRedis, ThoonkRedisSubscriber, check_exec
+from txthoonk.types import Feed, SortedFeed, Queue, Job
+from txthoonk.retry import RetryPolicy, TransactionAborted
+from txthoonk.dispatch import Dispatcher
+from txthoonk.codec import get_codec, UnknownCodec
+from txthoonk.batching import BatchingTransport
+from txthoonk import scripts
 
 try:
-    from collection import OrderedDict
+    from collections import OrderedDict
 except ImportError:
     OrderedDict = dict
 
@@ -20,6 +28,24 @@ class FeedExists(Exception):
 class FeedDoesNotExist(Exception):
     pass
 
+class ItemDoesNotExist(Exception):
+    pass
+
+class QueueEmpty(Exception):
+    pass
+
+class JobNotClaimed(Exception):
+    pass
+
+class JobNotStalled(Exception):
+    pass
+
+
+# prefixes of the data keys of all feed types, removed by delete_feed
+FEED_DATA_KEYS = ('feed.ids', 'feed.items', 'feed.publishes', 'feed.idincr',
+                  'feed.published', 'feed.claimed', 'feed.cancelled',
+                  'feed.stalled', 'feed.finishes', 'feed.claiming')
+
 
 class ThoonkBase(object):
     """
@@ -28,6 +54,16 @@ class ThoonkBase(object):
     SEPARATOR = "\x00"
     implements(interfaces.IProtocol)
 
+    # keyword arguments of constructor, the factories pass them to this
+    # class instead of txredis.
+    options = ()
+
+    # the txthoonk.stats.Observer notified of commands and operations
+    observer = None
+
+    # the txthoonk.batching.WriteBatching of connection writes
+    write_batching = None
+
     def __init__(self, redis):
         '''
         Constructor
@@ -43,8 +79,18 @@ class ThoonkBase(object):
 
         @param redis: the txredis instance
         '''
+        if self.observer is not None and hasattr(redis, 'observer'):
+            redis.observer = self.observer
         self.redis = redis
 
+    def get_stats(self):
+        '''
+        Return the snapshot of observer, see txthoonk.stats.
+        '''
+        if self.observer is None:
+            return {}
+        return self.observer.get_stats()
+
     def dataReceived(self, data):
         """
         Called whenever data is received.
@@ -73,12 +119,19 @@ class ThoonkBase(object):
 
         @type reason: L{twisted.python.failure.Failure}
         """
+        if isinstance(self.redis.transport, BatchingTransport):
+            self.redis.transport.discard()
         self.redis.connectionLost(reason)
 
     def makeConnection(self, transport):
         """
         Make a connection to a transport and a server.
+
+        If write_batching is set, writes are buffered by a
+        txthoonk.batching.BatchingTransport.
         """
+        if self.write_batching is not None:
+            transport = self.write_batching.wrap(transport)
         self.redis.makeConnection(transport)
 
     def connectionMade(self):
@@ -99,10 +152,192 @@ class ThoonkPub(ThoonkBase):
     Thoonk publisher class
     '''
     redis = Redis() # pydev: force code completion
+    options = ('scripting', 'retry_policy', 'config_cache', 'trim_chunk',
+               'blocking_pool', 'observer', 'write_batching', 'feed_registry',
+               'feed_catalogue')
+
+    def __init__(self, redis, scripting=False, retry_policy=None,
+                 config_cache=None, trim_chunk=1000, blocking_pool=None,
+                 observer=None, write_batching=None, feed_registry=None,
+                 feed_catalogue=None):
+        '''
+        Constructor
 
-    def __init__(self, *args, **kwargs):
+        @param redis: the txredis instance
+        @param scripting: if True, feed operations are executed by Lua scripts
+                          on redis server (requires redis >= 2.6).
+        @param retry_policy: the txthoonk.retry.RetryPolicy used by aborted
+                             transactions, it may be shared by many
+                             publishers.
+        @param config_cache: an optional txthoonk.cache.ConfigCache used by
+                             get_config. Call config_cache.listen(sub) in
+                             order to invalidate it on conffeed/delfeed
+                             events.
+        @param trim_chunk: max number of items removed from a feed by each
+                           server side trim call, 0 for no limit.
+        @param blocking_pool: a txthoonk.pool.RedisPool of dedicated
+                              connections used by blocking commands (eg.
+                              BRPOP of Queue.get), so they never block the
+                              connections of this publisher.
+        @param observer: an optional txthoonk.stats.Observer notified of
+                         redis commands, feed operations and aborted
+                         transactions.
+        @param write_batching: an optional txthoonk.batching.WriteBatching
+                               buffering the commands of a reactor
+                               iteration into a single write. It applies to
+                               connections made by the factories.
+        @param feed_registry: an optional txthoonk.cache.FeedRegistry of
+                              feed handles returned by feed, sorted_feed,
+                              queue and job without checking the feed
+                              exists. Call feed_registry.listen(sub) in
+                              order to invalidate it on delfeed events.
+        @param feed_catalogue: an optional txthoonk.cache.FeedCatalogue
+                               answering get_feed_names once loaded. Call
+                               feed_catalogue.listen(sub) and then
+                               feed_catalogue.load(pub).
+        '''
+        self.scripting = scripting
+        self.observer = observer
+        self.write_batching = write_batching
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self.retry_policy = retry_policy
+        self.config_cache = config_cache
+        self.feed_registry = feed_registry
+        self.feed_catalogue = feed_catalogue
+        self.trim_chunk = trim_chunk
+        self.blocking_pool = blocking_pool
+        # True if redis has UNLINK, None until checked
+        self.unlink = None
+        # True if redis runs Lua scripts, None until checked
+        self.lua = None
+        # feed name -> defer of the running purge of its data, see
+        # delete_feed
+        self.purging = {}
         self.feed = self._get_feed_type(Feed, type_="feed")
-        super(ThoonkPub, self).__init__(*args, **kwargs)
+        self.sorted_feed = self._get_feed_type(SortedFeed, type_="sorted_feed")
+        self.queue = self._get_feed_type(Queue, type_="queue")
+        self.job = self._get_feed_type(Job, type_="job")
+        super(ThoonkPub, self).__init__(redis)
+
+    def load_scripts(self):
+        '''
+        Load all Lua scripts into redis script cache.
+
+        It is not required, scripts are loaded on demand, but avoids the
+        extra round trip on first use of each script.
+        '''
+        return defer.DeferredList([s.load(self.redis) for s in scripts.SCRIPTS],
+                                  fireOnOneErrback=True, consumeErrors=True)
+
+    def retry(self, feed_name, attempt):
+        '''
+        Run an optimistic transaction using self.retry_policy.
+
+        @param feed_name: the name of the feed, used on contention counters.
+        @param attempt: a function returning a defer, this defer must fail
+                        with TransactionAborted in order to be retried.
+        '''
+        observer = self.observer
+        if observer is None:
+            return self.retry_policy.run(feed_name, attempt)
+
+        def _aborted(failure):
+            if failure.check(TransactionAborted):
+                observer.aborted(feed_name)
+            return failure
+
+        def _attempt():
+            return defer.maybeDeferred(attempt).addErrback(_aborted)
+
+        return self.retry_policy.run(feed_name, _attempt)
+
+    def lease(self):
+        '''
+        Lease a connection for exclusive use, eg. a WATCH..EXEC span.
+
+        This publisher has a single connection, it is always returned and
+        concurrent transactions share it. See txthoonk.pool.ThoonkPubPool
+        for a publisher with many connections.
+
+        @return: a defer witch callback function will have the connection as
+                 the first argument, it must be given back by release.
+        '''
+        return defer.succeed(self.redis)
+
+    def release(self, redis):
+        '''
+        Give back a connection returned by lease.
+
+        @param redis: the leased connection.
+        '''
+        pass
+
+    def with_connection(self, func):
+        '''
+        Call func with a leased connection, releasing it when done.
+
+        func must not wait for other commands of this publisher while the
+        connection is leased, it must use the given connection instead.
+
+        @param func: a function receiving the connection and returning a
+                     defer.
+        '''
+        def _release(ret, redis):
+            self.release(redis)
+            return ret
+
+        def _call(redis):
+            d = defer.maybeDeferred(func, redis)
+            return d.addBoth(_release, redis)
+
+        return self.lease().addCallback(_call)
+
+    def with_blocking_connection(self, func):
+        '''
+        Call func with a connection leased from blocking_pool, releasing it
+        when done.
+
+        Fails with ValueError if this publisher has no blocking_pool.
+
+        @param func: a function receiving the connection and returning a
+                     defer.
+        '''
+        pool = self.blocking_pool
+        if pool is None:
+            return defer.fail(ValueError("blocking commands require a "
+                                         "blocking_pool"))
+
+        def _release(ret, redis):
+            pool.release(redis)
+            return ret
+
+        def _call(redis):
+            d = defer.maybeDeferred(func, redis)
+            return d.addBoth(_release, redis)
+
+        return pool.lease().addCallback(_call)
+
+    def transaction(self, feed_name, attempt):
+        '''
+        Run an optimistic transaction, each attempt on a leased connection.
+
+        @param feed_name: the name of the feed, used on contention counters.
+        @param attempt: a function receiving the connection and returning a
+                        defer, this defer must fail with TransactionAborted
+                        in order to be retried.
+        '''
+        return self.retry(feed_name, lambda: self.with_connection(attempt))
+
+    def run_script(self, script, keys=(), args=()):
+        '''
+        Run a Lua script on redis.
+
+        @param script: the txthoonk.scripts.Script instance.
+        @param keys: the list of redis keys used by the script.
+        @param args: the list of additional arguments of script.
+        '''
+        return script(self.redis, keys, args)
 
     def _get_feed_type(self, kls, type_):
         '''
@@ -116,11 +351,25 @@ class ThoonkPub(ThoonkBase):
             '''
             Creates a new feed of this type.
 
+            If self.feed_registry is set, a registered handle of the feed
+            may be returned from it.
+
             @param feed_name: the name of the feed.
             '''
+            registry = self.feed_registry
+            generation = None
+            if registry is not None:
+                feed = registry.get(feed_name, kls)
+                if feed is not None:
+                    return defer.succeed(feed)
+                generation = registry.generation()
+
             def _get_feed(*args):
                 """Create a new a new instance of passed class"""
-                return kls(pub=self, name=feed_name)
+                feed = kls(pub=self, name=feed_name)
+                if registry is not None:
+                    registry.set(feed, generation)
+                return feed
             def _exists(ret):
                 """
                 Called when self.feed_exists returns
@@ -136,20 +385,23 @@ class ThoonkPub(ThoonkBase):
 
         return _create_type
 
-    def _publish_channel(self, channel, *args):
+    def _publish_channel(self, channel, *args, **kwargs):
         """Calls self.publish_channel appending self._uuid at end"""
         args = list(args) + [self._uuid]
-        return self.publish_channel(channel, *args)
+        return self.publish_channel(channel, *args, **kwargs)
 
-    def publish_channel(self, channel, *args):
+    def publish_channel(self, channel, *args, **kwargs):
         '''
         Publish on channel.
 
         @param channel: the channel where message will be published
         @param *args: a list that will compose the message
+        @param redis: (keyword only) the connection used, defaults to
+                      self.redis. Transactions must give their connection.
         '''
+        redis = kwargs.get('redis', self.redis)
         message = self.SEPARATOR.join(args)
-        return self.redis.publish(channel, message)
+        return redis.publish(channel, message)
 
     def create_feed(self, feed_name, config={}):
         """
@@ -158,9 +410,17 @@ class ThoonkPub(ThoonkBase):
         The configuration is a dict, and should include a 'type'
         entry with the class of the feed type implementation.
 
+        The field 'codec' must name a registered codec (see txthoonk.codec),
+        otherwise it fails with UnknownCodec and nothing is created.
+
         @param feed_name: The name of the new feed.
         @param config: A dictionary of configuration values.
         """
+        try:
+            get_codec(config.get('codec'))
+        except UnknownCodec:
+            return defer.fail()
+
         def _set_config(ret):
             '''
             Called when self._publish_channel returns.
@@ -172,6 +432,8 @@ class ThoonkPub(ThoonkBase):
             Called when redis.sadd returns.
             """
             if ret == 1:
+                if self.feed_catalogue is not None:
+                    self.feed_catalogue.add(feed_name)
                 d = self._publish_channel("newfeed", feed_name)
                 d.addCallback(_set_config)
                 return d
@@ -180,113 +442,476 @@ class ThoonkPub(ThoonkBase):
 
         return self.redis.sadd("feeds", feed_name).addCallback(_publish)
 
-    def delete_feed(self, feed_name):
+    def _check_unlink(self):
+        '''
+        Check if redis has the UNLINK command (redis >= 4.0), the result is
+        kept on self.unlink.
+
+        @return: a defer witch callback function will have the result as
+                 first argument.
+        '''
+        if self.unlink is not None:
+            return defer.succeed(self.unlink)
+
+        def _supported(ret):
+            self.unlink = True
+            return True
+
+        def _unsupported(failure):
+            failure.trap(ResponseError)
+            if not str(failure.value).lower().startswith('err unknown'):
+                return failure
+            self.unlink = False
+            return False
+
+        d = self.redis.send('UNLINK', 'feed.deleted:unlink')
+        return d.addCallbacks(_supported, _unsupported)
+
+    def check_scripting(self):
+        '''
+        Check if redis runs Lua scripts (redis >= 2.6), even if scripting is
+        disabled on this publisher. The result is kept on self.lua.
+
+        @return: a defer witch callback function will have the result as
+                 first argument.
+        '''
+        if self.lua is not None:
+            return defer.succeed(self.lua)
+
+        def _supported(ret):
+            self.lua = True
+            return True
+
+        def _unsupported(failure):
+            failure.trap(ResponseError)
+            if not str(failure.value).lower().startswith('err unknown'):
+                return failure
+            self.lua = False
+            return False
+
+        d = self.redis.send('SCRIPT', 'EXISTS', scripts.FEED_TRIM.sha)
+        return d.addCallbacks(_supported, _unsupported)
+
+    def delete_feed(self, feed_name, chunk=None, progress=None):
         """
-        Delete a given feed.
+        Delete a given feed and all its data.
+
+        The feed name, config and data keys are removed by a single
+        transaction. Data keys are removed by UNLINK if redis has it (their
+        memory is freed by a background thread of redis), otherwise they
+        are renamed to trash keys (feed.deleted:[uuid]:[key]) emptied in
+        background by purge_keys; running purges are kept on self.purging.
 
         @param feed_name: The name of the feed.
+        @param chunk: max number of entries removed by each chunk of the
+                      purge, see purge_keys.
+        @param progress: an optional function called after each chunk of
+                         the purge, see purge_keys.
+
+        @return: a defer fired when the feed is deleted, a purge may still
+                 be running.
         """
         hash_feed_config = "feed.config:%s" % feed_name
+        data_keys = ["%s:%s" % (prefix, feed_name)
+                     for prefix in FEED_DATA_KEYS]
+        trash = "feed.deleted:%s:" % uuid.uuid4().hex
 
-        def _exec_check(bulk_result):
+        def _exec_check(bulk_result, trash_keys):
             # All defers must be succeed
             assert all([a[0] for a in bulk_result])
-            # assert number of commands
-            assert len(bulk_result) == 7
 
-            multi_result = bulk_result[-1][1]
+            multi_result = check_exec(bulk_result[-1][1])
             if multi_result:
                 # transaction done :D
-                # assert number commands in transaction
-                assert len(multi_result) == 3
                 # check if feed_name existed when was deleted
                 exists = multi_result[0]
+                if self.config_cache is not None:
+                    self.config_cache.invalidate(feed_name)
+                if self.feed_registry is not None:
+                    self.feed_registry.invalidate(feed_name)
+                if self.feed_catalogue is not None:
+                    self.feed_catalogue.discard(feed_name)
                 if not exists:
                     return defer.fail(FeedDoesNotExist())
+                if trash_keys:
+                    self._purge_in_background(feed_name, trash_keys, chunk,
+                                              progress)
                 return True
 
             # transaction fail :-(
             # repeat it
-            return self.delete_feed(feed_name)
+            return defer.fail(TransactionAborted())
 
-        defers = []
-        # issue all commands in order to avoid concurrent calls
-        defers.append(self.redis.watch("feeds")) #0
-        defers.append(self.redis.watch(hash_feed_config)) #1
-        # begin transaction
-        defers.append(self.redis.multi()) #2
-        defers.append(self.redis.srem("feeds", feed_name)) #3 - #0
-        defers.append(self.redis.delete(hash_feed_config)) #4 - #1
-        defers.append(self._publish_channel("delfeed", feed_name)) #5 - #2
-        # end transaction
-        defers.append(self.redis.execute()) #6
+        def _delete(bulk_result, redis, unlink):
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            exists = bulk_result[-1][1]
+            existing = [key for key, (_, ret) in zip(data_keys,
+                                                     bulk_result[1:-1])
+                        if ret]
+            trash_keys = []
+
+            defers = []
+            # begin transaction
+            defers.append(redis.multi())
+            defers.append(redis.srem("feeds", feed_name))
+            defers.append(redis.delete(hash_feed_config))
+            if exists and existing:
+                if unlink:
+                    defers.append(redis.send('UNLINK', *existing))
+                else:
+                    for key in existing:
+                        trash_keys.append(trash + key)
+                        defers.append(redis.send('RENAME', key, trash + key))
+            defers.append(self._publish_channel("delfeed", feed_name,
+                                                redis=redis))
+            # end transaction
+            defers.append(redis.execute())
+
+            d = defer.DeferredList(defers)
+            return d.addCallback(_exec_check, trash_keys)
+
+        def _attempt(redis, unlink):
+            defers = []
+            # issue all commands in order to avoid concurrent calls
+            defers.append(redis.watch("feeds", hash_feed_config, *data_keys))
+            for key in data_keys:
+                defers.append(redis.send('EXISTS', key))
+            defers.append(redis.sismember("feeds", feed_name))
+
+            d = defer.DeferredList(defers)
+            return d.addCallback(_delete, redis, unlink)
+
+        d = self._check_unlink()
+        return d.addCallback(lambda unlink: self.transaction(
+                                feed_name, lambda redis: _attempt(redis,
+                                                                  unlink)))
+
+    def _purge_in_background(self, feed_name, keys, chunk=None,
+                             progress=None):
+        '''
+        Start a purge of the keys of a deleted feed.
+        '''
+        d = self.purging[feed_name] = self.purge_keys(keys, chunk, progress)
+
+        def _done(ret):
+            if self.purging.get(feed_name) is d:
+                del self.purging[feed_name]
+            return ret
+
+        d.addErrback(log.err, "Failed to purge feed %r" % feed_name)
+        d.addBoth(_done)
+
+    def purge_keys(self, keys, chunk=None, progress=None):
+        '''
+        Remove keys without blocking redis.
+
+        Keys are removed by UNLINK if redis has it, otherwise hashes, sets,
+        sorted sets and lists are emptied in chunks (HSCAN/HDEL, SSCAN/SREM,
+        ZREMRANGEBYRANK and LTRIM), letting other clients run between
+        chunks. Keys must not be written meanwhile.
+
+        @param keys: the list of keys.
+        @param chunk: max number of entries removed by each chunk, defaults
+                      to self.trim_chunk, 0 to remove each key by a DEL.
+        @param progress: an optional function called with (key, removed)
+                         after each chunk, removed is the number of entries
+                         of the key removed so far, or None when the key was
+                         removed at once.
+
+        @return: A defer fired when all keys are removed.
+        '''
+        redis = self.redis
+        keys = list(keys)
+        if chunk is None:
+            chunk = self.trim_chunk
+
+        def _report(key, removed):
+            if progress is not None:
+                progress(key, removed)
+
+        def _del(key):
+            return redis.delete(key).addCallback(lambda ret:
+                                                 _report(key, None))
+
+        def _later(func, *args):
+            from twisted.internet import reactor
+            return task.deferLater(reactor, 0, func, *args)
+
+        def _scan(key, scan, remove, cursor=0, removed=0):
+            def _remove(ret):
+                cursor, elements = ret
+                if not elements:
+                    return _removed(0, cursor)
+                d = redis.send(remove, key, *elements)
+                return d.addCallback(_removed, cursor)
+
+            def _removed(count, cursor):
+                total = removed + count
+                _report(key, total)
+                if cursor:
+                    return _later(_scan, key, scan, remove, cursor, total)
+                # all members were scanned
+                return redis.delete(key)
+
+            return scan(key, cursor, count=chunk).addCallback(_remove)
+
+        def _trim_zset(key, removed=0):
+            def _removed(count):
+                _report(key, removed + count)
+                if count == chunk:
+                    return _later(_trim_zset, key, removed + count)
+
+            d = redis.send('ZREMRANGEBYRANK', key, 0, chunk - 1)
+            return d.addCallback(_removed)
+
+        def _trim_list(key, removed=0):
+            def _trim(length):
+                if length <= chunk:
+                    d = redis.delete(key)
+                    return d.addCallback(lambda ret:
+                                         _report(key, removed + length))
+                d = redis.ltrim(key, chunk, -1)
+                return d.addCallback(_trimmed)
+
+            def _trimmed(ret):
+                _report(key, removed + chunk)
+                return _later(_trim_list, key, removed + chunk)
+
+            return redis.llen(key).addCallback(_trim)
+
+        def _purge(type_, key):
+            if type_ == 'hash':
+                return _scan(key, redis.hscan, 'HDEL')
+            if type_ == 'set':
+                return _scan(key, redis.sscan, 'SREM')
+            if type_ == 'zset':
+                return _trim_zset(key)
+            if type_ == 'list':
+                return _trim_list(key)
+            return _del(key)
+
+        def _next(ret=None):
+            if not keys:
+                return None
+            key = keys.pop(0)
+            if not chunk:
+                d = _del(key)
+            else:
+                d = redis.send('TYPE', key).addCallback(_purge, key)
+            return d.addCallback(_next)
+
+        def _check_unlink(unlink):
+            if unlink:
+                d = redis.send('UNLINK', *keys)
+                return d.addCallback(lambda ret: [_report(key, None)
+                                                  for key in keys])
+            return _next()
 
-        return defer.DeferredList(defers).addCallback(_exec_check)
+        if not keys:
+            return defer.succeed(None)
+        d = self._check_unlink()
+        return d.addCallback(_check_unlink).addCallback(lambda ret: None)
 
-    def feed_exists(self, feed_name):
+    def feed_exists(self, feed_name, redis=None):
         """
         Check if a given feed exists.
 
         @param feed_name: The name of the feed.
+        @param redis: the connection used, defaults to self.redis.
         """
-
-        return self.redis.sismember("feeds", feed_name)
+        if redis is None:
+            redis = self.redis
+        return redis.sismember("feeds", feed_name)
 
     def set_config(self, feed_name, config):
         """
         Set the configuration for a given feed.
 
+        All values are written by a single HMSET and a conffeed event is
+        published. If scripting is enabled, it is done by a single Lua script
+        call.
+
         @param feed_name: The name of the feed.
         @param config: A dictionary of configuration values.
+
+        The field 'codec' must name a registered codec (see txthoonk.codec),
+        otherwise it fails with UnknownCodec.
         """
+        message = self.SEPARATOR.join([feed_name, self._uuid])
+        try:
+            get_codec(config.get('codec'))
+        except UnknownCodec:
+            return defer.fail()
+
+        def _invalidate(ret):
+            if self.config_cache is not None:
+                self.config_cache.invalidate(feed_name)
+            return True
+
+        if self.scripting and config:
+            def _check_result(ret):
+                if ret < 0:
+                    return defer.fail(FeedDoesNotExist())
+                return _invalidate(ret)
+
+            args = [feed_name, message]
+            for k, v in config.items():
+                args += [k, v]
+            d = self.run_script(scripts.SET_CONFIG,
+                                ["feeds", "feed.config:%s" % feed_name], args)
+            return d.addCallback(_check_result)
+
         def _exists(ret):
             if not ret:
                 return defer.fail(FeedDoesNotExist())
+            if not config:
+                # nothing to be changed
+                return True
 
-            dl = []
-            for k, v in config.items():
-                dl.append(self.redis.hset('feed.config:%s' % feed_name, k, v))
-            return defer.DeferredList(dl)
+            d = self.with_connection(_write)
+            return d.addCallback(_invalidate)
+
+        def _write(redis):
+            defers = []
+            # begin transaction
+            defers.append(redis.multi())
+            defers.append(redis.hmset('feed.config:%s' % feed_name, config))
+            defers.append(redis.publish("conffeed", message))
+            # end transaction
+            defers.append(redis.execute())
+            d = defer.DeferredList(defers, fireOnOneErrback=True,
+                                   consumeErrors=True)
+            d.addErrback(lambda failure: failure.value.subFailure)
+            return d.addCallback(lambda results: check_exec(results[-1][1]))
 
         return self.feed_exists(feed_name).addCallback(_exists)
 
-    def get_config(self, feed_name):
+    def set_config_many(self, configs):
+        """
+        Set the configuration of many feeds.
+
+        Existence of feeds is checked by a single pipeline and all configs
+        are written by a single transaction, publishing a conffeed event for
+        each feed. Nothing is written if any feed does not exist.
+
+        @param configs: A dictionary of feed name -> configuration dict.
+        """
+        names = [name for name, config in configs.items() if config]
+        try:
+            for name in names:
+                get_codec(configs[name].get('codec'))
+        except UnknownCodec:
+            return defer.fail()
+
+        def _exists(bulk_result):
+            missing = [name for name, (ok, exists) in zip(names, bulk_result)
+                       if not exists]
+            if missing:
+                return defer.fail(FeedDoesNotExist(*missing))
+
+            return self.with_connection(_write).addCallback(_invalidate)
+
+        def _write(redis):
+            defers = []
+            # begin transaction
+            defers.append(redis.multi())
+            for name in names:
+                message = self.SEPARATOR.join([name, self._uuid])
+                defers.append(redis.hmset('feed.config:%s' % name,
+                                          configs[name]))
+                defers.append(redis.publish("conffeed", message))
+            # end transaction
+            defers.append(redis.execute())
+            d = defer.DeferredList(defers, fireOnOneErrback=True,
+                                   consumeErrors=True)
+            d.addErrback(lambda failure: failure.value.subFailure)
+            return d.addCallback(lambda results: check_exec(results[-1][1]))
+
+        def _invalidate(ret):
+            if self.config_cache is not None:
+                for name in names:
+                    self.config_cache.invalidate(name)
+            return True
+
+        if not names:
+            return defer.succeed(True)
+
+        d = defer.DeferredList([self.feed_exists(name) for name in names],
+                               fireOnOneErrback=True, consumeErrors=True)
+        d.addErrback(lambda failure: failure.value.subFailure)
+        return d.addCallback(_exists)
+
+    def get_config(self, feed_name, redis=None):
         """
         Get the configuration for a given feed.
 
         @param feed_name: The name of the feed.
+        @param redis: the connection used, defaults to self.redis.
+
+        If self.config_cache is set, the config may be returned from it
+        without querying redis.
 
         @return: A defer witch callback function will have a config dict
                  as the first argument
         """
+        cache = self.config_cache
+        if cache is not None:
+            config = cache.get(feed_name)
+            if config is not None:
+                return defer.succeed(config)
+            generation = cache.generation(feed_name)
+
+        def _cache(config):
+            cache.set(feed_name, config, generation)
+            return config
+
         def _exists(ret):
             if not ret:
                 return defer.fail(FeedDoesNotExist())
 
-            return self.redis.hgetall('feed.config:%s' % feed_name)
+            d = redis.hgetall('feed.config:%s' % feed_name)
+            if cache is not None:
+                d.addCallback(_cache)
+            return d
 
-        return self.feed_exists(feed_name).addCallback(_exists)
+        if redis is None:
+            redis = self.redis
+        return self.feed_exists(feed_name, redis).addCallback(_exists)
 
     def get_feed_names(self):
         """
         Return the set of known feeds.
 
+        If self.feed_catalogue is loaded, the set is returned from it.
+
         @return: a defer witch callback function will have the set result
                 as first argument
         """
+        catalogue = self.feed_catalogue
+        if catalogue is not None and catalogue.loaded:
+            return defer.succeed(set(catalogue.get_names()))
         return self.redis.smembers("feeds")
 
 class ThoonkPubFactory(ReconnectingClientFactory):
     '''
     ThoonkPub Factory
     '''
-    protocol = Redis
+    protocol = ThoonkRedis
     protocol_wrapper = ThoonkPub
 
     def __init__(self, *args, **kwargs):
         '''
         Constructor
+
+        Keyword arguments listed in protocol_wrapper.options are passed to
+        protocol_wrapper, all other arguments are passed to protocol.
         '''
+        self._wrapper_kwargs = {}
+        for option in self.protocol_wrapper.options:
+            if option in kwargs:
+                self._wrapper_kwargs[option] = kwargs.pop(option)
         self._args = args
         self._kwargs = kwargs
 
@@ -306,39 +931,58 @@ class ThoonkPubFactory(ReconnectingClientFactory):
 
         redis = self.protocol(*self._args, **self._kwargs)
         self.resetDelay()
-        return self.protocol_wrapper(redis)
+        return self.protocol_wrapper(redis, **self._wrapper_kwargs)
 
 class ThoonkSub(ThoonkBase):
     '''
     Thoonk Subscriber class.
     '''
     redis = RedisSubscriber() # pydev: force code completion
+    options = ('catchup', 'dispatcher', 'observer')
 
-    def __init__(self, redis):
+    # max number of channels of each SUBSCRIBE command
+    subscribe_chunk = 1000
+
+    def __init__(self, redis, catchup=None, dispatcher=None, observer=None):
         '''
         Constructor
 
         @param redis: the txredis instance
+        @param catchup: an optional ThoonkPub used to replay, after a
+                        reconnection, the items published while
+                        disconnected to the feed.publish:[feed] handlers.
+                        Items may be delivered more than once.
+        @param dispatcher: the txthoonk.dispatch.Dispatcher calling the
+                           handlers, eg. in order to limit the concurrency
+                           of handlers returning defers.
+        @param observer: an optional txthoonk.stats.Observer notified of
+                         the messages received.
         '''
+        self.catchup = catchup
+        self.observer = observer
+        if dispatcher is None:
+            dispatcher = Dispatcher()
+        self.dispatcher = dispatcher
+        # feed name -> (id of last publish event or None, time)
+        self._last_seen = {}
+        # functions called with True when subscriptions are restored after
+        # a connection is made, with False when it is lost
+        self._connection_handlers = []
         self._handlers = {'id_gen': itertools.count(), #@UndefinedVariable
                           'channel_handlers': {},
-                          'id2channel' : {}}
-        # delay subscribe
-        self._subscribed = {'running': False,
-                            'subscribed': {},
-                            'running_for': None,
-                            'defer': None}
+                          'id2channel' : {},
+                          'pattern_handlers': {},
+                          'id2pattern': {}}
+        # subscribed: channel -> True
+        # pending: channel -> list of defers waiting for its subscription
+        self._subscribed = {'subscribed': {},
+                            'pending': {}}
+        # same for channel patterns
+        self._psubscribed = {'subscribed': {},
+                             'pending': {}}
 
         super(ThoonkSub, self).__init__(redis)
 
-    def _get_sub_channel_cb(self, channel):
-        '''
-        Returns a callback in order to subscribe one channel.
-
-        @param channel: the desired channel.
-        '''
-        return lambda arg: self._sub_channel(channel)
-
     def _evt2channel(self, evt):
         '''
         Convert Thoonk.py channels in compatible events
@@ -353,40 +997,75 @@ class ThoonkSub(ThoonkBase):
             channel = "delfeed"
         return channel
 
-    def _sub_channel(self, channel):
+    def _subscribe(self, state, command, channels):
         """
-        Subscribe to a channel using a defer.
+        Subscribe to many channels or patterns.
 
-        This call will queue channel subscriptions.
+        Channels not subscribed yet nor pending are subscribed by a single
+        command (one per subscribe_chunk channels), without waiting for
+        other subscriptions.
 
-        @param channel: the desired channel.
+        @param state: self._subscribed or self._psubscribed.
+        @param command: the txredis method, subscribe or psubscribe.
+        @param channels: the desired channels.
+
+        @return: a defer fired when all channels are subscribed.
         """
-        if self._subscribed['subscribed'].get(channel):
-            # already subcribed
-            return defer.succeed(True)
+        subscribed = state['subscribed']
+        pending = state['pending']
 
-        if self._subscribed['running']:
-            # call it later, queue it
-            d = self._subscribed['defer']
-            d.addCallback(self._get_sub_channel_cb(channel))
-            return d
+        defers = []
+        new = []
+        for channel in channels:
+            if subscribed.get(channel):
+                # already subcribed
+                continue
+            if channel not in pending:
+                pending[channel] = []
+                new.append(channel)
+            d = defer.Deferred()
+            pending[channel].append(d)
+            defers.append(d)
+
+        for pos in range(0, len(new), self.subscribe_chunk):
+            command(*new[pos:pos + self.subscribe_chunk])
+
+        return defer.DeferredList(defers, fireOnOneErrback=True,
+                                  consumeErrors=True)
+
+    def _subscribed_to(self, state, channel):
+        """
+        Mark a channel or pattern as subscribed, firing its pending defers.
+        """
+        state['subscribed'][channel] = True
+        for d in state['pending'].pop(channel, []):
+            d.callback(True)
 
-        def set_subscribed(*args):
-            '''
-            Called when channel was subscribed.
-            '''
-            self._subscribed['running'] = False
-            self._subscribed['subscribed'][channel] = True
-            return True
+    def _sub_channels(self, channels):
+        """
+        Subscribe to many channels by SUBSCRIBE.
+
+        @param channels: the desired channels.
+        """
+        return self._subscribe(self._subscribed, self.redis.subscribe,
+                               channels)
+
+    def _sub_patterns(self, patterns):
+        """
+        Subscribe to many channel patterns by PSUBSCRIBE.
 
-        self._subscribed['running'] = True
-        self.redis.subscribe(channel)
+        @param patterns: the desired patterns.
+        """
+        return self._subscribe(self._psubscribed, self.redis.psubscribe,
+                               patterns)
 
-        d = defer.Deferred()
-        self._subscribed['defer'] = d
-        self._subscribed['running_for'] = channel
+    def _sub_channel(self, channel):
+        """
+        Subscribe to a channel using a defer.
 
-        return d.addCallback(set_subscribed)
+        @param channel: the desired channel.
+        """
+        return self._sub_channels([channel]).addCallback(lambda x: True)
 
     def set_redis(self, redis):
         '''
@@ -394,12 +1073,13 @@ class ThoonkSub(ThoonkBase):
 
         @param redis: the txredis instance
         '''
-        # FIXME: on (re)connect (re)subscribe all channels
         redis.messageReceived = self.messageReceived
         redis.channelSubscribed = self.channelSubscribed
+        redis.patternMessageReceived = self.patternMessageReceived
+        redis.channelPatternSubscribed = self.channelPatternSubscribed
         super(ThoonkSub, self).set_redis(redis)
 
-    def register_handler(self, evt, handler):
+    def register_handler(self, evt, handler, codec=None):
         """
         Register a function to respond to feed events.
 
@@ -414,37 +1094,143 @@ class ThoonkSub(ThoonkBase):
 
         @param evt: The name of the feed event.
         @param handler: The function for handling the event.
+        @param codec: the codec (or its name) of the feed, the item param of
+                      publish and edit events is decoded by it (see
+                      Feed.get_codec).
         """
         channel = self._evt2channel(evt)
 
         if not channel:
             return defer.succeed(None)
 
+        if codec is not None:
+            handler = self._decoding_handler(handler, codec)
+
+        d = self.register_handlers({evt: handler})
+        return d.addCallback(lambda ids: ids[evt])
+
+    def _decoding_handler(self, handler, codec):
+        """
+        Return a handler decoding the item param before calling handler.
+
+        @param handler: The function for handling the event.
+        @param codec: the codec or its name.
+        """
+        if isinstance(codec, basestring):
+            codec = get_codec(codec)
+
+        def _handler(id_, *args):
+            if args:
+                args = (codec.decode(args[0]),) + args[1:]
+            return handler(id_, *args)
+        return _handler
+
+    def register_handlers(self, handlers):
+        """
+        Register many functions to respond to feed events.
+
+        All channels are subscribed together, see register_handler for the
+        event types.
+
+        @param handlers: A dictionary of event name -> handler function.
+
+        @return: A defer witch callback function will have a dictionary of
+                 event name -> handler id as the first argument.
+        """
+        channels = dict((evt, self._evt2channel(evt)) for evt in handlers)
+        channels = dict((evt, channel) for evt, channel in channels.items()
+                        if channel)
+
+        def _register_callback(*args):
+            """
+            Called when channels were subscribed.
+            """
+            ids = {}
+            for evt, channel in channels.items():
+                if channel.startswith('feed.publish:'):
+                    feed_name = channel[len('feed.publish:'):]
+                    self._last_seen.setdefault(feed_name, (None, time.time()))
+
+                id_ = self._handlers['id_gen'].next()
+
+                # store map id -> channel
+                self._handlers['id2channel'][id_] = channel
+
+                channel_handlers = self._handlers['channel_handlers']
+                if channel not in channel_handlers:
+                    channel_handlers[channel] = OrderedDict()
+
+                # store handler
+                channel_handlers[channel][id_] = handlers[evt]
+                ids[evt] = id_
+            return ids
+
+        d = self._sub_channels(set(channels.values()))
+        return d.addCallback(_register_callback)
+
+    def register_pattern_handler(self, pattern, handler):
+        """
+        Register a function to respond to events of all channels matching a
+        pattern (see redis PSUBSCRIBE), eg. feed.publish:* or
+        feed.*:orders-*.
+
+        The handler is called with the feed name and the event extracted
+        from the channel followed by the event params (see
+        register_handler), eg. handler(feedname, 'feed.publish', id, item).
+        Feed name is None for channels without it (newfeed, delfeed,
+        conffeed).
+
+        @param pattern: The channel pattern.
+        @param handler: The function for handling the events.
+        """
+        d = self.register_pattern_handlers({pattern: handler})
+        return d.addCallback(lambda ids: ids[pattern])
+
+    def register_pattern_handlers(self, handlers):
+        """
+        Register many functions to respond to events of channel patterns.
+
+        All patterns are subscribed together, see register_pattern_handler.
+
+        @param handlers: A dictionary of pattern -> handler function.
+
+        @return: A defer witch callback function will have a dictionary of
+                 pattern -> handler id as the first argument.
+        """
         def _register_callback(*args):
             """
-            Called when channel was subscribed.
+            Called when patterns were subscribed.
             """
-            id_ = self._handlers['id_gen'].next()
+            ids = {}
+            for pattern, handler in handlers.items():
+                id_ = self._handlers['id_gen'].next()
 
-            # store map id -> channel
-            self._handlers['id2channel'][id_] = channel
+                # store map id -> pattern
+                self._handlers['id2pattern'][id_] = pattern
 
-            handlers = self._handlers['channel_handlers'].get(channel)
-            if not handlers:
-                handlers = self._handlers['channel_handlers'][channel] = OrderedDict()
+                pattern_handlers = self._handlers['pattern_handlers']
+                if pattern not in pattern_handlers:
+                    pattern_handlers[pattern] = OrderedDict()
 
-            # store handler
-            handlers[id_] = handler
-            return id_
+                # store handler
+                pattern_handlers[pattern][id_] = handler
+                ids[pattern] = id_
+            return ids
 
-        return self._sub_channel(channel).addCallback(_register_callback)
+        d = self._sub_patterns(handlers.keys())
+        return d.addCallback(_register_callback)
 
     def remove_handler(self, id_):
         """
-        Unregister a function that was registered via register_handler
+        Unregister a function that was registered via register_handler or
+        register_pattern_handler
 
         @param id_: the handler id
         """
+        pattern = self._handlers['id2pattern'].pop(id_, None)
+        if pattern is not None:
+            del self._handlers['pattern_handlers'][pattern][id_]
+            return
 
         channel = self._handlers['id2channel'].get(id_)
         if not channel:
@@ -453,32 +1239,247 @@ class ThoonkSub(ThoonkBase):
         del self._handlers['channel_handlers'][channel][id_]
         del self._handlers['id2channel'][id_]
 
+    def makeConnection(self, transport):
+        """
+        Make a connection to a transport and a server.
+
+        All channels and patterns with handlers are subscribed again, and
+        if catchup is set, missed items are replayed once subscribed.
+        """
+        super(ThoonkSub, self).makeConnection(transport)
+        d = self._resubscribe()
+        d.addCallback(lambda x: self._connection_changed(True))
+        if self.catchup is not None:
+            d.addCallback(lambda x: self._catch_up_all())
+        d.addErrback(log.err, "Failed to restore subscriptions")
+
+    def connectionLost(self, reason):
+        """
+        Called when the connection is shut down.
+
+        Events published until subscriptions are restored are lost.
+        """
+        super(ThoonkSub, self).connectionLost(reason)
+        self._connection_changed(False)
+
+    def _connection_changed(self, connected):
+        for handler in list(self._connection_handlers):
+            try:
+                handler(connected)
+            except:
+                log.err(None, "Connection handler %r failed" % (handler,))
+
+    def register_connection_handler(self, handler):
+        """
+        Register a function called with True when all subscriptions are
+        restored after a connection is made, and with False when the
+        connection is lost, eg. to clear caches kept coherent by events.
+
+        @param handler: The function.
+        """
+        self._connection_handlers.append(handler)
+
+    def remove_connection_handler(self, handler):
+        """
+        Unregister a function registered by register_connection_handler.
+
+        @param handler: The function.
+        """
+        if handler in self._connection_handlers:
+            self._connection_handlers.remove(handler)
+
+    def _resubscribe(self):
+        """
+        Subscribe again all channels and patterns with handlers or pending,
+        in a single batch.
+
+        @return: a defer fired when all of them are subscribed.
+        """
+        defers = []
+        for state, command, handlers in (
+                (self._subscribed, self.redis.subscribe,
+                 self._handlers['channel_handlers']),
+                (self._psubscribed, self.redis.psubscribe,
+                 self._handlers['pattern_handlers'])):
+            pending = state['pending']
+            state['subscribed'] = {}
+            state['pending'] = {}
+
+            names = set(name for name, h in handlers.items() if h)
+            names.update(pending)
+            defers.append(self._subscribe(state, command, names))
+
+            # keep the defers waiting for the old connection
+            for name, waiting in pending.items():
+                state['pending'][name].extend(waiting)
+
+        return defer.DeferredList(defers, fireOnOneErrback=True,
+                                  consumeErrors=True)
+
+    def _catch_up_all(self):
+        """
+        Replay missed items of all feeds with feed.publish handlers.
+        """
+        defers = []
+        prefix = 'feed.publish:'
+        for channel, handlers in self._handlers['channel_handlers'].items():
+            if handlers and channel.startswith(prefix):
+                feed_name = channel[len(prefix):]
+                d = self.catch_up(feed_name)
+                d.addErrback(log.err, "Failed to catch up feed %r" % feed_name)
+                defers.append(d)
+        return defer.DeferredList(defers)
+
+    def catch_up(self, feed_name):
+        """
+        Replay to feed.publish:[feed] handlers the items of a feed newer
+        than its last publish event received (or than the registration of
+        its first handler).
+
+        Requires catchup to be set. Only feeds whose ids are a sorted set by
+        publication time (Feed) are replayed, nothing is done for other
+        feed types.
+
+        @param feed_name: The name of the feed.
+
+        @return: a defer witch callback function will have the list of
+                 replayed ids as the first argument.
+        """
+        redis = self.catchup.redis
+        channel = 'feed.publish:%s' % feed_name
+        feed_ids = 'feed.ids:%s' % feed_name
+        feed_items = 'feed.items:%s' % feed_name
+        last_id, last_time = self._last_seen.get(feed_name,
+                                                 (None, time.time()))
+
+        def _got_type(type_):
+            if type_ != 'zset':
+                # not a Feed, or no items
+                return []
+            if last_id is None:
+                return _got_score(None)
+            d = redis.send('ZSCORE', feed_ids, last_id)
+            return d.addCallback(_got_score)
+
+        def _got_score(score):
+            if score is None:
+                # no event or its item was removed
+                score = repr(last_time)
+            return redis.send('ZRANGEBYSCORE', feed_ids, '(%s' % score,
+                              '+inf')
+
+        def _got_ids(ids):
+            if not ids:
+                return []
+            d = redis.hmget(feed_items, ids)
+            return d.addCallback(_replay, ids)
+
+        def _replay(items, ids):
+            replayed = []
+            for id_ in ids:
+                item = items.get(id_)
+                if item is None:
+                    # retracted meanwhile
+                    continue
+                self.messageReceived(channel,
+                                     self.SEPARATOR.join([id_, item]))
+                replayed.append(id_)
+            return replayed
+
+        d = redis.send('TYPE', feed_ids)
+        return d.addCallback(_got_type).addCallback(_got_ids)
+
     def messageReceived(self, channel, message):
         """
         Called when this connection is subscribed to a channel that
         has received a message published on it.
         """
+        if self.observer is not None:
+            self.observer.message(channel)
         handlers = self._handlers['channel_handlers'].get(channel)
         if handlers is None:
             return
 
-        for handler in handlers.values():
-            args = message.split(self.SEPARATOR)
-            handler(*args)
+        args = self._parse(channel, message)
+        if self.catchup is not None and channel.startswith('feed.publish:'):
+            self._last_seen[channel[len('feed.publish:'):]] = (args[0],
+                                                               time.time())
+
+        self.dispatcher.dispatch(channel, handlers.values(), args)
+
+    def _parse(self, channel, message):
+        """
+        Return the list of params of a message.
+
+        The item param of publish and edit events may have separators.
+        """
+        if (channel.startswith('feed.publish:') or
+            channel.startswith('feed.edit:')):
+            return message.split(self.SEPARATOR, 1)
+        return message.split(self.SEPARATOR)
+
+    def patternMessageReceived(self, pattern, channel, message):
+        """
+        Called when this connection is subscribed to a channel pattern that
+        has received a message published on a matching channel.
+        """
+        if self.observer is not None:
+            self.observer.message(channel)
+        handlers = self._handlers['pattern_handlers'].get(pattern)
+        if handlers is None:
+            return
+
+        # feed.publish:[feed] -> ('feed.publish', feed)
+        evt, sep, feed_name = channel.partition(':')
+        if not sep:
+            feed_name = None
+
+        args = [feed_name, evt] + self._parse(channel, message)
+        self.dispatcher.dispatch(pattern, handlers.values(), args)
 
     def channelSubscribed(self, channel, numSubscriptions):
         """
         Called when a channel is subscribed to.
         """
-        assert self._subscribed['running']
-        assert self._subscribed['running_for'] == channel
-        d = self._subscribed['defer']
-        d.callback(True)
+        self._subscribed_to(self._subscribed, channel)
+
+    def channelPatternSubscribed(self, pattern, numSubscriptions):
+        """
+        Called when a channel pattern is subscribed to.
+        """
+        self._subscribed_to(self._psubscribed, pattern)
 
 class ThoonkSubFactory(ThoonkPubFactory):
     '''
     ThoonkSub Factory class.
     '''
-    protocol = RedisSubscriber
+    protocol = ThoonkRedisSubscriber
     protocol_wrapper = ThoonkSub
 
+    def __init__(self, *args, **kwargs):
+        '''
+        Constructor
+
+        Keyword arguments listed in protocol_wrapper.options are passed to
+        protocol_wrapper, all other arguments are passed to protocol.
+        '''
+        ThoonkPubFactory.__init__(self, *args, **kwargs)
+        self.sub = None
+
+    def buildProtocol(self, addr):
+        """
+        Called when a connection has been established to addr.
+
+        The same ThoonkSub (self.sub) is used by all connections, so its
+        handlers survive reconnections.
+
+        @return: the ThoonkSub instance.
+        """
+        redis = self.protocol(*self._args, **self._kwargs)
+        self.resetDelay()
+        if self.sub is None:
+            self.sub = self.protocol_wrapper(redis, **self._wrapper_kwargs)
+        else:
+            self.sub.set_redis(redis)
+        return self.sub
+
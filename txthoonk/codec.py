@@ -0,0 +1,135 @@
+'''
+Item codecs.
+
+The codec of a feed is recorded on the field 'codec' of its configuration,
+eg. {'codec': 'json'} or {'codec': 'json+zlib'}. Feeds without codec store
+items as given (raw strings), as other Thoonk implementations do.
+'''
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class UnknownCodec(Exception):
+    """
+    A codec name is not registered.
+    """
+    pass
+
+
+class RawCodec(object):
+    """
+    Items are strings, stored as given.
+    """
+    name = 'raw'
+
+    def encode(self, item):
+        return item
+
+    def decode(self, data):
+        return data
+
+
+class JSONCodec(object):
+    """
+    Items are JSON documents.
+    """
+    name = 'json'
+
+    def encode(self, item):
+        return json.dumps(item, separators=(',', ':'))
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class MsgpackCodec(object):
+    """
+    Items are MessagePack documents (requires msgpack package).
+    """
+    name = 'msgpack'
+
+    def encode(self, item):
+        return msgpack.packb(item)
+
+    def decode(self, data):
+        return msgpack.unpackb(data)
+
+
+class ZlibCodec(object):
+    """
+    Compress items encoded by another codec when they are larger than
+    threshold.
+
+    Encoded items have a marker byte: 'z' for compressed data, 'r' for
+    uncompressed data.
+    """
+    def __init__(self, codec, threshold=1024, level=6):
+        '''
+        Constructor
+
+        @param codec: the codec used before compression.
+        @param threshold: min size of data to be compressed, in bytes.
+        @param level: the zlib compression level.
+        '''
+        self.codec = codec
+        self.threshold = threshold
+        self.level = level
+        self.name = '%s+zlib' % codec.name
+
+    def encode(self, item):
+        data = self.codec.encode(item)
+        if len(data) < self.threshold:
+            return 'r' + data
+        return 'z' + zlib.compress(data, self.level)
+
+    def decode(self, data):
+        if data[:1] == 'z':
+            data = zlib.decompress(data[1:])
+        else:
+            data = data[1:]
+        return self.codec.decode(data)
+
+
+CODECS = {}
+
+
+def register_codec(codec):
+    '''
+    Register a codec by its name.
+
+    @param codec: an object with name attribute and encode/decode methods.
+    '''
+    CODECS[codec.name] = codec
+
+
+def get_codec(name=None):
+    '''
+    Return a registered codec.
+
+    Names ending with +zlib return the codec wrapped by ZlibCodec.
+
+    @param name: the codec name, None for raw.
+    '''
+    if name is None or name == '':
+        name = RawCodec.name
+    codec = CODECS.get(name)
+    if codec is not None:
+        return codec
+
+    base, sep, compression = name.rpartition('+')
+    if sep and compression == 'zlib':
+        codec = CODECS[name] = ZlibCodec(get_codec(base))
+        return codec
+
+    raise UnknownCodec(name)
+
+
+register_codec(RawCodec())
+register_codec(JSONCodec())
+if msgpack is not None:
+    register_codec(MsgpackCodec())
@@ -0,0 +1,120 @@
+'''
+Dispatch of subscribed events to handlers.
+'''
+from twisted.internet import defer
+from twisted.python import log
+
+
+class Dispatcher(object):
+    """
+    Calls the handlers of a channel (or pattern) for each message.
+
+    A failure of a handler is logged and does not stop the delivery to the
+    other handlers. Handlers may return a defer; when concurrency is set,
+    at most concurrency calls of each channel are running, the others wait
+    in order.
+
+    Counters are kept by channel: number of messages, handler calls and
+    errors, calls waiting for a slot, and the latency (seconds from message
+    receipt to the completion of each call).
+
+    Attributes:
+        concurrency - Max number of running calls by channel, None for no
+                      limit.
+        stats       - A dict of channel -> dict of counters.
+    """
+    def __init__(self, concurrency=None, clock=None):
+        '''
+        Constructor
+
+        @param concurrency: max number of running calls by channel, None for
+                            no limit.
+        @param clock: the IReactorTime used to measure latency, defaults to
+                      the global reactor.
+        '''
+        self.concurrency = concurrency
+        self.clock = clock
+        self.stats = {}
+        self._semaphores = {}
+
+    def _now(self):
+        if self.clock is None:
+            from twisted.internet import reactor
+            return reactor.seconds()
+        return self.clock.seconds()
+
+    def _get_counters(self, channel):
+        counters = self.stats.get(channel)
+        if counters is None:
+            counters = self.stats[channel] = {'messages': 0,
+                                              'calls': 0,
+                                              'errors': 0,
+                                              'waiting': 0,
+                                              'latency_max': 0.0,
+                                              'latency_total': 0.0}
+        return counters
+
+    def get_stats(self, channel=None):
+        '''
+        Return a copy of the counters.
+
+        @param channel: if given, return only the counters of this channel.
+        '''
+        if channel is not None:
+            return dict(self._get_counters(channel))
+        return dict((k, dict(v)) for k, v in self.stats.items())
+
+    def dispatch(self, channel, handlers, args):
+        '''
+        Call handlers with the params of a message.
+
+        @param channel: the channel (or pattern) of the message.
+        @param handlers: the list of handlers.
+        @param args: the list of params, already parsed.
+        '''
+        counters = self._get_counters(channel)
+        counters['messages'] += 1
+        start = self._now()
+
+        def _done(ret):
+            latency = self._now() - start
+            counters['calls'] += 1
+            counters['latency_total'] += latency
+            if latency > counters['latency_max']:
+                counters['latency_max'] = latency
+            return ret
+
+        def _failed(failure, handler):
+            counters['errors'] += 1
+            log.err(failure, "Handler %r of %r failed" % (handler, channel))
+
+        if self.concurrency is None:
+            for handler in handlers:
+                try:
+                    ret = handler(*args)
+                except:
+                    _failed(None, handler)
+                    _done(None)
+                    continue
+
+                if isinstance(ret, defer.Deferred):
+                    ret.addErrback(_failed, handler)
+                    ret.addBoth(_done)
+                else:
+                    _done(ret)
+            return
+
+        semaphore = self._semaphores.get(channel)
+        if semaphore is None:
+            semaphore = defer.DeferredSemaphore(self.concurrency)
+            self._semaphores[channel] = semaphore
+
+        def _call(handler):
+            counters['waiting'] -= 1
+            return handler(*args)
+
+        for handler in handlers:
+            counters['waiting'] += 1
+            d = semaphore.run(_call, handler)
+            d.addErrback(_failed, handler)
+            d.addBoth(_done)
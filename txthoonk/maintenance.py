@@ -0,0 +1,151 @@
+'''
+Maintenance of job feeds.
+'''
+import time
+
+from twisted.internet import defer, task
+from twisted.python import log
+
+
+class JobMaintenance(object):
+    """
+    Periodic maintenance of a job feed (txthoonk.types.Job), it must run on
+    a single process for each job feed.
+
+    Each round cancels the jobs claimed for more than claim_timeout seconds,
+    found by score range queries on feed.claimed, at most chunk jobs by
+    transaction; jobs already cancelled max_failures times are stalled
+    instead. Then it requeues the jobs lost between their get and claim (see
+    Job.requeue_lost).
+
+    Rounds run every interval seconds, scheduled by clock.callLater.
+
+    Attributes:
+        job           - The Job object.
+        claim_timeout - Max seconds a job may be claimed.
+        interval      - Seconds between rounds.
+        max_failures  - Max number of cancels of a job before it is stalled,
+                        None for no limit.
+        chunk         - Max number of jobs cancelled by each transaction.
+        stats         - A dict of counters: rounds, cancelled, stalled,
+                        requeued and errors.
+    """
+    def __init__(self, job, claim_timeout=300, interval=30, max_failures=None,
+                 chunk=1000, clock=None):
+        '''
+        Constructor
+
+        @param job: the Job object.
+        @param claim_timeout: max seconds a job may be claimed.
+        @param interval: seconds between rounds.
+        @param max_failures: max number of cancels of a job before it is
+                             stalled, None for no limit.
+        @param chunk: max number of jobs cancelled by each transaction.
+        @param clock: the IReactorTime used to schedule rounds, defaults to
+                      the global reactor.
+        '''
+        self.job = job
+        self.claim_timeout = claim_timeout
+        self.interval = interval
+        self.max_failures = max_failures
+        self.chunk = chunk
+        self.clock = clock
+        self.stats = {'rounds': 0,
+                      'cancelled': 0,
+                      'stalled': 0,
+                      'requeued': 0,
+                      'errors': 0}
+        self.running = False
+        self._call = None
+        self._round = None
+        # ids unaccounted on the last round
+        self._unaccounted = set()
+
+    def _get_clock(self):
+        if self.clock is None:
+            from twisted.internet import reactor
+            return reactor
+        return self.clock
+
+    def get_stats(self):
+        '''
+        Return a copy of the counters.
+        '''
+        return dict(self.stats)
+
+    def start(self):
+        '''
+        Start running rounds, the first one right now.
+        '''
+        if self.running:
+            return
+        self.running = True
+        self._schedule(0)
+
+    def stop(self):
+        '''
+        Stop running rounds.
+
+        @return: a defer fired when the running round, if any, is done.
+        '''
+        self.running = False
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        if self._round is None:
+            return defer.succeed(None)
+
+        d = defer.Deferred()
+        self._round.addBoth(lambda ret: d.callback(None) or ret)
+        return d
+
+    def _schedule(self, delay):
+        self._call = self._get_clock().callLater(delay, self._loop)
+
+    def _loop(self):
+        self._call = None
+
+        def _failed(failure):
+            self.stats['errors'] += 1
+            log.err(failure, "Maintenance of job %r failed" % self.job.name)
+
+        def _done(ret):
+            self._round = None
+            if self.running:
+                self._schedule(self.interval)
+
+        d = self._round = self.run()
+        d.addErrback(_failed)
+        d.addBoth(_done)
+
+    def run(self):
+        '''
+        Run a round of maintenance.
+
+        @return: a defer fired when the round is done.
+        '''
+        job = self.job
+        claimed_before = time.time() - self.claim_timeout
+
+        def _cancel():
+            d = job.cancel_claims(claimed_before, self.chunk,
+                                  self.max_failures)
+            return d.addCallback(_cancelled)
+
+        def _cancelled(ret):
+            cancelled, stalled = ret
+            self.stats['cancelled'] += len(cancelled)
+            self.stats['stalled'] += len(stalled)
+            if len(cancelled) + len(stalled) >= self.chunk:
+                # there may be more, let other clients run between chunks
+                return task.deferLater(self._get_clock(), 0, _cancel)
+
+            d = job.requeue_lost(self._unaccounted)
+            return d.addCallback(_requeued)
+
+        def _requeued(ret):
+            requeued, self._unaccounted = ret
+            self.stats['requeued'] += len(requeued)
+            self.stats['rounds'] += 1
+
+        return _cancel()
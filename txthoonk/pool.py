@@ -0,0 +1,280 @@
+'''
+Pool of redis connections used by txThoonk publishers.
+'''
+from collections import deque
+
+from twisted.internet import defer
+
+from txthoonk.batching import BatchingTransport
+from txthoonk.protocol import ThoonkRedis
+from txthoonk.client import ThoonkPub, ThoonkPubFactory
+
+
+class RedisPool(object):
+    """
+    A pool of redis connections.
+
+    Connections are leased for exclusive use, eg. by an optimistic
+    transaction for its WATCH..EXEC span. The least busy connection (the one
+    with fewer replies pending) is leased first; when all connections are
+    leased, leases wait for a release.
+
+    Commands of ThoonkRedis called on the pool itself are sent by the least
+    busy connection not leased, so they never enter a running transaction.
+    Commands not chained by callbacks may run on different connections, in
+    any order.
+
+    Attributes:
+        connections - The list of connected redis instances.
+    """
+    def __init__(self, connections=()):
+        '''
+        Constructor
+
+        @param connections: the initial redis instances.
+        '''
+        self.connections = []
+        self._leased = set()
+        self._waiting = deque()
+        for redis in connections:
+            self.add(redis)
+
+    def _load(self, redis):
+        return redis.pending_replies
+
+    def add(self, redis):
+        '''
+        Add a connection to the pool.
+
+        @param redis: the redis instance.
+        '''
+        self.connections.append(redis)
+        if self._waiting:
+            self._leased.add(redis)
+            self._waiting.popleft().callback(redis)
+
+    def remove(self, redis):
+        '''
+        Remove a connection from the pool, eg. when it is lost.
+
+        @param redis: the redis instance.
+        '''
+        if redis in self.connections:
+            self.connections.remove(redis)
+        self._leased.discard(redis)
+
+    def lease(self):
+        '''
+        Lease the least busy connection for exclusive use.
+
+        @return: a defer witch callback function will have the connection as
+                 the first argument, it must be given back by release.
+        '''
+        free = [r for r in self.connections if r not in self._leased]
+        if not free:
+            d = defer.Deferred()
+            self._waiting.append(d)
+            return d
+
+        redis = min(free, key=self._load)
+        self._leased.add(redis)
+        return defer.succeed(redis)
+
+    def release(self, redis):
+        '''
+        Give back a connection returned by lease.
+
+        @param redis: the leased connection.
+        '''
+        if redis not in self._leased:
+            return
+        self._leased.remove(redis)
+        if redis in self.connections and self._waiting:
+            self._leased.add(redis)
+            self._waiting.popleft().callback(redis)
+
+    def disconnect(self):
+        '''
+        Close all connections.
+        '''
+        for redis in list(self.connections):
+            redis.transport.loseConnection()
+
+    def get_stats(self):
+        '''
+        Return the pool counters.
+        '''
+        return {'size': len(self.connections),
+                'leased': len(self._leased),
+                'waiting': len(self._waiting)}
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not callable(getattr(ThoonkRedis, name,
+                                                        None)):
+            raise AttributeError(name)
+
+        def _command(*args, **kwargs):
+            """
+            Send the command by the least busy connection.
+            """
+            def _send(redis):
+                try:
+                    return getattr(redis, name)(*args, **kwargs)
+                finally:
+                    # replies are ordered, it may be leased again right now
+                    self.release(redis)
+
+            return self.lease().addCallback(_send)
+
+        _command.__name__ = name
+        return _command
+
+
+class PooledRedis(ThoonkRedis):
+    """
+    ThoonkRedis protocol adding itself to a RedisPool while connected.
+
+    If write_batching is set, writes are buffered by a
+    txthoonk.batching.BatchingTransport.
+    """
+    pool = None
+    write_batching = None
+
+    def makeConnection(self, transport):
+        if self.write_batching is not None:
+            transport = self.write_batching.wrap(transport)
+        ThoonkRedis.makeConnection(self, transport)
+
+    def connectionMade(self):
+        d = ThoonkRedis.connectionMade(self)
+        self.pool.add(self)
+        return d
+
+    def connectionLost(self, reason):
+        self.pool.remove(self)
+        if isinstance(self.transport, BatchingTransport):
+            self.transport.discard()
+        ThoonkRedis.connectionLost(self, reason)
+
+
+class ThoonkPubPool(ThoonkPub):
+    '''
+    Thoonk publisher using a pool of connections.
+
+    Each optimistic transaction leases a connection of pool, so concurrent
+    transactions do not share a WATCH..EXEC span and run in parallel. Other
+    commands are sent by the least busy connection.
+    '''
+    def __init__(self, pool, **kwargs):
+        '''
+        Constructor
+
+        @param pool: the RedisPool instance.
+
+        Keyword arguments are the ones of ThoonkPub.
+        '''
+        super(ThoonkPubPool, self).__init__(pool, **kwargs)
+
+    @property
+    def pool(self):
+        return self.redis
+
+    def lease(self):
+        '''
+        Lease a connection of pool for exclusive use.
+        '''
+        return self.redis.lease()
+
+    def release(self, redis):
+        '''
+        Give back a connection returned by lease.
+
+        @param redis: the leased connection.
+        '''
+        self.redis.release(redis)
+
+
+class ThoonkPubPoolFactory(ThoonkPubFactory):
+    '''
+    ThoonkPubPool Factory
+
+    All connections built by this factory are added to the same pool, used
+    by the publisher self.pub.
+    '''
+    protocol = PooledRedis
+    protocol_wrapper = ThoonkPubPool
+
+    def __init__(self, *args, **kwargs):
+        '''
+        Constructor
+
+        Keyword arguments listed in protocol_wrapper.options are passed to
+        protocol_wrapper, all other arguments are passed to protocol.
+        '''
+        ThoonkPubFactory.__init__(self, *args, **kwargs)
+        self.pool = RedisPool()
+        self.pub = self.protocol_wrapper(self.pool, **self._wrapper_kwargs)
+
+    def buildProtocol(self, addr):
+        """
+        Called when a connection has been established to addr.
+
+        @return: a PooledRedis of self.pool.
+        """
+        redis = self.protocol(*self._args, **self._kwargs)
+        redis.pool = self.pool
+        redis.observer = self._wrapper_kwargs.get('observer')
+        redis.write_batching = self._wrapper_kwargs.get('write_batching')
+        redis.factory = self
+        self.resetDelay()
+        return redis
+
+
+def _connect(factory, endpoint, size):
+    '''
+    Connect size connections of a ThoonkPubPoolFactory.
+    '''
+    d = defer.DeferredList([endpoint.connect(factory) for _ in range(size)],
+                           fireOnOneErrback=True, consumeErrors=True)
+
+    def _failed(failure):
+        factory.pool.disconnect()
+        return failure.value.subFailure
+
+    return d.addErrback(_failed)
+
+
+def connect_pool(endpoint, size=4, *args, **kwargs):
+    '''
+    Connect a pooled publisher.
+
+    @param endpoint: the IStreamClientEndpoint of redis server.
+    @param size: the number of connections.
+
+    Other arguments are the ones of ThoonkPubPoolFactory.
+
+    @return: a defer witch callback function will have the ThoonkPubPool
+             as the first argument, fired when all connections are made.
+    '''
+    factory = ThoonkPubPoolFactory(*args, **kwargs)
+    return _connect(factory, endpoint, size).addCallback(lambda x: factory.pub)
+
+
+def connect_redis_pool(endpoint, size=4, *args, **kwargs):
+    '''
+    Connect a RedisPool, eg. the blocking_pool of a publisher.
+
+    Each blocking command holds a connection until it returns, size is the
+    max number of concurrent blocking commands.
+
+    @param endpoint: the IStreamClientEndpoint of redis server.
+    @param size: the number of connections.
+
+    Other arguments are the ones of ThoonkRedis.
+
+    @return: a defer witch callback function will have the RedisPool as
+             the first argument, fired when all connections are made.
+    '''
+    factory = ThoonkPubPoolFactory(*args, **kwargs)
+    return _connect(factory, endpoint, size).addCallback(
+                                                    lambda x: factory.pool)
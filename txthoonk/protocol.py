@@ -0,0 +1,283 @@
+'''
+Redis protocols used by txThoonk publishers and subscribers.
+'''
+from txredis.protocol import Redis, RedisSubscriber, ResponseError, \
+    InvalidResponse
+
+
+class ThoonkRedis(Redis):
+    """
+    txredis Redis protocol supporting nested multi-bulk replies.
+
+    txredis 2.x parses a multi-bulk reply nested in another one as a new
+    reply, which breaks replies like the ones of SCAN family commands
+    ([cursor, [elements]]) or Lua scripts returning nested tables. This class
+    keeps a stack of the multi-bulk replies being received instead.
+
+    Errors nested in a multi-bulk reply (eg. a command failing inside
+    MULTI/EXEC) are returned as ResponseError instances.
+
+    If observer is set (a txthoonk.stats.Observer), it is notified of each
+    command with a reply and of the bytes received. Commands queued by MULTI
+    are measured until their QUEUED reply, EXEC until the reply of all of
+    them.
+
+    Attributes:
+        pending_replies - The number of commands sent waiting for a reply.
+    """
+    observer = None
+
+    def __init__(self, *args, **kwargs):
+        Redis.__init__(self, *args, **kwargs)
+        self.pending_replies = 0
+        # list of [number of missing elements, elements]
+        self._multi_bulk_stack = []
+        # (name, size) of the last command sent, while observed
+        self._sent = None
+
+    def dataReceived(self, data):
+        """Receive data.
+
+        Spec: http://redis.io/topics/protocol
+        """
+        if self.observer is not None:
+            self.observer.received(len(data))
+        self.resetTimeout()
+        self._buffer = self._buffer + data
+
+        while self._buffer:
+
+            # if we're expecting bulk data, read that many bytes
+            if self._bulk_length is not None:
+                # wait until there's enough data in the buffer
+                if len(self._buffer) < self._bulk_length + 2: # /r/n
+                    return
+                data = self._buffer[:self._bulk_length]
+                self._buffer = self._buffer[self._bulk_length + 2:]
+                self._bulk_length = None
+                self.replyReceived(data)
+                continue
+
+            # wait until we have a line
+            if '\r\n' not in self._buffer:
+                return
+
+            # grab a line
+            line, self._buffer = self._buffer.split('\r\n', 1)
+            if len(line) == 0:
+                continue
+
+            # first byte indicates reply type
+            reply_type = line[0]
+            reply_data = line[1:]
+
+            if reply_type == self.ERROR:
+                self.replyReceived(ResponseError(reply_data))
+            elif reply_type == self.INTEGER:
+                try:
+                    self.replyReceived(int(reply_data))
+                except ValueError:
+                    self.replyReceived(InvalidResponse(
+                        "Cannot convert data '%s' to integer" % reply_data))
+            elif reply_type == self.SINGLE_LINE:
+                self.replyReceived(None if reply_data == 'none' else
+                                   reply_data)
+            elif reply_type == self.BULK:
+                try:
+                    length = int(reply_data)
+                except ValueError:
+                    self.replyReceived(InvalidResponse(
+                        "Cannot convert data '%s' to integer" % reply_data))
+                    continue
+                if length == -1:
+                    # requested value may not exist
+                    self.replyReceived(None)
+                else:
+                    self._bulk_length = length
+            elif reply_type == self.MULTI_BULK:
+                try:
+                    length = int(reply_data)
+                except ValueError:
+                    self.replyReceived(InvalidResponse(
+                        "Cannot convert data '%s' to integer" % reply_data))
+                    continue
+                if length == -1:
+                    self.replyReceived(None)
+                elif length == 0:
+                    self.replyReceived([])
+                else:
+                    self._multi_bulk_stack.append([length, []])
+
+    def replyReceived(self, reply):
+        """
+        Handle a reply or an element of a multi-bulk reply.
+        """
+        while self._multi_bulk_stack:
+            pending = self._multi_bulk_stack[-1]
+            pending[1].append(reply)
+            pending[0] -= 1
+            if pending[0] > 0:
+                # wait for more elements
+                return
+            # multi-bulk is complete, it is an element of its parent
+            self._multi_bulk_stack.pop()
+            reply = pending[1]
+
+        if not self._request_queue:
+            if isinstance(reply, Exception):
+                raise reply
+            return
+
+        d = self._request_queue.popleft()
+        if isinstance(reply, Exception):
+            d.errback(reply)
+        else:
+            d.callback(reply)
+
+    def _send(self, *args):
+        """
+        Encode and send a request, see Redis._send.
+        """
+        cmds = []
+        for arg in args:
+            value = self._encode(arg)
+            cmds.append('$%s\r\n%s\r\n' % (len(value), value))
+        cmd = '*%s\r\n' % len(args) + ''.join(cmds)
+        self.transport.write(cmd)
+        if self.observer is not None:
+            self._sent = (args[0], len(cmd))
+
+    def getResponse(self):
+        """
+        Return a defer fired with the reply of the last command sent.
+        """
+        d = Redis.getResponse(self)
+        self.pending_replies += 1
+        d.addBoth(self._replied)
+        sent, self._sent = self._sent, None
+        observer = self.observer
+        if sent is None or observer is None:
+            return d
+
+        name, size = sent
+        name = name.upper()
+        start = observer.seconds()
+
+        def _done(ret, failed=False):
+            observer.command(name, observer.seconds() - start, size, failed)
+            return ret
+
+        return d.addCallbacks(_done, lambda f: _done(f, True))
+
+    def _replied(self, ret):
+        self.pending_replies -= 1
+        return ret
+
+    def _scan(self, command, key, cursor, match=None, count=None):
+        args = [command, key, cursor]
+        if match is not None:
+            args.extend(['MATCH', match])
+        if count is not None:
+            args.extend(['COUNT', count])
+        self._send(*args)
+
+        def post_process(reply):
+            cursor, elements = reply
+            return int(cursor), elements
+
+        return self.getResponse().addCallback(post_process)
+
+    def hscan(self, key, cursor=0, match=None, count=None):
+        """
+        Incrementally iterate over the fields of a hash (redis >= 2.8).
+
+        @return: a defer witch callback function will have a tuple of
+                 (next cursor, dict of fields) as the first argument, the
+                 iteration is complete when next cursor is 0.
+        """
+        def post_process(reply):
+            cursor, elements = reply
+            return cursor, dict(zip(elements[::2], elements[1::2]))
+        d = self._scan('HSCAN', key, cursor, match, count)
+        return d.addCallback(post_process)
+
+    def sscan(self, key, cursor=0, match=None, count=None):
+        """
+        Incrementally iterate over the members of a set (redis >= 2.8).
+
+        @return: a defer witch callback function will have a tuple of
+                 (next cursor, list of members) as the first argument, the
+                 iteration is complete when next cursor is 0.
+        """
+        return self._scan('SSCAN', key, cursor, match, count)
+
+    def zscan(self, key, cursor=0, match=None, count=None):
+        """
+        Incrementally iterate over the members of a sorted set
+        (redis >= 2.8).
+
+        @return: a defer witch callback function will have a tuple of
+                 (next cursor, list of (member, score)) as the first
+                 argument, the iteration is complete when next cursor is 0.
+        """
+        def post_process(reply):
+            cursor, elements = reply
+            return cursor, [(m, float(s)) for m, s in zip(elements[::2],
+                                                          elements[1::2])]
+        d = self._scan('ZSCAN', key, cursor, match, count)
+        return d.addCallback(post_process)
+
+
+def check_exec(reply):
+    '''
+    Raise the first error of an EXEC reply.
+
+    A command failing inside MULTI/EXEC (eg. WRONGTYPE) does not abort the
+    transaction: the other commands are applied and its error is returned
+    in its slot of the reply (see ThoonkRedis), so the transaction must not
+    be reported as done.
+
+    @param reply: the reply of EXEC, None if the transaction was aborted.
+
+    @return: the reply.
+    '''
+    for ret in reply or ():
+        if isinstance(ret, ResponseError):
+            raise ret
+    return reply
+
+
+class ThoonkRedisSubscriber(RedisSubscriber):
+    """
+    txredis RedisSubscriber protocol keeping the pattern of pmessage.
+
+    txredis 2.x passes messages received by a pattern subscription to
+    messageReceived, dropping the pattern. This class calls
+    patternMessageReceived instead.
+
+    If observer is set (a txthoonk.stats.Observer), it is notified of the
+    bytes received.
+    """
+    observer = None
+
+    def dataReceived(self, data):
+        if self.observer is not None:
+            self.observer.received(len(data))
+        RedisSubscriber.dataReceived(self, data)
+
+    def handleCompleteMultiBulkData(self, reply):
+        """
+        Intercept pmessage events, see RedisSubscriber.
+        """
+        if reply[0] == u"pmessage":
+            pattern, channel, message = reply[1:]
+            self.patternMessageReceived(pattern, channel, message)
+        else:
+            RedisSubscriber.handleCompleteMultiBulkData(self, reply)
+
+    def patternMessageReceived(self, pattern, channel, message):
+        """
+        Called when this connection is subscribed to a channel pattern that
+        has received a message published on a matching channel.
+        """
+        pass
@@ -0,0 +1,125 @@
+'''
+Retry policy for optimistic (WATCH/MULTI/EXEC) transactions.
+'''
+from twisted.internet import defer, task
+import random
+
+
+class TransactionAborted(Exception):
+    """
+    An optimistic transaction was aborted, EXEC returned nil.
+    """
+    pass
+
+
+class RetryLimitExceeded(Exception):
+    """
+    An optimistic transaction was aborted more times than allowed.
+    """
+    pass
+
+
+class RetryPolicy(object):
+    """
+    Retry policy for optimistic transactions.
+
+    An attempt is a function returning a defer that fails with
+    TransactionAborted when EXEC was aborted by a concurrent change of a
+    watched key. Aborted attempts are retried after an exponential backoff
+    with full jitter, up to max_attempts.
+
+    Counters of attempts, aborts and exhausted retries are kept by name
+    (usually the feed name) in order to measure contention.
+
+    Attributes:
+        max_attempts - Max number of attempts, None for unlimited.
+        base_delay   - Backoff delay of the first retry, in seconds.
+        max_delay    - Max backoff delay, in seconds.
+        stats        - A dict of name -> dict of counters.
+    """
+    def __init__(self, max_attempts=20, base_delay=0.001, max_delay=0.1,
+                 clock=None):
+        '''
+        Constructor
+
+        @param max_attempts: max number of attempts, None for unlimited.
+        @param base_delay: backoff delay of the first retry, in seconds.
+        @param max_delay: max backoff delay, in seconds.
+        @param clock: the IReactorTime used to schedule retries, defaults to
+                      the global reactor.
+        '''
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.stats = {}
+
+    def _get_clock(self):
+        if self.clock is None:
+            from twisted.internet import reactor
+            return reactor
+        return self.clock
+
+    def _count(self, name, counter):
+        counters = self.stats.get(name)
+        if counters is None:
+            counters = self.stats[name] = {'attempts': 0,
+                                           'aborts': 0,
+                                           'exhausted': 0}
+        counters[counter] += 1
+
+    def get_delay(self, retry):
+        '''
+        Return the delay before a retry.
+
+        @param retry: the number of this retry, starting at 1.
+        '''
+        delay = min(self.max_delay, self.base_delay * 2 ** (retry - 1))
+        return random.uniform(0, delay)
+
+    def get_stats(self, name=None):
+        '''
+        Return a copy of the counters.
+
+        @param name: if given, return only the counters of this name.
+        '''
+        if name is not None:
+            return dict(self.stats.get(name, {'attempts': 0,
+                                              'aborts': 0,
+                                              'exhausted': 0}))
+        return dict((k, dict(v)) for k, v in self.stats.items())
+
+    def run(self, name, attempt):
+        '''
+        Run attempt until it is not aborted.
+
+        @param name: the name used on counters.
+        @param attempt: a function returning a defer, this defer must fail
+                        with TransactionAborted in order to be retried.
+
+        @return: a defer with the result of the succeeded attempt, it fails
+                 with RetryLimitExceeded when max_attempts is reached.
+        '''
+        state = {'attempts': 0}
+
+        def _aborted(failure):
+            """
+            Called when an attempt was aborted.
+            """
+            failure.trap(TransactionAborted)
+            self._count(name, 'aborts')
+            if (self.max_attempts is not None and
+                state['attempts'] >= self.max_attempts):
+                self._count(name, 'exhausted')
+                return defer.fail(RetryLimitExceeded(name, state['attempts']))
+
+            delay = self.get_delay(state['attempts'])
+            return task.deferLater(self._get_clock(), delay, _attempt)
+
+        def _attempt():
+            state['attempts'] += 1
+            self._count(name, 'attempts')
+            d = defer.maybeDeferred(attempt)
+            return d.addErrback(_aborted)
+
+        return _attempt()
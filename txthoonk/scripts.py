@@ -0,0 +1,253 @@
+'''
+Server-side Lua scripts used by txThoonk when scripting is enabled.
+'''
+import hashlib
+
+from txredis.protocol import ResponseError
+
+
+class Script(object):
+    """
+    A Lua script executed by the redis server.
+
+    Scripts are called by their SHA1 digest (EVALSHA). If the server does not
+    know the script yet (NOSCRIPT), it is loaded (SCRIPT LOAD) and the call is
+    repeated, so the source is sent over the wire only once per server.
+
+    Attributes:
+        source - The Lua source of this script.
+        sha    - The SHA1 digest of the source, as known by redis.
+    """
+    def __init__(self, source):
+        '''
+        Constructor
+
+        @param source: the Lua source code.
+        '''
+        self.source = source
+        self.sha = hashlib.sha1(source).hexdigest()
+
+    def load(self, redis):
+        '''
+        Load this script into redis script cache.
+
+        @param redis: the txredis instance
+        '''
+        return redis.send('SCRIPT', 'LOAD', self.source)
+
+    def __call__(self, redis, keys=(), args=()):
+        '''
+        Run this script.
+
+        @param redis: the txredis instance
+        @param keys: the list of redis keys used by the script (KEYS).
+        @param args: the list of additional arguments (ARGV).
+        '''
+        params = [len(keys)] + list(keys) + list(args)
+
+        def _evalsha(*args):
+            return redis.send('EVALSHA', self.sha, *params)
+
+        def _noscript(failure):
+            """
+            Called when EVALSHA fails, loads the script if redis does not
+            have it.
+            """
+            failure.trap(ResponseError)
+            if not str(failure.value).startswith('NOSCRIPT'):
+                return failure
+            return self.load(redis).addCallback(_evalsha)
+
+        return _evalsha().addErrback(_noscript)
+
+
+# Removes the oldest ids of a feed until it has at most max ids, at most
+# chunk ids (if chunk > 0) are removed. Returns the number of ids still to be
+# removed.
+_TRIM = """
+local function trim(ids_key, items_key, retract_channel, max, chunk)
+    local overflow = redis.call('zcard', ids_key) - max
+    if overflow <= 0 then
+        return 0
+    end
+    local n = overflow
+    if chunk > 0 and n > chunk then
+        n = chunk
+    end
+    local ids = redis.call('zrange', ids_key, 0, n - 1)
+    redis.call('zremrangebyrank', ids_key, 0, n - 1)
+    for i = 1, #ids, 1000 do
+        redis.call('hdel', items_key, unpack(ids, i, math.min(i + 999, #ids)))
+    end
+    for _, id in ipairs(ids) do
+        redis.call('publish', retract_channel, id)
+    end
+    return overflow - n
+end
+"""
+
+# KEYS: feed.ids, feed.items
+# ARGV: max length, chunk, retract channel
+# Returns: the number of ids still to be removed.
+FEED_TRIM = Script(_TRIM + """
+return trim(KEYS[1], KEYS[2], ARGV[3], tonumber(ARGV[1]), tonumber(ARGV[2]))
+""")
+
+# KEYS: feeds, feed.config, feed.ids, feed.items, feed.publishes
+# ARGV: feed name, id, item, score, separator,
+#       publish channel, edit channel, retract channel, trim chunk
+# Returns: {-1, 0} if the feed does not exist, {1, remaining} if the item was
+#          published and {0, remaining} if it was edited. remaining is the
+#          number of ids still to be removed by FEED_TRIM.
+FEED_PUBLISH = Script(_TRIM + """
+if redis.call('sismember', KEYS[1], ARGV[1]) == 0 then
+    return {-1, 0}
+end
+local id, item = ARGV[2], ARGV[3]
+local exists = redis.call('hexists', KEYS[4], id)
+redis.call('incr', KEYS[5])
+redis.call('hset', KEYS[4], id, item)
+redis.call('zadd', KEYS[3], ARGV[4], id)
+local remaining = 0
+local max = redis.call('hget', KEYS[2], 'max_length')
+if max and string.match(max, '^%d+$') and tonumber(max) > 0 then
+    remaining = trim(KEYS[3], KEYS[4], ARGV[8], tonumber(max),
+                     tonumber(ARGV[9]))
+end
+if exists == 0 then
+    redis.call('publish', ARGV[6], id .. ARGV[5] .. item)
+    return {1, remaining}
+end
+redis.call('publish', ARGV[7], id .. ARGV[5] .. item)
+return {0, remaining}
+""")
+
+# KEYS: feeds, feed.config
+# ARGV: feed name, conffeed message, field1, value1, field2, value2, ...
+# Returns: -1 if the feed does not exist, else 1.
+SET_CONFIG = Script("""
+if redis.call('sismember', KEYS[1], ARGV[1]) == 0 then
+    return -1
+end
+redis.call('hmset', KEYS[2], unpack(ARGV, 3))
+redis.call('publish', 'conffeed', ARGV[2])
+return 1
+""")
+
+# KEYS: feeds, feed.idincr, feed.ids, feed.items, feed.publishes
+# ARGV: feed name, item, separator, publish channel, position channel,
+#       where ('begin', 'end', 'before' or 'after'), relative id, position
+# Returns: {-1, ''} if the feed does not exist, {0, ''} if the relative id
+#          does not exist, else {1, id}.
+SORTED_INSERT = Script("""
+if redis.call('sismember', KEYS[1], ARGV[1]) == 0 then
+    return {-1, ''}
+end
+local where, rel = ARGV[6], ARGV[7]
+if (where == 'before' or where == 'after') and
+   redis.call('hexists', KEYS[4], rel) == 0 then
+    return {0, ''}
+end
+local id = tostring(redis.call('incr', KEYS[2]))
+if where == 'begin' then
+    redis.call('lpush', KEYS[3], id)
+elseif where == 'end' then
+    redis.call('rpush', KEYS[3], id)
+else
+    redis.call('linsert', KEYS[3], where, rel, id)
+end
+redis.call('hset', KEYS[4], id, ARGV[2])
+redis.call('incr', KEYS[5])
+redis.call('publish', ARGV[4], id .. ARGV[3] .. ARGV[2])
+redis.call('publish', ARGV[5], id .. ARGV[3] .. ARGV[8])
+return {1, id}
+""")
+
+# KEYS: feed.items, feed.publishes
+# ARGV: id, item, separator, publish channel
+# Returns: 0 if the id does not exist, else 1.
+SORTED_EDIT = Script("""
+local id = ARGV[1]
+if redis.call('hexists', KEYS[1], id) == 0 then
+    return 0
+end
+redis.call('hset', KEYS[1], id, ARGV[2])
+redis.call('incr', KEYS[2])
+redis.call('publish', ARGV[4], id .. ARGV[3] .. ARGV[2])
+return 1
+""")
+
+# KEYS: feed.ids, feed.items
+# ARGV: id, where ('begin', 'end', 'before' or 'after'), relative id,
+#       separator, position channel, position
+# Returns: -1 if the id does not exist, 0 if the relative id does not exist,
+#          else 1.
+SORTED_MOVE = Script("""
+local id, where, rel = ARGV[1], ARGV[2], ARGV[3]
+if redis.call('hexists', KEYS[2], id) == 0 then
+    return -1
+end
+if (where == 'before' or where == 'after') and
+   redis.call('hexists', KEYS[2], rel) == 0 then
+    return 0
+end
+redis.call('lrem', KEYS[1], 1, id)
+if where == 'begin' then
+    redis.call('lpush', KEYS[1], id)
+elseif where == 'end' then
+    redis.call('rpush', KEYS[1], id)
+else
+    redis.call('linsert', KEYS[1], where, rel, id)
+end
+redis.call('publish', ARGV[5], id .. ARGV[4] .. ARGV[6])
+return 1
+""")
+
+# KEYS: feed.ids, feed.items
+# ARGV: max number of items
+# Returns: the list of id1, item1, id2, item2... removed from the tail of
+#          queue, in get order.
+QUEUE_POP = Script("""
+local ids = redis.call('lrange', KEYS[1], -tonumber(ARGV[1]), -1)
+if #ids == 0 then
+    return {}
+end
+redis.call('ltrim', KEYS[1], 0, -#ids - 1)
+local items = {}
+for i = #ids, 1, -1 do
+    local item = redis.call('hget', KEYS[2], ids[i])
+    if item then
+        items[#items + 1] = ids[i]
+        items[#items + 1] = item
+    end
+end
+for i = 1, #ids, 1000 do
+    redis.call('hdel', KEYS[2], unpack(ids, i, math.min(i + 999, #ids)))
+end
+return items
+""")
+
+# KEYS: feed.ids, feed.items, feed.claimed
+# ARGV: max number of jobs, claim time
+# Returns: the list of id1, item1, id2, item2... of jobs removed from the
+#          tail of feed.ids and claimed, in get order.
+JOB_CLAIM = Script("""
+local ids = redis.call('lrange', KEYS[1], -tonumber(ARGV[1]), -1)
+if #ids == 0 then
+    return {}
+end
+redis.call('ltrim', KEYS[1], 0, -#ids - 1)
+local items = {}
+for i = #ids, 1, -1 do
+    local item = redis.call('hget', KEYS[2], ids[i])
+    if item then
+        redis.call('zadd', KEYS[3], ARGV[2], ids[i])
+        items[#items + 1] = ids[i]
+        items[#items + 1] = item
+    end
+end
+return items
+""")
+
+SCRIPTS = [FEED_TRIM, FEED_PUBLISH, SET_CONFIG, SORTED_INSERT, SORTED_EDIT,
+           SORTED_MOVE, QUEUE_POP, JOB_CLAIM]
@@ -0,0 +1,299 @@
+'''
+Instrumentation of publishers, subscribers and feeds.
+
+An observer given to ThoonkPub, ThoonkSub or their factories (observer
+option) is notified of:
+
+    - each redis command: name, latency, bytes sent and if it failed;
+    - the bytes received by each connection;
+    - each feed operation (eg. Feed.publish): latency and if it failed;
+    - each aborted optimistic transaction (WATCH), by feed name;
+    - each message received by a subscriber, by channel.
+
+Stats is the default observer, keeping latency histograms and counters in
+memory; get_stats returns a snapshot to be exported, eg.:
+
+    stats = Stats()
+    pub = yield endpoint.connect(ThoonkPubFactory(observer=stats))
+    ...
+    stats.get_stats()['operations']['Feed.publish']['p99']
+'''
+from bisect import bisect_left
+import functools
+
+from twisted.internet import defer
+
+
+class Observer(object):
+    """
+    Observer interface, all notifications are ignored.
+
+    Subclasses override the notifications they need. Latencies are measured
+    by the seconds method, in seconds.
+    """
+    def __init__(self, clock=None):
+        '''
+        Constructor
+
+        @param clock: the IReactorTime used to measure latency, defaults to
+                      the global reactor.
+        '''
+        self.clock = clock
+
+    def seconds(self):
+        '''
+        Return the current time, in seconds.
+        '''
+        if self.clock is None:
+            from twisted.internet import reactor
+            return reactor.seconds()
+        return self.clock.seconds()
+
+    def command(self, name, latency, sent, failed):
+        '''
+        Called when the reply of a redis command is received.
+
+        @param name: the command name, eg. HGET.
+        @param latency: seconds from sending to reply.
+        @param sent: bytes sent.
+        @param failed: True if the reply is an error.
+        '''
+        pass
+
+    def received(self, size):
+        '''
+        Called when a connection receives data.
+
+        @param size: bytes received.
+        '''
+        pass
+
+    def operation(self, name, latency, failed):
+        '''
+        Called when a feed operation is done.
+
+        @param name: the operation name, eg. Feed.publish.
+        @param latency: seconds from call to result.
+        @param failed: True if the operation failed.
+        '''
+        pass
+
+    def aborted(self, feed_name):
+        '''
+        Called when an optimistic transaction is aborted.
+
+        @param feed_name: the name of the feed.
+        '''
+        pass
+
+    def message(self, channel):
+        '''
+        Called when a subscriber receives a message.
+
+        @param channel: the channel of message.
+        '''
+        pass
+
+    def get_stats(self):
+        '''
+        Return a snapshot of what was observed.
+        '''
+        return {}
+
+
+class Histogram(object):
+    """
+    Histogram of values (eg. latencies, in seconds), in buckets of
+    exponential bounds.
+
+    Percentiles are estimated by the upper bound of the bucket where they
+    fall (at most max), so their error is bounded by the bucket width.
+
+    Attributes:
+        bounds  - The sorted list of upper bounds of buckets.
+        buckets - The list of counts of each bucket, the last one counts
+                  the values above all bounds.
+    """
+    # 1us to ~67s, doubling
+    BOUNDS = [1e-6 * 2 ** i for i in range(27)]
+
+    def __init__(self, bounds=None):
+        '''
+        Constructor
+
+        @param bounds: the sorted list of upper bounds of buckets, defaults
+                       to BOUNDS (latencies in seconds).
+        '''
+        self.bounds = bounds or self.BOUNDS
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        '''
+        Count a value.
+        '''
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        '''
+        Return the estimated p percentile (0 < p <= 100), None if empty.
+        '''
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for pos, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                if pos == len(self.bounds):
+                    return self.max
+                return min(self.bounds[pos], self.max)
+        return self.max
+
+    def get_stats(self):
+        '''
+        Return count, total, min, max, mean and percentiles p50, p90, p99
+        and p999.
+        '''
+        return {'count': self.count,
+                'total': self.total,
+                'min': self.min,
+                'max': self.max,
+                'mean': self.total / self.count if self.count else None,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'p999': self.percentile(99.9)}
+
+
+class Stats(Observer):
+    """
+    Observer keeping latency histograms and counters in memory.
+
+    Attributes:
+        commands       - A dict command name -> Histogram.
+        operations     - A dict operation name -> Histogram.
+        errors         - A dict command or operation name -> number of
+                         failures.
+        aborts         - A dict feed name -> number of aborted transactions.
+        messages       - A dict channel -> number of messages received.
+        bytes_sent     - Bytes sent by commands.
+        bytes_received - Bytes received.
+        started        - When counting started, see reset.
+    """
+    def __init__(self, clock=None):
+        '''
+        Constructor
+
+        @param clock: the IReactorTime used to measure latency, defaults to
+                      the global reactor.
+        '''
+        Observer.__init__(self, clock)
+        self.reset()
+
+    def reset(self):
+        '''
+        Clear all histograms and counters.
+        '''
+        self.commands = {}
+        self.operations = {}
+        self.errors = {}
+        self.aborts = {}
+        self.messages = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.started = self.seconds()
+
+    def _add(self, histograms, name, latency, failed):
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.add(latency)
+        if failed:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def command(self, name, latency, sent, failed):
+        self.bytes_sent += sent
+        self._add(self.commands, name, latency, failed)
+
+    def received(self, size):
+        self.bytes_received += size
+
+    def operation(self, name, latency, failed):
+        self._add(self.operations, name, latency, failed)
+
+    def aborted(self, feed_name):
+        self.aborts[feed_name] = self.aborts.get(feed_name, 0) + 1
+
+    def message(self, channel):
+        self.messages[channel] = self.messages.get(channel, 0) + 1
+
+    def get_stats(self):
+        '''
+        Return a snapshot of histograms and counters.
+
+        Histograms are given by Histogram.get_stats, with the number of
+        errors; messages by channel have their count and rate (messages by
+        second since started).
+        '''
+        elapsed = self.seconds() - self.started
+
+        def _histograms(histograms):
+            ret = {}
+            for name, histogram in histograms.items():
+                ret[name] = histogram.get_stats()
+                ret[name]['errors'] = self.errors.get(name, 0)
+            return ret
+
+        return {'elapsed': elapsed,
+                'commands': _histograms(self.commands),
+                'operations': _histograms(self.operations),
+                'aborts': dict(self.aborts),
+                'messages': dict((channel, {'count': count,
+                                            'per_sec': count / elapsed
+                                                       if elapsed else None})
+                                 for channel, count in self.messages.items()),
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received}
+
+
+def measured(func):
+    '''
+    Decorator of feed methods, reporting their latency to the observer of
+    the publisher (self.pub.observer) as operation [class].[method].
+    '''
+    @functools.wraps(func)
+    def _measured(self, *args, **kwargs):
+        observer = self.pub.observer
+        if observer is None:
+            return func(self, *args, **kwargs)
+
+        name = '%s.%s' % (self.__class__.__name__, func.__name__)
+        start = observer.seconds()
+
+        def _done(ret, failed=False):
+            observer.operation(name, observer.seconds() - start, failed)
+            return ret
+
+        try:
+            ret = func(self, *args, **kwargs)
+        except:
+            _done(None, True)
+            raise
+
+        if isinstance(ret, defer.Deferred):
+            ret.addCallbacks(_done, lambda f: _done(f, True))
+        else:
+            _done(ret)
+        return ret
+
+    return _measured
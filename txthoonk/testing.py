@@ -0,0 +1,1231 @@
+'''
+In-process redis stand-in for tests and benchmarks.
+
+FakeRedisServer keeps its data in memory and speaks the redis protocol to
+clients connected by FakeRedisEndpoint over a loopback transport, so
+ThoonkPub and ThoonkSub run unchanged against it, eg.:
+
+    server = FakeRedisServer()
+    endpoint = FakeRedisEndpoint(server)
+    pub = yield endpoint.connect(ThoonkPubFactory(db=1))
+    sub = yield endpoint.connect(ThoonkSubFactory())
+
+Data written to a transport is delivered by clock.callLater(0), never
+synchronously. With a twisted.internet.task.Clock, clock.advance(0) delivers
+all pending data (and the data written in reply to it), which makes runs
+deterministic and free of sockets, eg. to profile the client overhead.
+
+Supported commands are the ones used by txThoonk: strings, hashes, lists
+(including BRPOP/BLPOP), sets, sorted sets, SCAN family, MULTI/EXEC/WATCH
+and PUBLISH/SUBSCRIBE. Lua scripting (EVAL, EVALSHA and SCRIPT) and key
+expiration are not supported.
+'''
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+import itertools
+from fnmatch import fnmatchcase
+
+from zope.interface import implements #@UnresolvedImport
+
+from twisted.internet import address, defer, error, interfaces
+from twisted.internet.protocol import Protocol
+from twisted.python import failure
+
+
+class CommandError(Exception):
+    """
+    A command failed, the message is sent to the client as an error reply.
+    """
+    pass
+
+
+WRONGTYPE = CommandError("WRONGTYPE Operation against a key holding the "
+                         "wrong kind of value")
+NOT_INTEGER = CommandError("ERR value is not an integer or out of range")
+NOT_FLOAT = CommandError("ERR value is not a valid float")
+SYNTAX = CommandError("ERR syntax error")
+
+
+class Status(str):
+    """
+    A status reply, eg. OK.
+    """
+    pass
+
+
+OK = Status('OK')
+QUEUED = Status('QUEUED')
+# returned by commands sending their replies themselves, eg. SUBSCRIBE, or
+# later, eg. a blocked BRPOP
+NO_REPLY = object()
+
+
+def encode_reply(reply):
+    '''
+    Encode a reply by the redis protocol.
+
+    @param reply: None, a Status, a str, an int, a CommandError or a list of
+                  replies.
+    '''
+    if reply is None:
+        return '$-1\r\n'
+    if isinstance(reply, Status):
+        return '+%s\r\n' % reply
+    if isinstance(reply, str):
+        return '$%d\r\n%s\r\n' % (len(reply), reply)
+    if isinstance(reply, (int, long)):
+        return ':%d\r\n' % reply
+    if isinstance(reply, CommandError):
+        return '-%s\r\n' % reply
+    return '*%d\r\n%s' % (len(reply), ''.join(encode_reply(r) for r in reply))
+
+
+def _int(value):
+    try:
+        return int(value)
+    except ValueError:
+        raise NOT_INTEGER
+
+
+def _float(value):
+    try:
+        return float(value)
+    except ValueError:
+        raise NOT_FLOAT
+
+
+def _format_score(score):
+    if abs(score) < 1e17 and score == int(score):
+        return '%d' % score
+    return repr(score)
+
+
+def _parse_range(value):
+    '''
+    Parse a score range limit, eg. '(1.5' or '-inf'.
+
+    @return: a tuple of (score, exclusive).
+    '''
+    if value.startswith('('):
+        return _float(value[1:]), True
+    return _float(value), False
+
+
+def _slice(length, start, end):
+    '''
+    Translate redis start and end indexes (inclusive, negative ones count
+    from the end) to a python slice.
+    '''
+    if start < 0:
+        start = max(length + start, 0)
+    if end < 0:
+        end = length + end
+    return slice(start, max(end + 1, start))
+
+
+class SortedSet(object):
+    """
+    Value of a sorted set key.
+
+    Attributes:
+        scores - A dict member -> score.
+        order  - A list of (score, member), sorted.
+    """
+    def __init__(self):
+        self.scores = {}
+        self.order = []
+
+    def __len__(self):
+        return len(self.scores)
+
+    def add(self, member, score):
+        '''
+        Add a member or update its score.
+
+        @return: True if the member is new.
+        '''
+        old = self.scores.get(member)
+        if old is not None:
+            if old == score:
+                return False
+            del self.order[bisect_left(self.order, (old, member))]
+        self.scores[member] = score
+        insort(self.order, (score, member))
+        return old is None
+
+    def remove(self, member):
+        '''
+        Remove a member.
+
+        @return: True if the member was found.
+        '''
+        score = self.scores.pop(member, None)
+        if score is None:
+            return False
+        del self.order[bisect_left(self.order, (score, member))]
+        return True
+
+    def rank(self, member):
+        '''
+        Return the position of a member, None if it is not found.
+        '''
+        score = self.scores.get(member)
+        if score is None:
+            return None
+        return bisect_left(self.order, (score, member))
+
+    def range_by_score(self, min_, max_):
+        '''
+        Return the slice of order with scores between min_ and max_, parsed
+        by _parse_range.
+        '''
+        (low, low_excl), (high, high_excl) = min_, max_
+        order = self.order
+        # (score,) sorts before all entries with that score
+        start = bisect_left(order, (low,))
+        if low_excl:
+            while start < len(order) and order[start][0] == low:
+                start += 1
+        end = bisect_left(order, (high,))
+        if not high_excl:
+            while end < len(order) and order[end][0] == high:
+                end += 1
+        return slice(start, max(start, end))
+
+
+class LoopbackTransport(object):
+    """
+    One direction of an in-process connection: data written here is
+    delivered to the peer protocol by clock.callLater(0).
+
+    Attributes:
+        protocol - The protocol using this transport.
+        peer     - The transport of the other side.
+    """
+    implements(interfaces.ITransport)
+
+    disconnecting = False
+    # max size of data delivered by each dataReceived call
+    chunk_size = 65536
+
+    def __init__(self, clock, protocol):
+        self.clock = clock
+        self.protocol = protocol
+        self.peer = None
+        self.connected = True
+        self._buffer = []
+        self._call = None
+
+    def write(self, data):
+        if not self.connected or self.disconnecting:
+            return
+        self._buffer.append(data)
+        if self._call is None:
+            self._call = self.clock.callLater(0, self._flush)
+
+    def writeSequence(self, data):
+        for chunk in data:
+            self.write(chunk)
+
+    def _flush(self):
+        self._call = None
+        data = ''.join(self._buffer)
+        self._buffer = []
+        # delivered in chunks, as read from a socket
+        for pos in range(0, len(data), self.chunk_size):
+            if not self.peer.connected:
+                break
+            self.peer.protocol.dataReceived(data[pos:pos + self.chunk_size])
+
+    def loseConnection(self):
+        '''
+        Close the connection after delivering the data written so far.
+        '''
+        if self.disconnecting or not self.connected:
+            return
+        self.disconnecting = True
+        self.clock.callLater(0, self._close)
+
+    abortConnection = loseConnection
+
+    def _close(self):
+        for transport in (self, self.peer):
+            if transport._call is not None:
+                transport._call.cancel()
+                transport._flush()
+        reason = failure.Failure(error.ConnectionDone())
+        for transport in (self, self.peer):
+            if transport.connected:
+                transport.connected = False
+                transport.protocol.connectionLost(reason)
+
+    def getPeer(self):
+        return address.IPv4Address('TCP', '127.0.0.1', 6379)
+
+    def getHost(self):
+        return address.IPv4Address('TCP', '127.0.0.1', 0)
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+
+class FakeRedisProtocol(Protocol):
+    """
+    Server side of a connection to a FakeRedisServer.
+
+    Commands are executed in order; a blocked client (BRPOP) does not
+    execute further commands until it is served or times out.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.db = 0
+        self.channels = set()
+        self.patterns = set()
+        # commands queued by MULTI, None when not in a transaction
+        self.multi = None
+        self.multi_failed = False
+        # True while EXEC runs the queued commands
+        self.executing = False
+        # watched (db, key) and whether any of them was written
+        self.watched = set()
+        self.dirty = False
+        # (keys, tail, timeout call) of a blocking pop
+        self.blocked = None
+        self._buffer = ''
+        self._commands = deque()
+
+    def dataReceived(self, data):
+        buf = self._buffer + data
+        pos = 0
+        while pos < len(buf):
+            if buf[pos] != '*':
+                # inline commands are not supported
+                self.transport.write(encode_reply(
+                    CommandError("ERR Protocol error: expected '*'")))
+                self.transport.loseConnection()
+                pos = len(buf)
+                break
+            parsed = self._parse(buf, pos)
+            if parsed is None:
+                break
+            args, pos = parsed
+            self._commands.append(args)
+        self._buffer = buf[pos:]
+        self.process()
+
+    def _parse(self, buf, pos):
+        '''
+        Parse a request (multi-bulk) starting at pos of buf.
+
+        @return: a tuple of (list of arguments, position after the request),
+                 None if the request is incomplete.
+        '''
+        end = buf.find('\r\n', pos)
+        if end < 0:
+            return None
+        count = int(buf[pos + 1:end])
+        pos = end + 2
+        args = []
+        for _ in range(count):
+            end = buf.find('\r\n', pos)
+            if end < 0:
+                return None
+            length = int(buf[pos + 1:end])
+            start = end + 2
+            if len(buf) < start + length + 2:
+                return None
+            args.append(buf[start:start + length])
+            pos = start + length + 2
+        return args, pos
+
+    def process(self):
+        '''
+        Execute the received commands, unless blocked.
+        '''
+        while self._commands and self.blocked is None and \
+                self.transport.connected:
+            args = self._commands.popleft()
+            reply = self.server.execute(self, args)
+            if reply is not NO_REPLY:
+                self.reply(reply)
+
+    def reply(self, reply):
+        self.transport.write(encode_reply(reply))
+
+    def connectionLost(self, reason):
+        self.server.disconnected(self)
+
+
+class FakeRedisServer(object):
+    """
+    In-memory redis server.
+
+    Attributes:
+        dbs      - A dict db number -> dict key -> value, values are str,
+                   dict (hash), list, set or SortedSet instances.
+        clock    - The IReactorTime used to deliver data and time out
+                   blocking commands.
+        commands - A dict command name -> number of calls.
+    """
+    # command name -> arity, as in redis: a negative one is a minimum
+    arity = {
+        'PING': -1, 'ECHO': 2, 'SELECT': 2, 'FLUSHDB': -1, 'FLUSHALL': -1,
+        'DBSIZE': 1, 'KEYS': 2, 'EXISTS': -2, 'DEL': -2, 'UNLINK': -2,
+        'TYPE': 2, 'RENAME': 3, 'GET': 2, 'SET': 3, 'INCR': 2, 'INCRBY': 3,
+        'DECR': 2, 'DECRBY': 3,
+        'HGET': 3, 'HSET': -4, 'HSETNX': 4, 'HMSET': -4, 'HMGET': -3,
+        'HGETALL': 2, 'HKEYS': 2, 'HVALS': 2, 'HDEL': -3, 'HEXISTS': 3,
+        'HLEN': 2, 'HINCRBY': 4, 'HSCAN': -3,
+        'LPUSH': -3, 'RPUSH': -3, 'LLEN': 2, 'LRANGE': 4, 'LTRIM': 4,
+        'LINDEX': 3, 'LSET': 4, 'LREM': 4, 'LINSERT': 5, 'LPOP': 2, 'RPOP': 2,
+        'BLPOP': -3, 'BRPOP': -3, 'RPOPLPUSH': 3, 'BRPOPLPUSH': 4,
+        'SADD': -3, 'SREM': -3, 'SMEMBERS': 2, 'SISMEMBER': 3, 'SCARD': 2,
+        'SSCAN': -3,
+        'ZADD': -4, 'ZREM': -3, 'ZSCORE': 3, 'ZINCRBY': 4, 'ZRANK': 3,
+        'ZREVRANK': 3, 'ZCARD': 2, 'ZCOUNT': 4, 'ZRANGE': -4, 'ZREVRANGE': -4,
+        'ZRANGEBYSCORE': -4, 'ZREMRANGEBYRANK': 4, 'ZREMRANGEBYSCORE': 4,
+        'ZSCAN': -3,
+        'MULTI': 1, 'EXEC': 1, 'DISCARD': 1, 'WATCH': -2, 'UNWATCH': 1,
+        'PUBLISH': 3, 'SUBSCRIBE': -2, 'UNSUBSCRIBE': -1, 'PSUBSCRIBE': -2,
+        'PUNSUBSCRIBE': -1,
+    }
+    # commands executed right away inside MULTI
+    transaction_commands = ('MULTI', 'EXEC', 'DISCARD', 'WATCH')
+    # commands allowed while subscribed
+    subscriber_commands = ('SUBSCRIBE', 'UNSUBSCRIBE', 'PSUBSCRIBE',
+                           'PUNSUBSCRIBE', 'PING')
+
+    def __init__(self, clock=None):
+        '''
+        Constructor
+
+        @param clock: the IReactorTime used to deliver data, defaults to the
+                      global reactor.
+        '''
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.clock = clock
+        self.dbs = {}
+        self.commands = {}
+        # (db, key) -> set of clients watching it
+        self._watchers = {}
+        # channel or pattern -> set of clients subscribed
+        self._channels = {}
+        self._patterns = {}
+        # clients blocked by BLPOP/BRPOP, in order
+        self._blocked = []
+        # SCAN family cursor -> sort key of the last element returned, so
+        # elements removed while scanning do not make others to be skipped
+        self._cursors = {}
+        self._cursor_ids = itertools.count(1)
+
+    def buildProtocol(self, addr):
+        return FakeRedisProtocol(self)
+
+    def get_stats(self):
+        '''
+        Return a copy of the number of calls by command name.
+        '''
+        return dict(self.commands)
+
+    ############################################################################
+    #  Command execution
+    ############################################################################
+    def execute(self, client, args):
+        '''
+        Execute a command of client.
+
+        @return: the reply, or NO_REPLY.
+        '''
+        name = args[0].upper()
+        self.commands[name] = self.commands.get(name, 0) + 1
+
+        arity = self.arity.get(name)
+        if arity is None:
+            error = CommandError("ERR unknown command '%s'" % args[0])
+        elif (arity > 0 and len(args) != arity) or len(args) < -arity:
+            error = CommandError("ERR wrong number of arguments for '%s' "
+                                 "command" % args[0].lower())
+        elif (client.channels or client.patterns) and \
+                name not in self.subscriber_commands:
+            error = CommandError("ERR only (P)SUBSCRIBE / (P)UNSUBSCRIBE / "
+                                 "PING / QUIT allowed in this context")
+        else:
+            error = None
+
+        if client.multi is not None and name not in \
+                self.transaction_commands:
+            if error is not None:
+                client.multi_failed = True
+                return error
+            client.multi.append((name, args[1:]))
+            return QUEUED
+        if error is not None:
+            return error
+
+        reply = self._call(client, name, args[1:])
+        self._serve_blocked()
+        return reply
+
+    def _call(self, client, name, args):
+        try:
+            return getattr(self, '_cmd_' + name.lower())(client, *args)
+        except CommandError as e:
+            return e
+
+    def _touch(self, client, key):
+        '''
+        Mark the clients watching key as dirty.
+        '''
+        for watcher in self._watchers.pop((client.db, key), ()):
+            watcher.dirty = True
+
+    def _unwatch(self, client):
+        for watched in client.watched:
+            watchers = self._watchers.get(watched)
+            if watchers is not None:
+                watchers.discard(client)
+                if not watchers:
+                    del self._watchers[watched]
+        client.watched = set()
+        client.dirty = False
+
+    def disconnected(self, client):
+        '''
+        Clean up the state of a lost client.
+        '''
+        self._unwatch(client)
+        self._unsubscribe(client, self._channels, client.channels,
+                          client.channels, 'unsubscribe', False)
+        self._unsubscribe(client, self._patterns, client.patterns,
+                          client.patterns, 'punsubscribe', False)
+        if client in self._blocked:
+            self._unblock(client, None)
+
+    ############################################################################
+    #  Key access
+    ############################################################################
+    def _data(self, client):
+        return self.dbs.setdefault(client.db, {})
+
+    def _get(self, client, key, kind):
+        '''
+        Return the value of key, None if it does not exist.
+
+        @param kind: the expected type of value.
+        '''
+        value = self._data(client).get(key)
+        if value is not None and type(value) is not kind:
+            raise WRONGTYPE
+        return value
+
+    def _create(self, client, key, kind):
+        '''
+        Return the value of key, creating an empty one if needed.
+        '''
+        value = self._get(client, key, kind)
+        if value is None:
+            value = self._data(client)[key] = kind()
+        return value
+
+    def _written(self, client, key):
+        '''
+        Called after key is written: watchers are notified, empty values are
+        removed.
+        '''
+        data = self._data(client)
+        value = data.get(key)
+        if value is not None and not isinstance(value, str) and not value:
+            del data[key]
+        self._touch(client, key)
+
+    ############################################################################
+    #  Connection and keys
+    ############################################################################
+    def _cmd_ping(self, client, message=None):
+        if client.channels or client.patterns:
+            return ['pong', message or '']
+        return Status('PONG') if message is None else message
+
+    def _cmd_echo(self, client, message):
+        return message
+
+    def _cmd_select(self, client, db):
+        client.db = _int(db)
+        return OK
+
+    def _flush(self, db):
+        data = self.dbs.pop(db, {})
+        for (watched_db, key) in list(self._watchers):
+            if watched_db == db and key in data:
+                for watcher in self._watchers.pop((db, key)):
+                    watcher.dirty = True
+
+    def _cmd_flushdb(self, client, *args):
+        self._flush(client.db)
+        return OK
+
+    def _cmd_flushall(self, client, *args):
+        for db in list(self.dbs):
+            self._flush(db)
+        return OK
+
+    def _cmd_dbsize(self, client):
+        return len(self._data(client))
+
+    def _cmd_keys(self, client, pattern):
+        return [k for k in sorted(self._data(client))
+                if fnmatchcase(k, pattern)]
+
+    def _cmd_exists(self, client, *keys):
+        data = self._data(client)
+        return len([k for k in keys if k in data])
+
+    def _cmd_del(self, client, *keys):
+        data = self._data(client)
+        count = 0
+        for key in keys:
+            if data.pop(key, None) is not None:
+                count += 1
+                self._touch(client, key)
+        return count
+
+    _cmd_unlink = _cmd_del
+
+    def _cmd_rename(self, client, key, newkey):
+        data = self._data(client)
+        if key not in data:
+            raise CommandError("ERR no such key")
+        data[newkey] = data.pop(key)
+        self._touch(client, key)
+        self._touch(client, newkey)
+        return OK
+
+    def _cmd_type(self, client, key):
+        value = self._data(client).get(key)
+        names = {str: 'string', dict: 'hash', list: 'list', set: 'set',
+                 SortedSet: 'zset'}
+        return Status(names.get(type(value), 'none'))
+
+    ############################################################################
+    #  Strings
+    ############################################################################
+    def _cmd_get(self, client, key):
+        return self._get(client, key, str)
+
+    def _cmd_set(self, client, key, value):
+        self._data(client)[key] = value
+        self._touch(client, key)
+        return OK
+
+    def _cmd_incrby(self, client, key, amount):
+        amount = _int(amount)
+        value = _int(self._get(client, key, str) or 0) + amount
+        self._data(client)[key] = str(value)
+        self._touch(client, key)
+        return value
+
+    def _cmd_incr(self, client, key):
+        return self._cmd_incrby(client, key, 1)
+
+    def _cmd_decrby(self, client, key, amount):
+        return self._cmd_incrby(client, key, -_int(amount))
+
+    def _cmd_decr(self, client, key):
+        return self._cmd_incrby(client, key, -1)
+
+    ############################################################################
+    #  Hashes
+    ############################################################################
+    def _cmd_hget(self, client, key, field):
+        return (self._get(client, key, dict) or {}).get(field)
+
+    def _cmd_hset(self, client, key, *args):
+        if len(args) % 2:
+            raise CommandError("ERR wrong number of arguments for 'hset' "
+                               "command")
+        hash_ = self._create(client, key, dict)
+        count = 0
+        for field, value in zip(args[::2], args[1::2]):
+            count += field not in hash_
+            hash_[field] = value
+        self._written(client, key)
+        return count
+
+    def _cmd_hsetnx(self, client, key, field, value):
+        hash_ = self._create(client, key, dict)
+        if field in hash_:
+            return 0
+        hash_[field] = value
+        self._written(client, key)
+        return 1
+
+    def _cmd_hmset(self, client, key, *args):
+        if len(args) % 2:
+            raise CommandError("ERR wrong number of arguments for 'hmset' "
+                               "command")
+        self._cmd_hset(client, key, *args)
+        return OK
+
+    def _cmd_hmget(self, client, key, *fields):
+        hash_ = self._get(client, key, dict) or {}
+        return [hash_.get(f) for f in fields]
+
+    def _cmd_hgetall(self, client, key):
+        hash_ = self._get(client, key, dict) or {}
+        return [x for item in hash_.items() for x in item]
+
+    def _cmd_hkeys(self, client, key):
+        return list(self._get(client, key, dict) or ())
+
+    def _cmd_hvals(self, client, key):
+        return list((self._get(client, key, dict) or {}).values())
+
+    def _cmd_hdel(self, client, key, *fields):
+        hash_ = self._get(client, key, dict)
+        if hash_ is None:
+            return 0
+        count = 0
+        for field in fields:
+            if hash_.pop(field, None) is not None:
+                count += 1
+        if count:
+            self._written(client, key)
+        return count
+
+    def _cmd_hexists(self, client, key, field):
+        return int(field in (self._get(client, key, dict) or ()))
+
+    def _cmd_hlen(self, client, key):
+        return len(self._get(client, key, dict) or ())
+
+    def _cmd_hincrby(self, client, key, field, amount):
+        amount = _int(amount)
+        hash_ = self._create(client, key, dict)
+        value = hash_[field] = str(_int(hash_.get(field, 0)) + amount)
+        self._written(client, key)
+        return int(value)
+
+    def _scan(self, elements, order, cursor, args):
+        '''
+        Return a page of elements as a SCAN family reply.
+
+        As in redis, elements present during the whole iteration are
+        returned, even if others are removed meanwhile.
+
+        @param elements: the list of elements, sorted by order.
+        @param order: the sorted list of sort keys of elements.
+        @param cursor: the cursor, 0 or one returned by a previous page.
+        @param args: the options, MATCH and COUNT.
+        '''
+        cursor = _int(cursor)
+        pattern, count = None, 10
+        for pos in range(0, len(args), 2):
+            option = args[pos].upper()
+            if pos + 1 >= len(args):
+                raise SYNTAX
+            if option == 'MATCH':
+                pattern = args[pos + 1]
+            elif option == 'COUNT':
+                count = _int(args[pos + 1])
+            else:
+                raise SYNTAX
+        start = 0
+        if cursor in self._cursors:
+            start = bisect_right(order, self._cursors[cursor])
+        page = elements[start:start + count]
+        if start + count >= len(elements):
+            cursor = 0
+        else:
+            cursor = next(self._cursor_ids)
+            self._cursors[cursor] = order[start + count - 1]
+        if pattern is not None:
+            page = [e for e in page if fnmatchcase(e[0], pattern)]
+        return [str(cursor), page]
+
+    def _cmd_hscan(self, client, key, cursor, *args):
+        hash_ = self._get(client, key, dict) or {}
+        items = sorted(hash_.items())
+        cursor, page = self._scan(items, [f for f, _ in items], cursor, args)
+        return [cursor, [x for item in page for x in item]]
+
+    ############################################################################
+    #  Lists
+    ############################################################################
+    def _push(self, client, key, values, tail):
+        list_ = self._create(client, key, list)
+        if tail:
+            list_.extend(values)
+        else:
+            list_[:0] = reversed(values)
+        self._written(client, key)
+        return len(list_)
+
+    def _cmd_lpush(self, client, key, *values):
+        return self._push(client, key, values, False)
+
+    def _cmd_rpush(self, client, key, *values):
+        return self._push(client, key, values, True)
+
+    def _cmd_llen(self, client, key):
+        return len(self._get(client, key, list) or ())
+
+    def _cmd_lrange(self, client, key, start, end):
+        list_ = self._get(client, key, list) or []
+        return list_[_slice(len(list_), _int(start), _int(end))]
+
+    def _cmd_ltrim(self, client, key, start, end):
+        list_ = self._get(client, key, list)
+        if list_ is not None:
+            list_[:] = list_[_slice(len(list_), _int(start), _int(end))]
+            self._written(client, key)
+        return OK
+
+    def _cmd_lindex(self, client, key, index):
+        list_ = self._get(client, key, list) or []
+        index = _int(index)
+        if -len(list_) <= index < len(list_):
+            return list_[index]
+        return None
+
+    def _cmd_lset(self, client, key, index, value):
+        list_ = self._get(client, key, list)
+        if list_ is None:
+            raise CommandError("ERR no such key")
+        index = _int(index)
+        if not -len(list_) <= index < len(list_):
+            raise CommandError("ERR index out of range")
+        list_[index] = value
+        self._written(client, key)
+        return OK
+
+    def _cmd_lrem(self, client, key, count, value):
+        list_ = self._get(client, key, list)
+        count = _int(count)
+        if list_ is None:
+            return 0
+        positions = [i for i, v in enumerate(list_) if v == value]
+        if count < 0:
+            positions = positions[count:]
+        elif count > 0:
+            positions = positions[:count]
+        for pos in reversed(positions):
+            del list_[pos]
+        if positions:
+            self._written(client, key)
+        return len(positions)
+
+    def _cmd_linsert(self, client, key, where, pivot, value):
+        where = where.upper()
+        if where not in ('BEFORE', 'AFTER'):
+            raise SYNTAX
+        list_ = self._get(client, key, list)
+        if list_ is None:
+            return 0
+        if pivot not in list_:
+            return -1
+        pos = list_.index(pivot) + (where == 'AFTER')
+        list_.insert(pos, value)
+        self._written(client, key)
+        return len(list_)
+
+    def _pop(self, client, key, tail):
+        list_ = self._get(client, key, list)
+        if not list_:
+            return None
+        value = list_.pop(-1 if tail else 0)
+        self._written(client, key)
+        return value
+
+    def _cmd_lpop(self, client, key):
+        return self._pop(client, key, False)
+
+    def _cmd_rpop(self, client, key):
+        return self._pop(client, key, True)
+
+    def _popped(self, client, key, value, destination):
+        '''
+        Return the reply of a blocking pop, pushing value to the head of
+        destination (BRPOPLPUSH) if given.
+        '''
+        if destination is None:
+            return [key, value]
+        self._push(client, destination, [value], False)
+        return value
+
+    def _bpop(self, client, args, tail, destination=None):
+        keys = args[:-1]
+        try:
+            timeout = float(args[-1])
+        except ValueError:
+            raise CommandError("ERR timeout is not a float or out of range")
+        if timeout < 0:
+            raise CommandError("ERR timeout is negative")
+        for key in keys:
+            value = self._pop(client, key, tail)
+            if value is not None:
+                return self._popped(client, key, value, destination)
+        if client.multi is not None or client.executing:
+            # inside a transaction, it does not block
+            return None
+
+        call = None
+        if timeout:
+            call = self.clock.callLater(timeout, self._unblock, client, None)
+        client.blocked = (keys, tail, call, destination)
+        self._blocked.append(client)
+        return NO_REPLY
+
+    def _cmd_blpop(self, client, *args):
+        return self._bpop(client, args, False)
+
+    def _cmd_brpop(self, client, *args):
+        return self._bpop(client, args, True)
+
+    def _cmd_rpoplpush(self, client, source, destination):
+        value = self._pop(client, source, True)
+        if value is None:
+            return None
+        return self._popped(client, source, value, destination)
+
+    def _cmd_brpoplpush(self, client, source, destination, timeout):
+        return self._bpop(client, [source, timeout], True, destination)
+
+    def _unblock(self, client, reply):
+        '''
+        Send the reply of a blocked client and resume its commands.
+        '''
+        keys, tail, call, destination = client.blocked
+        if call is not None and call.active():
+            call.cancel()
+        client.blocked = None
+        self._blocked.remove(client)
+        if client.transport.connected:
+            client.reply(reply)
+            client.process()
+
+    def _serve_blocked(self):
+        '''
+        Serve blocked clients waiting for lists with values.
+        '''
+        for client in list(self._blocked):
+            if client.blocked is None:
+                # served while serving another one
+                continue
+            keys, tail, call, destination = client.blocked
+            data = self.dbs.get(client.db, {})
+            for key in keys:
+                if type(data.get(key)) is list:
+                    value = self._pop(client, key, tail)
+                    self._unblock(client, self._popped(client, key, value,
+                                                       destination))
+                    break
+
+    ############################################################################
+    #  Sets
+    ############################################################################
+    def _cmd_sadd(self, client, key, *members):
+        set_ = self._create(client, key, set)
+        count = len(set_)
+        set_.update(members)
+        count = len(set_) - count
+        self._written(client, key)
+        return count
+
+    def _cmd_srem(self, client, key, *members):
+        set_ = self._get(client, key, set)
+        if set_ is None:
+            return 0
+        count = len(set_)
+        set_.difference_update(members)
+        count -= len(set_)
+        if count:
+            self._written(client, key)
+        return count
+
+    def _cmd_smembers(self, client, key):
+        return list(self._get(client, key, set) or ())
+
+    def _cmd_sismember(self, client, key, member):
+        return int(member in (self._get(client, key, set) or ()))
+
+    def _cmd_scard(self, client, key):
+        return len(self._get(client, key, set) or ())
+
+    def _cmd_sscan(self, client, key, cursor, *args):
+        order = sorted(self._get(client, key, set) or ())
+        members = [(m,) for m in order]
+        cursor, page = self._scan(members, order, cursor, args)
+        return [cursor, [m for (m,) in page]]
+
+    ############################################################################
+    #  Sorted sets
+    ############################################################################
+    def _cmd_zadd(self, client, key, *args):
+        if len(args) % 2:
+            raise SYNTAX
+        pairs = [(_float(s), m) for s, m in zip(args[::2], args[1::2])]
+        zset = self._create(client, key, SortedSet)
+        count = 0
+        for score, member in pairs:
+            count += zset.add(member, score)
+        self._written(client, key)
+        return count
+
+    def _cmd_zrem(self, client, key, *members):
+        zset = self._get(client, key, SortedSet)
+        if zset is None:
+            return 0
+        count = 0
+        for member in members:
+            count += zset.remove(member)
+        if count:
+            self._written(client, key)
+        return count
+
+    def _cmd_zscore(self, client, key, member):
+        score = (self._get(client, key, SortedSet) or SortedSet()).scores.get(
+                                                                    member)
+        return None if score is None else _format_score(score)
+
+    def _cmd_zincrby(self, client, key, amount, member):
+        zset = self._create(client, key, SortedSet)
+        score = zset.scores.get(member, 0.0) + _float(amount)
+        zset.add(member, score)
+        self._written(client, key)
+        return _format_score(score)
+
+    def _cmd_zrank(self, client, key, member):
+        return (self._get(client, key, SortedSet) or SortedSet()).rank(member)
+
+    def _cmd_zrevrank(self, client, key, member):
+        zset = self._get(client, key, SortedSet) or SortedSet()
+        rank = zset.rank(member)
+        return None if rank is None else len(zset) - rank - 1
+
+    def _cmd_zcard(self, client, key):
+        return len(self._get(client, key, SortedSet) or ())
+
+    def _cmd_zcount(self, client, key, min_, max_):
+        zset = self._get(client, key, SortedSet) or SortedSet()
+        range_ = zset.range_by_score(_parse_range(min_), _parse_range(max_))
+        return range_.stop - range_.start
+
+    def _range_reply(self, entries, withscores):
+        if not withscores:
+            return [m for s, m in entries]
+        return [x for s, m in entries for x in (m, _format_score(s))]
+
+    def _zrange(self, client, key, start, end, args, reverse):
+        withscores = False
+        for arg in args:
+            if arg.upper() != 'WITHSCORES':
+                raise SYNTAX
+            withscores = True
+        order = (self._get(client, key, SortedSet) or SortedSet()).order
+        if reverse:
+            order = order[::-1]
+        entries = order[_slice(len(order), _int(start), _int(end))]
+        return self._range_reply(entries, withscores)
+
+    def _cmd_zrange(self, client, key, start, end, *args):
+        return self._zrange(client, key, start, end, args, False)
+
+    def _cmd_zrevrange(self, client, key, start, end, *args):
+        return self._zrange(client, key, start, end, args, True)
+
+    def _cmd_zrangebyscore(self, client, key, min_, max_, *args):
+        range_ = (_parse_range(min_), _parse_range(max_))
+        withscores, offset, count = False, 0, None
+        args = list(args)
+        while args:
+            option = args.pop(0).upper()
+            if option == 'WITHSCORES':
+                withscores = True
+            elif option == 'LIMIT' and len(args) >= 2:
+                offset, count = _int(args.pop(0)), _int(args.pop(0))
+            else:
+                raise SYNTAX
+        zset = self._get(client, key, SortedSet) or SortedSet()
+        entries = zset.order[zset.range_by_score(*range_)]
+        if offset < 0:
+            entries = []
+        elif count is not None and count >= 0:
+            entries = entries[offset:offset + count]
+        else:
+            entries = entries[offset:]
+        return self._range_reply(entries, withscores)
+
+    def _remove_range(self, client, key, zset, range_):
+        entries = zset.order[range_]
+        for score, member in entries:
+            zset.remove(member)
+        if entries:
+            self._written(client, key)
+        return len(entries)
+
+    def _cmd_zremrangebyrank(self, client, key, start, end):
+        zset = self._get(client, key, SortedSet) or SortedSet()
+        range_ = _slice(len(zset), _int(start), _int(end))
+        return self._remove_range(client, key, zset, range_)
+
+    def _cmd_zremrangebyscore(self, client, key, min_, max_):
+        zset = self._get(client, key, SortedSet) or SortedSet()
+        range_ = zset.range_by_score(_parse_range(min_), _parse_range(max_))
+        return self._remove_range(client, key, zset, range_)
+
+    def _cmd_zscan(self, client, key, cursor, *args):
+        zset = self._get(client, key, SortedSet) or SortedSet()
+        entries = [(m, _format_score(s)) for s, m in zset.order]
+        cursor, page = self._scan(entries, zset.order, cursor, args)
+        return [cursor, [x for entry in page for x in entry]]
+
+    ############################################################################
+    #  Transactions
+    ############################################################################
+    def _cmd_multi(self, client):
+        if client.multi is not None:
+            raise CommandError("ERR MULTI calls can not be nested")
+        client.multi = []
+        client.multi_failed = False
+        return OK
+
+    def _cmd_exec(self, client):
+        if client.multi is None:
+            raise CommandError("ERR EXEC without MULTI")
+        commands, client.multi = client.multi, None
+        dirty = client.dirty
+        self._unwatch(client)
+        if client.multi_failed:
+            raise CommandError("EXECABORT Transaction discarded because of "
+                               "previous errors.")
+        if dirty:
+            return None
+
+        client.executing = True
+        try:
+            return [self._call(client, name, args) for name, args in commands]
+        finally:
+            client.executing = False
+
+    def _cmd_discard(self, client):
+        if client.multi is None:
+            raise CommandError("ERR DISCARD without MULTI")
+        client.multi = None
+        self._unwatch(client)
+        return OK
+
+    def _cmd_watch(self, client, *keys):
+        if client.multi is not None:
+            raise CommandError("ERR WATCH inside MULTI is not allowed")
+        for key in keys:
+            watched = (client.db, key)
+            client.watched.add(watched)
+            self._watchers.setdefault(watched, set()).add(client)
+        return OK
+
+    def _cmd_unwatch(self, client):
+        self._unwatch(client)
+        return OK
+
+    ############################################################################
+    #  Publish/subscribe
+    ############################################################################
+    def _cmd_publish(self, client, channel, message):
+        count = 0
+        for subscriber in self._channels.get(channel, ()):
+            subscriber.reply(['message', channel, message])
+            count += 1
+        for pattern, subscribers in list(self._patterns.items()):
+            if fnmatchcase(channel, pattern):
+                for subscriber in subscribers:
+                    subscriber.reply(['pmessage', pattern, channel, message])
+                    count += 1
+        return count
+
+    def _subscribe(self, client, registry, names, subscribed, kind):
+        for name in names:
+            subscribed.add(name)
+            registry.setdefault(name, set()).add(client)
+            client.reply([kind, name,
+                          len(client.channels) + len(client.patterns)])
+
+    def _unsubscribe(self, client, registry, names, subscribed, kind,
+                     reply=True):
+        names = list(names or subscribed)
+        if not names and reply:
+            client.reply([kind, None,
+                          len(client.channels) + len(client.patterns)])
+        for name in names:
+            subscribed.discard(name)
+            subscribers = registry.get(name)
+            if subscribers is not None:
+                subscribers.discard(client)
+                if not subscribers:
+                    del registry[name]
+            if reply:
+                client.reply([kind, name,
+                              len(client.channels) + len(client.patterns)])
+
+    def _cmd_subscribe(self, client, *channels):
+        self._subscribe(client, self._channels, channels, client.channels,
+                        'subscribe')
+        return NO_REPLY
+
+    def _cmd_psubscribe(self, client, *patterns):
+        self._subscribe(client, self._patterns, patterns, client.patterns,
+                        'psubscribe')
+        return NO_REPLY
+
+    def _cmd_unsubscribe(self, client, *channels):
+        self._unsubscribe(client, self._channels, channels, client.channels,
+                          'unsubscribe')
+        return NO_REPLY
+
+    def _cmd_punsubscribe(self, client, *patterns):
+        self._unsubscribe(client, self._patterns, patterns, client.patterns,
+                          'punsubscribe')
+        return NO_REPLY
+
+
+class FakeRedisEndpoint(object):
+    """
+    IStreamClientEndpoint connecting clients to a FakeRedisServer.
+    """
+    implements(interfaces.IStreamClientEndpoint)
+
+    def __init__(self, server):
+        '''
+        Constructor
+
+        @param server: the FakeRedisServer.
+        '''
+        self.server = server
+
+    def connect(self, factory):
+        '''
+        Connect a protocol built by factory to the server.
+
+        @return: a defer witch callback function will have the protocol as
+                 the first argument.
+        '''
+        server = self.server
+        protocol = factory.buildProtocol(address.IPv4Address('TCP',
+                                                             '127.0.0.1',
+                                                             6379))
+        if protocol is None:
+            return defer.fail(error.ConnectionRefusedError())
+        server_protocol = server.buildProtocol(None)
+
+        client_transport = LoopbackTransport(server.clock, protocol)
+        server_transport = LoopbackTransport(server.clock, server_protocol)
+        client_transport.peer = server_transport
+        server_transport.peer = client_transport
+
+        server_protocol.makeConnection(server_transport)
+        protocol.makeConnection(client_transport)
+        return defer.succeed(protocol)
@@ -3,10 +3,27 @@ Created on Jul 6, 2012
 
 @author: iuri
 '''
-from twisted.internet import defer
+from twisted.internet import defer, task
+from twisted.python import log
+from txthoonk.retry import TransactionAborted
+from txthoonk.protocol import check_exec
+from txthoonk import scripts
+from txthoonk.codec import get_codec, RawCodec
+from txthoonk.stats import measured
 import uuid
 import time
 
+def get_max_length(config):
+    '''
+    Return the max_length of a feed configuration or None if unbounded.
+
+    @param config: the configuration dictionary.
+    '''
+    max_ = config.get("max_length")
+    if max_ is not None and str(max_).isdigit() and int(max_) > 0:
+        return int(max_)
+    return None
+
 class Feed(object):
     """
     A Thoonk feed is a collection of items ordered by publication date.
@@ -15,6 +32,10 @@ class Feed(object):
     feed is created by adding the field 'max_length' to the configuration
     with a value greater than 0.
 
+    Items are encoded by the codec named by the field 'codec' of the
+    configuration (see txthoonk.codec), eg. 'json' or 'json+zlib'; the codec
+    must be set when the feed is created.
+
     Attributes:
         pub             - The main ThoonkPub object.
         name            - The name of this feed.
@@ -25,6 +46,11 @@ class Feed(object):
         channel_retract - Redis pubsub channel for publication notices.
         channel_edit    - Redis pubsub channel for retraction notices.
         channel_publish - Redis pubsub channel for edit notices.
+        trimming        - A defer of the running background trim, or None.
+        codec           - The item codec (see txthoonk.codec), None until
+                          the configuration is read.
+        item_cache      - A txthoonk.cache.ItemCache used by get_item, or
+                          None.
 
     Redis Keys Used:
         feed.ids:[feed]       -- A sorted set of item IDs.
@@ -41,13 +67,26 @@ class Feed(object):
         get_all -- Return all items in the feed.
         publish -- Publish a new item to the feed, or edit an existing item.
         retract -- Remove an item from the feed.
+
+    Paging API:
+        get_ids_page -- Return a page of IDs, ordered by publication.
+        get_all_page -- Return a page of items (HSCAN, redis >= 2.8).
+        iter_ids     -- Return a generator of defers of IDs pages.
+        iter_all     -- Return a generator of defers of items pages.
     """
-    def __init__(self, pub, name):
+    # default number of entries of a page
+    page_size = 1000
+
+    def __init__(self, pub, name, item_cache=None):
         '''
         Create a new Feed object for a given Thoonk feed name.
 
         @param pub: the ThoonkPub object
         @param name: the name of this feed
+        @param item_cache: an optional txthoonk.cache.ItemCache of items read
+                           by get_item; it must listen to the events of this
+                           feed (see ItemCache.listen) to be kept coherent
+                           with other publishers.
         '''
         self.pub = pub
         self.name = name
@@ -61,6 +100,58 @@ class Feed(object):
         self.channel_edit = 'feed.edit:%s' % name
         self.channel_publish = 'feed.publish:%s' % name
 
+        self.trimming = None
+        self.codec = None
+        self.item_cache = item_cache
+
+    def _invalidate_items(self, ret, ids):
+        '''
+        Remove ids changed by this feed object from item_cache.
+
+        @param ret: the result passed through.
+        @param ids: the list of changed ids.
+        '''
+        if self.item_cache is not None:
+            for id_ in ids:
+                self.item_cache.invalidate(id_)
+        return ret
+
+    def _set_codec(self, config):
+        '''
+        Set self.codec from the feed configuration and return it.
+
+        @param config: the configuration dictionary.
+        '''
+        self.codec = get_codec(config.get('codec'))
+        return self.codec
+
+    def get_codec(self):
+        '''
+        Return a defer with the item codec, the configuration is read once.
+
+        Items of a feed that does not exist are read as raw.
+        '''
+        if self.codec is not None:
+            return defer.succeed(self.codec)
+
+        def _not_exists(failure):
+            from txthoonk.client import FeedDoesNotExist
+            failure.trap(FeedDoesNotExist)
+            return RawCodec()
+
+        d = self.get_config()
+        d.addCallbacks(self._set_codec, _not_exists)
+        return d
+
+    def _decode_items(self, items, codec):
+        '''
+        Decode the values of a dict of id -> data.
+        '''
+        if codec.name == RawCodec.name or not items:
+            return items
+        return dict((id_, None if data is None else codec.decode(data))
+                    for id_, data in items.items())
+
     def get_config(self):
         '''
         Get the configuration dictionary of this feed.
@@ -75,6 +166,7 @@ class Feed(object):
         '''
         return self.pub.set_config(self.name, conf)
 
+    @measured
     def publish(self, item, id_=None):
         '''
         Publish an item to the feed, or replace an existing item.
@@ -85,18 +177,47 @@ class Feed(object):
         If the feed has a max length, then the oldest entries will
         be removed to maintain the maximum length.
 
-        @param item: A string representation of the item.
+        If pub has scripting enabled, the whole operation is done by a single
+        Lua script call, which removes at most pub.trim_chunk old entries.
+        Otherwise the item is written by an optimistic transaction and at
+        most pub.trim_chunk old entries are removed after it, by rank (see
+        trim). In both cases any remaining overflow is removed in background
+        by trim.
+
+        @param item: The item, a string if the feed has no codec.
         @param id_: Optional id of this item.
         '''
         pub = self.pub
-        redis = pub.redis
 
         if id_ is None:
             id_ = uuid.uuid4().hex
 
         id_ = str(id_)
 
-        def _check_exec(bulk_result):
+        if pub.scripting:
+            d = self._publish_script(item, id_)
+            return d.addCallback(self._invalidate_items, [id_])
+
+        # max length and number of ids after the transaction
+        state = {'max': None, 'count': 0}
+
+        def _trim(ret):
+            """
+            Called when the transaction is done, its connection released
+            """
+            max_ = state['max']
+            if max_ is None or state['count'] <= max_:
+                return id_
+            d = self._trim_chunk(max_, pub.trim_chunk)
+            d.addCallback(_check_remaining)
+            return d
+
+        def _check_remaining(remaining):
+            if remaining > 0:
+                self._trim_in_background()
+            return id_
+
+        def _check_exec(bulk_result, data, redis):
             """
             Called when redis exec is completed
 
@@ -105,17 +226,20 @@ class Feed(object):
             # All defers must be succeed
             assert all([a[0] for a in bulk_result])
 
-            multi_result = bulk_result[-1][1]
+            multi_result = check_exec(bulk_result[-1][1])
             if multi_result:
                 # Transaction done :D
                 # assert number commands in transaction
-                assert len(multi_result) >= 3
+                assert len(multi_result) == 4
+                state['count'] = multi_result[-1]
                 # check if id_ existed when added
-                non_exists = multi_result[-1]
+                non_exists = multi_result[-2]
                 if non_exists:
-                    d = pub.publish_channel(self.channel_publish, id_, item)
+                    d = pub.publish_channel(self.channel_publish, id_, data,
+                                            redis=redis)
                 else:
-                    d = pub.publish_channel(self.channel_edit, id_, item)
+                    d = pub.publish_channel(self.channel_edit, id_, data,
+                                            redis=redis)
 
                 # return the id
                 d.addCallback(lambda x: id_)
@@ -123,75 +247,354 @@ class Feed(object):
 
             # Transaction fail :(
             # repeat it
-            return self.publish(item, id_)
+            return defer.fail(TransactionAborted())
 
-        def _do_publish(delete_ids, has_id):
+        def _do_publish(data, redis):
             """
-            Called when we have ids to be deleted
-
             Will add related data over the keys of redis.
-
-            May emit a retract event if has items to be deleted
             """
             defers = []
 
             # begin transaction
             defers += [redis.multi()]
 
-            # delete ids
-            # id is already on feed, we don't need to delete one
-            if has_id and len(delete_ids) > 0:
-                try:
-                    # try to choose itself if marked to be deleted
-                    delete_ids.remove(id_)
-                except ValueError:
-                    # else remove the last
-                    delete_ids.pop()
-
-            for i in delete_ids:
-                defers += [redis.zrem(self.feed_ids, i)]
-                defers += [redis.hdel(self.feed_items, i)]
-                defers += [pub.publish_channel(self.channel_retract, i)]
-
-            defers += [redis.incr(self.feed_publishes)] # -3
-            defers += [redis.hset(self.feed_items, id_, item)] # -2
-            defers += [redis.zadd(self.feed_ids, id_, time.time())] # -1
+            defers += [redis.incr(self.feed_publishes)] # -4
+            defers += [redis.hset(self.feed_items, id_, data)] # -3
+            defers += [redis.zadd(self.feed_ids, id_, repr(time.time()))] # -2
+            defers += [redis.zcard(self.feed_ids)] # -1
 
             defers += [redis.execute()]
 
-            return defer.DeferredList(defers).addCallback(_check_exec)
+            d = defer.DeferredList(defers)
+            return d.addCallback(_check_exec, data, redis)
 
-        def _got_config(bulk_result):
+        def _got_config(bulk_result, redis):
             """
             Called when we have this feed configuration
-
-            May generate a list of ids to be deleted.
             """
             # All defers must be succeed
             assert all([a[0] for a in bulk_result])
             # assert number of commands
-            assert len(bulk_result) == 5
+            assert len(bulk_result) == 4
 
-            has_id = bulk_result[-2][1]
             config = bulk_result[-1][1]
-            max_ = config.get("max_length")
-            if max_ is not None and max_.isdigit() and int(max_) > 0:
-                # get ids to be deleted
-                d = redis.zrange(self.feed_ids, 0, -int(max_))
-            else:
-                # no ids to be deleted
-                d = defer.succeed([])
+            data = self._set_codec(config).encode(item)
+            state['max'] = get_max_length(config)
+            return _do_publish(data, redis)
 
-            return d.addCallback(_do_publish, has_id)
+        def _attempt(redis):
+            defers = []
+            defers.append(redis.watch(self.feed_config)) #0
+            defers.append(redis.watch(self.feed_ids)) #1
+            defers.append(redis.watch(self.feed_items)) #2
+            defers.append(pub.get_config(self.name, redis)) #3
+            return defer.DeferredList(defers).addCallback(_got_config, redis)
 
-        defers = []
-        defers.append(redis.watch(self.feed_config)) #0
-        defers.append(redis.watch(self.feed_ids)) #1
-        defers.append(redis.watch(self.feed_items)) #2
-        defers.append(self.has_id(id_)) #3
-        defers.append(self.get_config()) #4
-        return defer.DeferredList(defers).addCallback(_got_config)
+        d = pub.transaction(self.name, _attempt)
+        d.addCallback(self._invalidate_items, [id_])
+        return d.addCallback(_trim)
+
+    def _publish_script(self, item, id_):
+        '''
+        Publish an item to the feed using FEED_PUBLISH script, reading the
+        codec of this feed first if needed.
+
+        @param item: The item.
+        @param id_: The id of this item.
+        '''
+        if self.codec is None:
+            d = self.get_codec()
+            return d.addCallback(self._publish_script_encoded, item, id_)
+        return self._publish_script_encoded(self.codec, item, id_)
+
+    def _publish_script_encoded(self, codec, item, id_):
+        '''
+        Publish an item to the feed using FEED_PUBLISH script.
+
+        @param codec: the codec of this feed.
+        @param item: The item.
+        @param id_: The id of this item.
+        '''
+        pub = self.pub
+
+        def _check_result(ret):
+            """
+            Called when script returns.
+            """
+            status, remaining = ret
+            if status < 0:
+                from txthoonk.client import FeedDoesNotExist
+                return defer.fail(FeedDoesNotExist())
+            if remaining > 0:
+                self._trim_in_background()
+            return id_
+
+        keys = ["feeds", self.feed_config, self.feed_ids, self.feed_items,
+                self.feed_publishes]
+        args = [self.name, id_, codec.encode(item), repr(time.time()),
+                pub.SEPARATOR, self.channel_publish, self.channel_edit,
+                self.channel_retract, pub.trim_chunk]
+        d = pub.run_script(scripts.FEED_PUBLISH, keys, args)
+        return d.addCallback(_check_result)
+
+    def _trim_in_background(self):
+        '''
+        Start a trim if there is no one running.
+        '''
+        if self.trimming is not None:
+            return
+
+        def _done(ret):
+            self.trimming = None
+            return ret
+
+        d = self.trimming = self.trim()
+        d.addErrback(log.err, "Failed to trim feed %r" % self.name)
+        d.addBoth(_done)
+
+    @measured
+    def trim(self, max_length=None, chunk=None):
+        '''
+        Remove the oldest items exceeding the max length of the feed.
+
+        The overflow is removed by rank on redis server (FEED_TRIM script),
+        ids are not sent to the client and a retract notice is published for
+        each removed item. Large trims are done in chunks, letting other
+        clients run between chunks.
+
+        The script is used whenever redis runs Lua scripts (redis >= 2.6),
+        even if pub has scripting disabled. Otherwise each chunk is removed
+        by an optimistic transaction (ZREMRANGEBYRANK and HDEL), only the ids
+        of the chunk are read by the client.
+
+        @param max_length: the max number of items, defaults to max_length
+                           on feed config.
+        @param chunk: max number of items removed by each chunk, defaults to
+                      pub.trim_chunk, 0 to remove all in a single call.
+
+        @return: A defer fired when the feed was trimmed.
+        '''
+        pub = self.pub
+        if chunk is None:
+            chunk = pub.trim_chunk
+
+        def _trim(max_):
+            if max_ is None:
+                # unbounded feed
+                return None
+            d = self._trim_chunk(max_, chunk)
+            return d.addCallback(_check_remaining, max_)
+
+        def _check_remaining(remaining, max_):
+            if remaining > 0:
+                from twisted.internet import reactor
+                return task.deferLater(reactor, 0, _trim, max_)
+
+        if max_length is not None:
+            return _trim(max_length)
+
+        d = self.get_config()
+        d.addCallback(get_max_length)
+        return d.addCallback(_trim)
+
+    def _trim_chunk(self, max_length, chunk):
+        '''
+        Remove at most chunk of the oldest items exceeding max_length, see
+        trim.
+
+        @return: A defer witch callback function will have the number of
+                 items still to be removed as the first argument.
+        '''
+        pub = self.pub
+
+        def _check_exec(bulk_result, remaining):
+            """
+            Called when redis exec is completed
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            if check_exec(bulk_result[-1][1]):
+                # transaction done :D
+                return remaining
+
+            # Transaction fail :(
+            # repeat it
+            return defer.fail(TransactionAborted())
+
+        def _got_ids(ids, remaining, redis):
+            """
+            Called when we have the ids of chunk
+            """
+            defers = []
+            # begin transaction
+            defers.append(redis.multi())
+            defers.append(redis.send('ZREMRANGEBYRANK', self.feed_ids, 0,
+                                     len(ids) - 1))
+            for pos in range(0, len(ids), 1000):
+                defers.append(redis.send('HDEL', self.feed_items,
+                                         *ids[pos:pos + 1000]))
+            for id_ in ids:
+                defers.append(pub.publish_channel(self.channel_retract, id_,
+                                                  redis=redis))
+            # end transaction
+            defers.append(redis.execute())
+
+            d = defer.DeferredList(defers)
+            return d.addCallback(_check_exec, remaining)
+
+        def _got_count(bulk_result, redis):
+            """
+            Called when we have the number of ids
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            overflow = bulk_result[-1][1] - max_length
+            if overflow <= 0:
+                return redis.unwatch().addCallback(lambda x: 0)
+            n = overflow
+            if chunk > 0 and n > chunk:
+                n = chunk
+            d = redis.zrange(self.feed_ids, 0, n - 1)
+            return d.addCallback(_got_ids, overflow - n, redis)
+
+        def _attempt(redis):
+            defers = []
+            defers.append(redis.watch(self.feed_ids)) #0
+            defers.append(redis.zcard(self.feed_ids)) #1
+            return defer.DeferredList(defers).addCallback(_got_count, redis)
+
+        def _run(lua):
+            if lua:
+                keys = [self.feed_ids, self.feed_items]
+                args = [max_length, chunk, self.channel_retract]
+                return pub.run_script(scripts.FEED_TRIM, keys, args)
+            return pub.transaction(self.name, _attempt)
+
+        return pub.check_scripting().addCallback(_run)
+
+    @measured
+    def publish_many(self, items):
+        '''
+        Publish many items to the feed, or replace existing items.
+
+        It works like calling publish for each item in order, but all items
+        are written by a single transaction and the feed is trimmed to its
+        max length once for the whole batch. Publish, edit and retract
+        notices are sent inside the transaction.
+
+        The feed is trimmed by trim after the transaction, instead of
+        sending the ids to be removed to the client.
+
+        @param items: An iterable of (item, id_) tuples, id_ may be None.
+                      Items are strings if the feed has no codec.
+
+        @return: A defer witch callback function will have the list of ids
+                 as the first argument.
+        '''
+        pub = self.pub
+
+        items = [(item, uuid.uuid4().hex if id_ is None else str(id_))
+                 for item, id_ in items]
+        if not items:
+            return defer.succeed([])
+
+        ids = [id_ for _, id_ in items]
+        batch = set(ids)
+
+        # max length to be trimmed by server after transaction
+        state = {'trim': None}
+
+        def _trim(ret):
+            """
+            Called when the transaction is done, its connection released
+            """
+            if state['trim'] is not None:
+                d = self.trim(state['trim'])
+                return d.addCallback(lambda x: ids)
+            return ids
+
+        def _check_exec(bulk_result):
+            """
+            Called when redis exec is completed
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            multi_result = check_exec(bulk_result[-1][1])
+            if multi_result:
+                # Transaction done :D
+                return ids
+
+            # Transaction fail :(
+            # repeat it
+            return defer.fail(TransactionAborted())
+
+        def _do_publish(existing, codec, redis):
+            """
+            Will add all items.
+            """
+            defers = [redis.multi()]
+
+            base_score = time.time()
+            seen = set(existing)
+            for pos, (item, id_) in enumerate(items):
+                # keep the batch order, items on batch may share same time
+                score = repr(base_score + pos * 1e-6)
+                item = codec.encode(item)
+                defers += [redis.incr(self.feed_publishes)]
+                defers += [redis.hset(self.feed_items, id_, item)]
+                defers += [redis.zadd(self.feed_ids, id_, score)]
+                if id_ in seen:
+                    channel = self.channel_edit
+                else:
+                    channel = self.channel_publish
+                    seen.add(id_)
+                defers += [pub.publish_channel(channel, id_, item,
+                                               redis=redis)]
+
+            defers += [redis.execute()]
+
+            return defer.DeferredList(defers).addCallback(_check_exec)
+
+        def _got_config(results, redis):
+            """
+            Called when we have this feed configuration and the ids of batch
+            already on feed.
+            """
+            found, config = [r[1] for r in results[1:]]
+            existing = set(id_ for id_, item in (found or {}).items()
+                           if item is not None)
+            codec = self._set_codec(config)
+            # the server will remove the overflow
+            state['trim'] = get_max_length(config)
+            return _do_publish(existing, codec, redis)
+
+        def _failed(failure, redis):
+            """
+            Called when we could not get config or existing ids
+            """
+            failure.trap(defer.FirstError)
+            d = redis.unwatch()
+            return d.addCallback(lambda x: failure.value.subFailure)
 
+        def _attempt(redis):
+            defers = []
+            defers.append(redis.watch(self.feed_config, self.feed_ids,
+                                      self.feed_items)) #0
+            defers.append(redis.hmget(self.feed_items, list(batch))) #1
+            defers.append(pub.get_config(self.name, redis)) #2
+            d = defer.DeferredList(defers, fireOnOneErrback=True,
+                                   consumeErrors=True)
+            return d.addCallbacks(_got_config, _failed,
+                                  callbackArgs=(redis,), errbackArgs=(redis,))
+
+        d = pub.transaction(self.name, _attempt)
+        d.addCallback(self._invalidate_items, ids)
+        return d.addCallback(_trim)
+
+    @measured
     def retract(self, id_):
         '''
         Remove an item from the feed.
@@ -199,55 +602,178 @@ class Feed(object):
         @param id_: The ID value of the item to remove.
         '''
         pub = self.pub
-        redis = pub.redis
 
-        def _check_exec(multi_result):
+        def _check_exec(bulk_result):
             """
             Called when redis exec is completed
             """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
 
+            multi_result = check_exec(bulk_result[-1][1])
             if multi_result:
                 # transaction done :D
                 # assert number commands in transaction
                 assert len(multi_result) == 3
-                return defer.succeed(None)
+                return None
 
             # Transaction fail :(
             # repeat it
-            return self.retract(id_)
+            return defer.fail(TransactionAborted())
 
-        def _has_id(has_id):
+        def _has_id(bulk_result, redis):
             """
             Called when self.has_id is completed
             """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            has_id = bulk_result[-1][1]
             if not has_id:
                 return redis.unwatch()
-            # start transaction
-            d = redis.multi()
-            d.addCallback(lambda x: redis.zrem(self.feed_ids, id_))
-            d.addCallback(lambda x: redis.hdel(self.feed_items, id_))
-            d.addCallback(lambda x: pub.publish_channel(self.channel_retract,
-                                                        id_))
-            d.addCallback(lambda x: redis.execute())
-
-            d.addCallback(_check_exec)
-            return d
 
-        d = redis.watch(self.feed_items)
-        d.addCallback(lambda x: redis.watch(self.feed_items))
-        d.addCallback(lambda x: redis.watch(self.feed_ids))
-        d.addCallback(lambda x: self.has_id(id_))
-        d.addCallback(_has_id)
+            defers = []
+            # begin transaction
+            defers.append(redis.multi())
+            defers.append(redis.zrem(self.feed_ids, id_))
+            defers.append(redis.hdel(self.feed_items, id_))
+            defers.append(pub.publish_channel(self.channel_retract, id_,
+                                              redis=redis))
+            # end transaction
+            defers.append(redis.execute())
+
+            return defer.DeferredList(defers).addCallback(_check_exec)
 
-        return d
+        def _attempt(redis):
+            defers = []
+            defers.append(redis.watch(self.feed_items, self.feed_ids)) #0
+            defers.append(redis.hexists(self.feed_items, id_)) #1
+            return defer.DeferredList(defers).addCallback(_has_id, redis)
+
+        d = pub.transaction(self.name, _attempt)
+        return d.addCallback(self._invalidate_items, [id_])
+
+    @measured
+    def retract_many(self, ids):
+        '''
+        Remove many items from the feed.
+
+        Existing ids are checked by a single HMGET and all of them are
+        removed by a single transaction. Non existing ids are ignored.
+
+        @param ids: An iterable of item IDs.
+
+        @return: A defer witch callback function will have the list of
+                 removed ids as the first argument.
+        '''
+        pub = self.pub
+
+        # unique ids, keeping the order
+        seen = set()
+        unique_ids = []
+        for id_ in ids:
+            id_ = str(id_)
+            if id_ not in seen:
+                seen.add(id_)
+                unique_ids.append(id_)
+        ids = unique_ids
+        if not ids:
+            return defer.succeed([])
+
+        def _check_exec(bulk_result, existing):
+            """
+            Called when redis exec is completed
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            multi_result = check_exec(bulk_result[-1][1])
+            if multi_result:
+                # transaction done :D
+                return existing
+
+            # Transaction fail :(
+            # repeat it
+            return defer.fail(TransactionAborted())
+
+        def _got_items(bulk_result, redis):
+            """
+            Called when we have the items of ids
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            found = bulk_result[-1][1] or {}
+            existing = [id_ for id_ in ids if found.get(id_) is not None]
+            if not existing:
+                return redis.unwatch().addCallback(lambda x: [])
+
+            defers = []
+            # begin transaction
+            defers.append(redis.multi())
+            for pos in range(0, len(existing), 1000):
+                chunk = existing[pos:pos + 1000]
+                defers.append(redis.send('ZREM', self.feed_ids, *chunk))
+                defers.append(redis.send('HDEL', self.feed_items, *chunk))
+            for id_ in existing:
+                defers.append(pub.publish_channel(self.channel_retract, id_,
+                                                  redis=redis))
+            # end transaction
+            defers.append(redis.execute())
+
+            d = defer.DeferredList(defers)
+            return d.addCallback(_check_exec, existing)
+
+        def _attempt(redis):
+            defers = []
+            defers.append(redis.watch(self.feed_items, self.feed_ids)) #0
+            defers.append(redis.hmget(self.feed_items, ids)) #1
+            return defer.DeferredList(defers).addCallback(_got_items, redis)
+
+        d = pub.transaction(self.name, _attempt)
+        return d.addCallback(self._invalidate_items, ids)
 
+    @measured
     def get_item(self, id_):
         '''
         Retrieve a single item from the feed.
 
+        If the feed has an item_cache, items found on it are returned without
+        reading redis.
+
         @param id_: The ID of the item to retrieve.
         '''
-        return self.pub.redis.hget(self.feed_items, id_)
+        cache = self.item_cache
+        if cache is not None:
+            id_ = str(id_)
+            found, item = cache.get(id_)
+            if found:
+                return defer.succeed({id_: item})
+
+        def _cache(data, codec, token):
+            items = self._decode_items(data, codec)
+            if not items or items.get(id_) is None:
+                cache.abort(id_, token)
+            else:
+                cache.set(id_, items[id_], len(data[id_]), token)
+            return items
+
+        def _failed(failure, token):
+            cache.abort(id_, token)
+            return failure
+
+        def _get(codec):
+            if cache is None:
+                d = self.pub.redis.hget(self.feed_items, id_)
+                return d.addCallback(self._decode_items, codec)
+
+            token = cache.reading(id_)
+            d = self.pub.redis.hget(self.feed_items, id_)
+            return d.addCallbacks(_cache, _failed,
+                                  callbackArgs=(codec, token),
+                                  errbackArgs=(token,))
+
+        return self.get_codec().addCallback(_get)
 
     def get_id(self, id_):
         '''
@@ -259,6 +785,7 @@ class Feed(object):
         '''
         return self.get_item(id_)
 
+    @measured
     def has_id(self, id_):
         '''
         Verify if the feed has an item ID.
@@ -273,14 +800,2039 @@ class Feed(object):
         d = self.pub.redis.hexists(self.feed_items, id_)
         return d
 
+    @measured
     def get_ids(self):
         '''
         Return the set of IDs used by items in the feed.
         '''
         return self.pub.redis.zrange(self.feed_ids, 0, -1)
 
+    @measured
     def get_all(self):
         '''
         Return all items from the feed.
         '''
-        return self.pub.redis.hgetall(self.feed_items)
+        def _get(codec):
+            d = self.pub.redis.hgetall(self.feed_items)
+            return d.addCallback(self._decode_items, codec)
+
+        return self.get_codec().addCallback(_get)
+
+    @measured
+    def get_ids_page(self, cursor=None, count=None):
+        '''
+        Return a page of the IDs used by items in the feed.
+
+        IDs are ordered by publication and windowed by score
+        (ZRANGEBYSCORE), so items published or retracted while paging do not
+        shift the next pages.
+
+        @param cursor: the cursor returned by the previous page, None for
+                       the first page.
+        @param count: the max number of IDs of page, defaults to page_size.
+
+        @return: A defer witch callback function will have a tuple of
+                 (list of ids, next cursor) as the first argument, next
+                 cursor is None on the last page.
+        '''
+        redis = self.pub.redis
+        if count is None:
+            count = self.page_size
+
+        if cursor is None:
+            min_score, skip = '-inf', 0
+        else:
+            min_score, skip = cursor
+
+        def _got_page(reply):
+            ids = reply[::2]
+            scores = reply[1::2]
+            if len(ids) < count:
+                return ids, None
+
+            last_score = scores[-1]
+            # ids sharing the last score must be skipped on next page
+            ties = len(scores) - scores.index(last_score)
+            if last_score == min_score:
+                ties += skip
+            return ids, (last_score, ties)
+
+        d = redis.send('ZRANGEBYSCORE', self.feed_ids, min_score, '+inf',
+                       'WITHSCORES', 'LIMIT', skip, count)
+        return d.addCallback(_got_page)
+
+    @measured
+    def get_all_page(self, cursor=0, count=None):
+        '''
+        Return a page of the items of the feed.
+
+        Items are iterated by HSCAN (redis >= 2.8), they are not ordered and
+        an item may be returned more than once.
+
+        @param cursor: the cursor returned by the previous page, 0 for the
+                       first page.
+        @param count: the hint of the number of items of page, defaults to
+                      page_size.
+
+        @return: A defer witch callback function will have a tuple of
+                 (dict of items, next cursor) as the first argument, next
+                 cursor is None on the last page.
+        '''
+        if count is None:
+            count = self.page_size
+
+        def _got_page(reply, codec):
+            cursor, items = reply
+            return self._decode_items(items, codec), cursor or None
+
+        def _get(codec):
+            d = self.pub.redis.hscan(self.feed_items, cursor, count=count)
+            return d.addCallback(_got_page, codec)
+
+        return self.get_codec().addCallback(_get)
+
+    def _iter_pages(self, get_page, cursor, page_size):
+        '''
+        Return a generator of defers of pages.
+
+        @param get_page: the function returning a page.
+        @param cursor: the cursor of first page.
+        @param page_size: the number of entries of each page.
+        '''
+        state = {'cursor': cursor, 'done': False, 'waiting': False}
+
+        def _got_page(page):
+            entries, state['cursor'] = page
+            state['done'] = state['cursor'] is None
+            return entries
+
+        def _failed(failure):
+            state['done'] = True
+            return failure
+
+        def _received(ret):
+            state['waiting'] = False
+            return ret
+
+        while not state['done']:
+            if state['waiting']:
+                raise RuntimeError("The previous page was not received yet")
+            state['waiting'] = True
+            d = get_page(state['cursor'], page_size)
+            d.addCallbacks(_got_page, _failed)
+            d.addBoth(_received)
+            yield d
+
+    def iter_ids(self, page_size=None):
+        '''
+        Return a generator of defers of IDs pages, see get_ids_page.
+
+        Each defer must be fired before asking for the next one, eg.:
+
+            for d in feed.iter_ids():
+                ids = yield d
+
+        @param page_size: the number of IDs of each page, defaults to
+                          page_size.
+        '''
+        return self._iter_pages(self.get_ids_page, None, page_size)
+
+    def iter_all(self, page_size=None):
+        '''
+        Return a generator of defers of items pages, see get_all_page.
+
+        Each defer must be fired before asking for the next one, eg.:
+
+            for d in feed.iter_all():
+                items = yield d
+
+        @param page_size: the hint of the number of items of each page,
+                          defaults to page_size.
+        '''
+        return self._iter_pages(self.get_all_page, 0, page_size)
+
+
+def _found(found, ids):
+    '''
+    Return the list of (id, data) of ids found by HMGET, in order.
+
+    @param found: the dict returned by HMGET.
+    @param ids: the list of ids.
+    '''
+    found = found or {}
+    return [(id_, found[id_]) for id_ in ids if found.get(id_) is not None]
+
+
+def parse_position(position):
+    '''
+    Return a tuple (where, relative id) of a relative position of a sorted
+    feed; where is 'begin', 'end', 'before' or 'after'.
+
+    @param position: 'begin:', ':end', ':[id]' (before id) or '[id]:' (after
+                     id).
+    '''
+    if position == 'begin:':
+        return 'begin', None
+    if position == ':end':
+        return 'end', None
+    if len(position) > 1 and position.startswith(':'):
+        return 'before', position[1:]
+    if len(position) > 1 and position.endswith(':'):
+        return 'after', position[:-1]
+    raise ValueError("Invalid position %r" % (position,))
+
+
+class SortedFeed(Feed):
+    """
+    A Thoonk sorted feed is an unbounded, manually ordered collection of
+    items.
+
+    Items get incremental IDs and may be inserted at the begin, at the end,
+    before or after another item, and moved later. Positions are written as
+    'begin:', ':end', ':[id]' (before id) and '[id]:' (after id), the same
+    format of the position notices.
+
+    If pub has scripting enabled, append, prepend, publish_before,
+    publish_after, edit and move are done by a single Lua script call,
+    otherwise by two round trips. append_many and move_many write a whole
+    batch by a single transaction.
+
+    Redis Keys Used:
+        feed.ids:[feed]       -- A list of item IDs, in feed order.
+        feed.items:[feed]     -- A hash table of items keyed by ID.
+        feed.idincr:[feed]    -- A counter for item IDs.
+        feed.config:[feed]    -- Feed configuration data of this feed.
+        feed.publishes:[feed] -- A counter for number of published items.
+        feed.publish:[feed]   -- A pubsub channel for publication and edit
+                                 notices.
+        feed.retract:[feed]   -- A pubsub channel for retraction notices.
+        feed.position:[feed]  -- A pubsub channel for position notices.
+
+    Thoonk Standard API:
+        append         -- Add an item to the end of the feed.
+        prepend        -- Add an item to the begin of the feed.
+        publish_before -- Add an item before another item.
+        publish_after  -- Add an item after another item.
+        edit           -- Replace an existing item.
+        move           -- Move an item to a relative position.
+        retract        -- Remove an item from the feed.
+        get_ids        -- Return the IDs of all items, in feed order.
+        get_item       -- Return a single item from the feed given its ID.
+        get_all        -- Return all items in the feed.
+
+    Bulk API:
+        append_many  -- Add many items to the end of the feed.
+        move_many    -- Move many items to a relative position.
+        retract_many -- Remove many items from the feed.
+    """
+    def __init__(self, pub, name, item_cache=None):
+        '''
+        Create a new SortedFeed object for a given Thoonk feed name.
+
+        @param pub: the ThoonkPub object
+        @param name: the name of this feed
+        @param item_cache: an optional txthoonk.cache.ItemCache of items read
+                           by get_item.
+        '''
+        Feed.__init__(self, pub, name, item_cache)
+        self.feed_idincr = 'feed.idincr:%s' % name
+        self.channel_position = 'feed.position:%s' % name
+
+    def publish(self, item):
+        '''
+        Add an item to the end of the feed, an alias to append.
+
+        @param item: The item, a string if the feed has no codec.
+        '''
+        return self.append(item)
+
+    def publish_many(self, items):
+        '''
+        Add many items to the end of the feed, an alias to append_many.
+
+        @param items: An iterable of items, strings if the feed has no codec.
+        '''
+        return self.append_many(items)
+
+    @measured
+    def append(self, item):
+        '''
+        Add an item to the end of the feed.
+
+        @param item: The item, a string if the feed has no codec.
+
+        @return: A defer witch callback function will have the new id as
+                 the first argument.
+        '''
+        return self._insert(item, ':end')
+
+    @measured
+    def prepend(self, item):
+        '''
+        Add an item to the begin of the feed.
+
+        @param item: The item, a string if the feed has no codec.
+        '''
+        return self._insert(item, 'begin:')
+
+    @measured
+    def publish_before(self, before_id, item):
+        '''
+        Add an item before an existing item, fails with ItemDoesNotExist if
+        before_id is not on feed.
+
+        @param before_id: The id of the item after the new one.
+        @param item: The item, a string if the feed has no codec.
+        '''
+        return self._insert(item, ':%s' % before_id)
+
+    @measured
+    def publish_after(self, after_id, item):
+        '''
+        Add an item after an existing item, fails with ItemDoesNotExist if
+        after_id is not on feed.
+
+        @param after_id: The id of the item before the new one.
+        @param item: The item, a string if the feed has no codec.
+        '''
+        return self._insert(item, '%s:' % after_id)
+
+    def _insert(self, item, position):
+        '''
+        Add an item at a relative position.
+
+        @param item: The item.
+        @param position: The relative position of the new item.
+        '''
+        from txthoonk.client import ItemDoesNotExist, FeedDoesNotExist
+        pub = self.pub
+        where, rel = parse_position(position)
+
+        def _check_script(ret):
+            status, id_ = ret
+            if status < 0:
+                return defer.fail(FeedDoesNotExist())
+            if status == 0:
+                return defer.fail(ItemDoesNotExist(rel))
+            return id_
+
+        def _check_exec(bulk_result, id_):
+            """
+            Called when redis exec is completed
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            if check_exec(bulk_result[-1][1]):
+                # Transaction done :D
+                return id_
+
+            # Transaction fail :(
+            # repeat it
+            return defer.fail(TransactionAborted())
+
+        def _got_id(bulk_result, data, redis):
+            """
+            Called when we have the new id and the relative id was checked
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            id_ = str(bulk_result[-1][1])
+            if not bulk_result[1][1]:
+                d = redis.unwatch()
+                return d.addCallback(
+                            lambda x: defer.fail(FeedDoesNotExist()))
+            if rel is not None and not bulk_result[2][1]:
+                d = redis.unwatch()
+                return d.addCallback(
+                            lambda x: defer.fail(ItemDoesNotExist(rel)))
+
+            defers = []
+            # begin transaction
+            defers.append(redis.multi())
+            if where == 'begin':
+                defers.append(redis.lpush(self.feed_ids, id_))
+            elif where == 'end':
+                defers.append(redis.rpush(self.feed_ids, id_))
+            else:
+                defers.append(redis.send('LINSERT', self.feed_ids,
+                                         where.upper(), rel, id_))
+            defers.append(redis.hset(self.feed_items, id_, data))
+            defers.append(redis.incr(self.feed_publishes))
+            defers.append(pub.publish_channel(self.channel_publish, id_, data,
+                                              redis=redis))
+            defers.append(pub.publish_channel(self.channel_position, id_,
+                                              position, redis=redis))
+            # end transaction
+            defers.append(redis.execute())
+
+            d = defer.DeferredList(defers)
+            return d.addCallback(_check_exec, id_)
+
+        def _attempt(redis, data):
+            defers = []
+            if rel is not None:
+                defers.append(redis.watch("feeds", self.feed_items)) #0
+            else:
+                defers.append(redis.watch("feeds")) #0
+            defers.append(pub.feed_exists(self.name, redis=redis)) #1
+            if rel is not None:
+                defers.append(redis.hexists(self.feed_items, rel)) #2
+            defers.append(redis.incr(self.feed_idincr)) #-1
+            return defer.DeferredList(defers).addCallback(_got_id, data,
+                                                          redis)
+
+        def _insert(codec):
+            data = codec.encode(item)
+            if pub.scripting:
+                keys = ["feeds", self.feed_idincr, self.feed_ids,
+                        self.feed_items, self.feed_publishes]
+                args = [self.name, data, pub.SEPARATOR, self.channel_publish,
+                        self.channel_position, where, rel or '', position]
+                d = pub.run_script(scripts.SORTED_INSERT, keys, args)
+                return d.addCallback(_check_script)
+            return pub.transaction(self.name,
+                                   lambda redis: _attempt(redis, data))
+
+        return self.get_codec().addCallback(_insert)
+
+    @measured
+    def append_many(self, items):
+        '''
+        Add many items to the end of the feed, in order.
+
+        IDs are reserved by a single INCRBY and all items are written by a
+        single transaction. Fails with FeedDoesNotExist if the feed does not
+        exist.
+
+        @param items: An iterable of items, strings if the feed has no codec.
+
+        @return: A defer witch callback function will have the list of new
+                 ids as the first argument.
+        '''
+        from txthoonk.client import FeedDoesNotExist
+        pub = self.pub
+        items = list(items)
+        if not items:
+            return defer.succeed([])
+
+        def _check_exec(bulk_result, ids):
+            """
+            Called when redis exec is completed
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            if check_exec(bulk_result[-1][1]):
+                # Transaction done :D
+                return ids
+
+            # Transaction fail :(
+            # repeat it
+            return defer.fail(TransactionAborted())
+
+        def _got_ids(bulk_result, data, redis):
+            """
+            Called when the ids were reserved and the feed was checked
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            if not bulk_result[1][1]:
+                d = redis.unwatch()
+                return d.addCallback(
+                            lambda x: defer.fail(FeedDoesNotExist()))
+
+            first = int(bulk_result[-1][1]) - len(data) + 1
+            ids = [str(i) for i in range(first, first + len(data))]
+
+            defers = []
+            # begin transaction
+            defers.append(redis.multi())
+            for pos in range(0, len(ids), 1000):
+                chunk = ids[pos:pos + 1000]
+                defers.append(redis.send('RPUSH', self.feed_ids, *chunk))
+                fields = []
+                for id_, item in zip(chunk, data[pos:pos + 1000]):
+                    fields += [id_, item]
+                defers.append(redis.send('HMSET', self.feed_items, *fields))
+            defers.append(redis.incr(self.feed_publishes, len(ids)))
+            for id_, item in zip(ids, data):
+                defers.append(pub.publish_channel(self.channel_publish, id_,
+                                                  item, redis=redis))
+                defers.append(pub.publish_channel(self.channel_position, id_,
+                                                  ':end', redis=redis))
+            # end transaction
+            defers.append(redis.execute())
+
+            d = defer.DeferredList(defers)
+            return d.addCallback(_check_exec, ids)
+
+        def _attempt(redis, data):
+            defers = []
+            defers.append(redis.watch("feeds")) #0
+            defers.append(pub.feed_exists(self.name, redis=redis)) #1
+            defers.append(redis.incr(self.feed_idincr, len(data))) #-1
+            return defer.DeferredList(defers).addCallback(_got_ids, data,
+                                                          redis)
+
+        def _encode(codec):
+            data = [codec.encode(item) for item in items]
+            return pub.transaction(self.name,
+                                   lambda redis: _attempt(redis, data))
+
+        return self.get_codec().addCallback(_encode)
+
+    @measured
+    def edit(self, id_, item):
+        '''
+        Replace an existing item, fails with ItemDoesNotExist if id_ is not
+        on feed.
+
+        A publish notice is sent, as other Thoonk implementations do.
+
+        @param id_: The id of the item.
+        @param item: The item, a string if the feed has no codec.
+        '''
+        from txthoonk.client import ItemDoesNotExist
+        pub = self.pub
+        id_ = str(id_)
+
+        def _check_script(ret):
+            if not ret:
+                return defer.fail(ItemDoesNotExist(id_))
+            return id_
+
+        def _check_exec(bulk_result):
+            """
+            Called when redis exec is completed
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            if check_exec(bulk_result[-1][1]):
+                # Transaction done :D
+                return id_
+
+            # Transaction fail :(
+            # repeat it
+            return defer.fail(TransactionAborted())
+
+        def _has_id(bulk_result, data, redis):
+            """
+            Called when we know if the item exists
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            if not bulk_result[-1][1]:
+                d = redis.unwatch()
+                return d.addCallback(
+                            lambda x: defer.fail(ItemDoesNotExist(id_)))
+
+            defers = []
+            # begin transaction
+            defers.append(redis.multi())
+            defers.append(redis.hset(self.feed_items, id_, data))
+            defers.append(redis.incr(self.feed_publishes))
+            defers.append(pub.publish_channel(self.channel_publish, id_, data,
+                                              redis=redis))
+            # end transaction
+            defers.append(redis.execute())
+
+            return defer.DeferredList(defers).addCallback(_check_exec)
+
+        def _attempt(redis, data):
+            defers = []
+            defers.append(redis.watch(self.feed_items)) #0
+            defers.append(redis.hexists(self.feed_items, id_)) #1
+            return defer.DeferredList(defers).addCallback(_has_id, data,
+                                                          redis)
+
+        def _edit(codec):
+            data = codec.encode(item)
+            if pub.scripting:
+                keys = [self.feed_items, self.feed_publishes]
+                args = [id_, data, pub.SEPARATOR, self.channel_publish]
+                d = pub.run_script(scripts.SORTED_EDIT, keys, args)
+                return d.addCallback(_check_script)
+            return pub.transaction(self.name,
+                                   lambda redis: _attempt(redis, data))
+
+        d = self.get_codec().addCallback(_edit)
+        return d.addCallback(self._invalidate_items, [id_])
+
+    @measured
+    def move(self, id_, position):
+        '''
+        Move an item to a relative position, fails with ItemDoesNotExist if
+        id_ or the relative id are not on feed.
+
+        @param id_: The id of the item.
+        @param position: 'begin:', ':end', ':[id]' (before id) or '[id]:'
+                         (after id).
+        '''
+        from txthoonk.client import ItemDoesNotExist
+        pub = self.pub
+        id_ = str(id_)
+        where, rel = parse_position(position)
+        if rel == id_:
+            return defer.fail(ValueError("Item can not be moved relative "
+                                         "to itself"))
+
+        def _check_script(ret):
+            if ret < 0:
+                return defer.fail(ItemDoesNotExist(id_))
+            if ret == 0:
+                return defer.fail(ItemDoesNotExist(rel))
+            return id_
+
+        def _check_exec(bulk_result):
+            """
+            Called when redis exec is completed
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            if check_exec(bulk_result[-1][1]):
+                # Transaction done :D
+                return id_
+
+            # Transaction fail :(
+            # repeat it
+            return defer.fail(TransactionAborted())
+
+        def _has_ids(bulk_result, redis):
+            """
+            Called when we know if the items exist
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            for (success, exists), missing in zip(bulk_result[1:], [id_, rel]):
+                if not exists:
+                    d = redis.unwatch()
+                    return d.addCallback(
+                            lambda x: defer.fail(ItemDoesNotExist(missing)))
+
+            defers = []
+            # begin transaction
+            defers.append(redis.multi())
+            defers.append(redis.lrem(self.feed_ids, id_, 1))
+            if where == 'begin':
+                defers.append(redis.lpush(self.feed_ids, id_))
+            elif where == 'end':
+                defers.append(redis.rpush(self.feed_ids, id_))
+            else:
+                defers.append(redis.send('LINSERT', self.feed_ids,
+                                         where.upper(), rel, id_))
+            defers.append(pub.publish_channel(self.channel_position, id_,
+                                              position, redis=redis))
+            # end transaction
+            defers.append(redis.execute())
+
+            return defer.DeferredList(defers).addCallback(_check_exec)
+
+        def _attempt(redis):
+            defers = []
+            defers.append(redis.watch(self.feed_items, self.feed_ids)) #0
+            defers.append(redis.hexists(self.feed_items, id_)) #1
+            if rel is not None:
+                defers.append(redis.hexists(self.feed_items, rel)) #2
+            return defer.DeferredList(defers).addCallback(_has_ids, redis)
+
+        if pub.scripting:
+            keys = [self.feed_ids, self.feed_items]
+            args = [id_, where, rel or '', pub.SEPARATOR,
+                    self.channel_position, position]
+            d = pub.run_script(scripts.SORTED_MOVE, keys, args)
+            return d.addCallback(_check_script)
+        return pub.transaction(self.name, _attempt)
+
+    def move_before(self, rel_id, id_):
+        '''
+        Move an item before another item.
+
+        @param rel_id: The id of the item after the moved one.
+        @param id_: The id of the item.
+        '''
+        return self.move(id_, ':%s' % rel_id)
+
+    def move_after(self, rel_id, id_):
+        '''
+        Move an item after another item.
+
+        @param rel_id: The id of the item before the moved one.
+        @param id_: The id of the item.
+        '''
+        return self.move(id_, '%s:' % rel_id)
+
+    def move_first(self, id_):
+        '''
+        Move an item to the begin of the feed.
+
+        @param id_: The id of the item.
+        '''
+        return self.move(id_, 'begin:')
+
+    def move_last(self, id_):
+        '''
+        Move an item to the end of the feed.
+
+        @param id_: The id of the item.
+        '''
+        return self.move(id_, ':end')
+
+    @measured
+    def move_many(self, ids, position):
+        '''
+        Move many items to a relative position, keeping the given order.
+
+        The list of IDs is read once, reordered on client and rewritten by a
+        single transaction, instead of one LREM (a list scan) by item. A
+        position notice is sent for each item, the first one at position
+        and each other after the previous one.
+
+        The whole list is sent twice over the connection whatever the number
+        of moved items, so on long feeds prefer move for a few items.
+
+        Fails with ItemDoesNotExist if an id or the relative id are not on
+        feed, and with ValueError if the relative id is one of ids.
+
+        @param ids: An iterable of item IDs.
+        @param position: 'begin:', ':end', ':[id]' (before id) or '[id]:'
+                         (after id).
+
+        @return: A defer witch callback function will have the list of moved
+                 ids as the first argument.
+        '''
+        from txthoonk.client import ItemDoesNotExist
+        pub = self.pub
+        where, rel = parse_position(position)
+
+        # unique ids, keeping the order
+        seen = set()
+        unique_ids = []
+        for id_ in ids:
+            id_ = str(id_)
+            if id_ not in seen:
+                seen.add(id_)
+                unique_ids.append(id_)
+        ids = unique_ids
+        if not ids:
+            return defer.succeed([])
+        if rel in seen:
+            return defer.fail(ValueError("Items can not be moved relative "
+                                         "to themselves"))
+
+        def _check_exec(bulk_result):
+            """
+            Called when redis exec is completed
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            if check_exec(bulk_result[-1][1]):
+                # Transaction done :D
+                return ids
+
+            # Transaction fail :(
+            # repeat it
+            return defer.fail(TransactionAborted())
+
+        def _fail(redis, missing):
+            d = redis.unwatch()
+            return d.addCallback(
+                        lambda x: defer.fail(ItemDoesNotExist(missing)))
+
+        def _got_ids(bulk_result, redis):
+            """
+            Called when we have the current order
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            current = bulk_result[-1][1] or []
+            current_set = set(current)
+            for id_ in ids:
+                if id_ not in current_set:
+                    return _fail(redis, id_)
+
+            rest = [id_ for id_ in current if id_ not in seen]
+            if where == 'begin':
+                new_order = ids + rest
+            elif where == 'end':
+                new_order = rest + ids
+            else:
+                if rel not in current_set:
+                    return _fail(redis, rel)
+                pos = rest.index(rel)
+                if where == 'after':
+                    pos += 1
+                new_order = rest[:pos] + ids + rest[pos:]
+
+            defers = []
+            # begin transaction
+            defers.append(redis.multi())
+            defers.append(redis.delete(self.feed_ids))
+            for pos in range(0, len(new_order), 1000):
+                defers.append(redis.send('RPUSH', self.feed_ids,
+                                         *new_order[pos:pos + 1000]))
+            prev_position = position
+            for id_ in ids:
+                defers.append(pub.publish_channel(self.channel_position, id_,
+                                                  prev_position, redis=redis))
+                prev_position = '%s:' % id_
+            # end transaction
+            defers.append(redis.execute())
+
+            return defer.DeferredList(defers).addCallback(_check_exec)
+
+        def _attempt(redis):
+            defers = []
+            defers.append(redis.watch(self.feed_ids)) #0
+            defers.append(redis.lrange(self.feed_ids, 0, -1)) #1
+            return defer.DeferredList(defers).addCallback(_got_ids, redis)
+
+        return pub.transaction(self.name, _attempt)
+
+    @measured
+    def retract(self, id_):
+        '''
+        Remove an item from the feed.
+
+        @param id_: The ID value of the item to remove.
+        '''
+        pub = self.pub
+        id_ = str(id_)
+
+        def _check_exec(bulk_result):
+            """
+            Called when redis exec is completed
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            if check_exec(bulk_result[-1][1]):
+                # transaction done :D
+                return None
+
+            # Transaction fail :(
+            # repeat it
+            return defer.fail(TransactionAborted())
+
+        def _has_id(bulk_result, redis):
+            """
+            Called when we know if the item exists
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            if not bulk_result[-1][1]:
+                return redis.unwatch()
+
+            defers = []
+            # begin transaction
+            defers.append(redis.multi())
+            defers.append(redis.lrem(self.feed_ids, id_, 1))
+            defers.append(redis.hdel(self.feed_items, id_))
+            defers.append(pub.publish_channel(self.channel_retract, id_,
+                                              redis=redis))
+            # end transaction
+            defers.append(redis.execute())
+
+            return defer.DeferredList(defers).addCallback(_check_exec)
+
+        def _attempt(redis):
+            defers = []
+            defers.append(redis.watch(self.feed_items)) #0
+            defers.append(redis.hexists(self.feed_items, id_)) #1
+            return defer.DeferredList(defers).addCallback(_has_id, redis)
+
+        d = pub.transaction(self.name, _attempt)
+        return d.addCallback(self._invalidate_items, [id_])
+
+    @measured
+    def retract_many(self, ids):
+        '''
+        Remove many items from the feed.
+
+        Existing ids are checked by a single HMGET and all of them are
+        removed by a single transaction. Non existing ids are ignored.
+
+        Each id is removed from the list by a LREM, a scan of the list, so
+        the transaction is O(N) by id on a feed of N items; on long feeds
+        retract large sets of ids in chunks, so other clients run between
+        them.
+
+        @param ids: An iterable of item IDs.
+
+        @return: A defer witch callback function will have the list of
+                 removed ids as the first argument.
+        '''
+        pub = self.pub
+
+        # unique ids, keeping the order
+        seen = set()
+        unique_ids = []
+        for id_ in ids:
+            id_ = str(id_)
+            if id_ not in seen:
+                seen.add(id_)
+                unique_ids.append(id_)
+        ids = unique_ids
+        if not ids:
+            return defer.succeed([])
+
+        def _check_exec(bulk_result, existing):
+            """
+            Called when redis exec is completed
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            if check_exec(bulk_result[-1][1]):
+                # transaction done :D
+                return existing
+
+            # Transaction fail :(
+            # repeat it
+            return defer.fail(TransactionAborted())
+
+        def _got_items(bulk_result, redis):
+            """
+            Called when we have the items of ids
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            found = bulk_result[-1][1] or {}
+            existing = [id_ for id_ in ids if found.get(id_) is not None]
+            if not existing:
+                return redis.unwatch().addCallback(lambda x: [])
+
+            defers = []
+            # begin transaction
+            defers.append(redis.multi())
+            for id_ in existing:
+                defers.append(redis.lrem(self.feed_ids, id_, 1))
+            for pos in range(0, len(existing), 1000):
+                defers.append(redis.send('HDEL', self.feed_items,
+                                         *existing[pos:pos + 1000]))
+            for id_ in existing:
+                defers.append(pub.publish_channel(self.channel_retract, id_,
+                                                  redis=redis))
+            # end transaction
+            defers.append(redis.execute())
+
+            d = defer.DeferredList(defers)
+            return d.addCallback(_check_exec, existing)
+
+        def _attempt(redis):
+            defers = []
+            defers.append(redis.watch(self.feed_items)) #0
+            defers.append(redis.hmget(self.feed_items, ids)) #1
+            return defer.DeferredList(defers).addCallback(_got_items, redis)
+
+        d = pub.transaction(self.name, _attempt)
+        return d.addCallback(self._invalidate_items, ids)
+
+    def trim(self, max_length=None, chunk=None):
+        '''
+        Sorted feeds are unbounded, nothing is removed.
+        '''
+        return defer.succeed(None)
+
+    @measured
+    def get_ids(self):
+        '''
+        Return the IDs of all items, in feed order.
+        '''
+        return self.pub.redis.lrange(self.feed_ids, 0, -1)
+
+    @measured
+    def get_ids_page(self, cursor=None, count=None):
+        '''
+        Return a page of the IDs of items, in feed order.
+
+        Pages are windowed by index, items inserted or moved while paging
+        may shift the next pages.
+
+        @param cursor: the cursor returned by the previous page, None for
+                       the first page.
+        @param count: the max number of IDs of page, defaults to page_size.
+
+        @return: A defer witch callback function will have a tuple of
+                 (list of ids, next cursor) as the first argument, next
+                 cursor is None on the last page.
+        '''
+        if count is None:
+            count = self.page_size
+        start = cursor or 0
+
+        def _got_page(ids):
+            ids = ids or []
+            if len(ids) < count:
+                return ids, None
+            return ids, start + len(ids)
+
+        d = self.pub.redis.lrange(self.feed_ids, start, start + count - 1)
+        return d.addCallback(_got_page)
+
+
+class Queue(Feed):
+    """
+    A Thoonk queue is a FIFO of items, each item is delivered to a single
+    getter and removed from the queue.
+
+    Items put with priority are delivered before all others (the last one
+    first). Blocking gets (BRPOP) run on connections of pub.blocking_pool,
+    so they never block the connections used by feeds.
+
+    Redis Keys Used:
+        feed.ids:[feed]       -- A list of item IDs, the next item at tail.
+        feed.items:[feed]     -- A hash table of items keyed by ID.
+        feed.config:[feed]    -- Feed configuration data of this feed.
+        feed.publishes:[feed] -- A counter for number of published items.
+
+    Thoonk Standard API:
+        put     -- Add an item to the queue.
+        get     -- Remove and return the next item, waiting for one.
+        retract -- Remove an item.
+        get_ids -- Return the IDs of all items, the next item last.
+
+    Bulk API:
+        put_many     -- Add many items to the queue.
+        get_batch    -- Remove and return up to count items, waiting for one.
+        retract_many -- Remove many items.
+    """
+    def publish(self, item, id_=None, priority=False):
+        '''
+        Add an item to the queue, an alias to put.
+
+        Ids of queue items are generated, so it fails with ValueError if id_
+        is given; the signature is kept as in Feed.publish.
+
+        @param item: The item, a string if the feed has no codec.
+        @param id_: must be None.
+        @param priority: if True, the item is delivered before all others.
+        '''
+        if id_ is not None:
+            return defer.fail(ValueError("Ids of queue items are generated"))
+        return self.put(item, priority)
+
+    @measured
+    def put(self, item, priority=False):
+        '''
+        Add an item to the queue.
+
+        @param item: The item, a string if the feed has no codec.
+        @param priority: if True, the item is delivered before all others.
+
+        @return: A defer witch callback function will have the item id as
+                 the first argument.
+        '''
+        d = self._put_many([item], priority)
+        return d.addCallback(lambda ids: ids[0])
+
+    @measured
+    def put_many(self, items, priority=False):
+        '''
+        Add many items to the queue, delivered in order (or in reverse order
+        if priority is True, as many put calls would do).
+
+        All items are written by a single transaction.
+
+        @param items: An iterable of items, strings if the feed has no codec.
+        @param priority: if True, the items are delivered before all others.
+
+        @return: A defer witch callback function will have the list of ids
+                 as the first argument.
+        '''
+        return self._put_many(items, priority)
+
+    def _put_many(self, items, priority):
+        '''
+        Add many items to the queue, see put_many.
+        '''
+        pub = self.pub
+        items = list(items)
+        if not items:
+            return defer.succeed([])
+        ids = [uuid.uuid4().hex for _ in items]
+        push = 'RPUSH' if priority else 'LPUSH'
+
+        def _check_exec(bulk_result):
+            """
+            Called when redis exec is completed
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            if check_exec(bulk_result[-1][1]):
+                # transaction done :D
+                return ids
+
+            # Transaction fail :(
+            # repeat it
+            return defer.fail(TransactionAborted())
+
+        def _put(redis, data):
+            defers = []
+            # begin transaction
+            defers.append(redis.multi())
+            for pos in range(0, len(ids), 1000):
+                chunk = ids[pos:pos + 1000]
+                fields = []
+                for id_, item in zip(chunk, data[pos:pos + 1000]):
+                    fields += [id_, item]
+                defers.append(redis.send('HMSET', self.feed_items, *fields))
+                defers.append(redis.send(push, self.feed_ids, *chunk))
+            defers.append(redis.incr(self.feed_publishes, len(ids)))
+            defers.extend(self._put_commands(redis, ids))
+            # end transaction
+            defers.append(redis.execute())
+
+            return defer.DeferredList(defers).addCallback(_check_exec)
+
+        def _encode(codec):
+            data = [codec.encode(item) for item in items]
+            return pub.transaction(self.name, lambda redis: _put(redis, data))
+
+        return self.get_codec().addCallback(_encode)
+
+    def _put_commands(self, redis, ids):
+        '''
+        Send the additional commands of the put transaction of ids.
+
+        @return: the list of defers of commands.
+        '''
+        return []
+
+    @measured
+    def get(self, timeout=0):
+        '''
+        Remove and return the next item, waiting for one up to timeout
+        seconds. Fails with QueueEmpty on timeout.
+
+        @param timeout: max seconds to wait, 0 to wait forever.
+        '''
+        def _got_items(items):
+            # ids without item are skipped
+            return items[0] if items else None
+
+        return self._pop(1, timeout).addCallback(_got_items)
+
+    @measured
+    def get_batch(self, count, timeout=0):
+        '''
+        Remove and return up to count items, waiting for one up to timeout
+        seconds. Fails with QueueEmpty on timeout.
+
+        Available items are removed by a single optimistic transaction, or
+        by a single Lua script call if pub has scripting enabled, instead of
+        a BRPOP by item. A connection of pub.blocking_pool is leased only to
+        wait by BRPOP when no item is available.
+
+        @param count: max number of items.
+        @param timeout: max seconds to wait, 0 to wait forever.
+
+        @return: A defer witch callback function will have the list of
+                 items, in queue order, as the first argument.
+        '''
+        if count < 1:
+            return defer.fail(ValueError("count must be positive"))
+        return self._pop(count, timeout)
+
+    def _block(self, redis, timeout):
+        '''
+        Wait by BRPOP for the next item id, up to timeout seconds.
+
+        @return: A defer witch callback function will have the id, or None
+                 on timeout, as the first argument.
+        '''
+        d = redis.send('BRPOP', self.feed_ids, timeout)
+        return d.addCallback(lambda reply: reply[1] if reply else None)
+
+    def _take(self, redis, ids, codec):
+        '''
+        Read and delete the items of ids removed from the list by _block, by
+        a single transaction.
+
+        @param redis: the connection used.
+        @param ids: the list of ids, in get order.
+        @param codec: the codec of this feed.
+
+        @return: A defer witch callback function will have the list of
+                 (id, item) of existing items as the first argument.
+        '''
+        def _check_exec(bulk_result):
+            """
+            Called when redis exec is completed
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+            return self._taken(redis, check_exec(bulk_result[-1][1]), ids,
+                               codec)
+
+        defers = []
+        # begin transaction
+        defers.append(redis.multi())
+        defers.extend(self._take_commands(redis, ids))
+        defers.extend(self._blocked_commands(redis, ids))
+        # end transaction
+        defers.append(redis.execute())
+        return defer.DeferredList(defers).addCallback(_check_exec)
+
+    def _take_commands(self, redis, ids):
+        '''
+        Send the commands of the get transaction of ids, the first one must
+        be the HMGET of their items.
+
+        @return: the list of defers of commands.
+        '''
+        defers = []
+        defers.append(redis.hmget(self.feed_items, ids))
+        defers.append(redis.send('HDEL', self.feed_items, *ids))
+        return defers
+
+    def _blocked_commands(self, redis, ids):
+        '''
+        Send the commands added to the get transaction of ids removed from
+        the list by _block, after the ones of _take_commands.
+
+        @return: the list of defers of commands.
+        '''
+        return []
+
+    def _taken(self, redis, replies, ids, codec):
+        '''
+        Return the list of (id, item) of existing items of ids.
+
+        @param redis: the connection used.
+        @param replies: the replies of the commands of _take_commands.
+        @param ids: the list of ids, in get order.
+        @param codec: the codec of this feed.
+        '''
+        found = dict(zip(ids, replies[0]))
+        return [(id_, codec.decode(data)) for id_, data in _found(found, ids)]
+
+    def _take_script(self, count):
+        '''
+        Run the script removing up to count available items.
+
+        @return: A defer witch callback function will have the list of
+                 id1, item1, id2, item2... as the first argument.
+        '''
+        return self.pub.run_script(scripts.QUEUE_POP,
+                                   [self.feed_ids, self.feed_items], [count])
+
+    def _result(self, entries):
+        '''
+        Return the result of get_batch from a list of (id, item).
+        '''
+        return [item for id_, item in entries]
+
+    def _drain(self, count, codec):
+        '''
+        Remove up to count available items, without blocking.
+
+        @return: A defer witch callback function will have the list of
+                 (id, item) of removed items as the first argument.
+        '''
+        pub = self.pub
+
+        def _decode(data):
+            """
+            Called when the script returns
+            """
+            return [(id_, codec.decode(item))
+                    for id_, item in zip(data[::2], data[1::2])]
+
+        if pub.scripting:
+            return self._take_script(count).addCallback(_decode)
+
+        def _check_exec(bulk_result, redis, ids):
+            """
+            Called when redis exec is completed
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            replies = check_exec(bulk_result[-1][1])
+            if replies:
+                # transaction done :D
+                return self._taken(redis, replies[1:], ids, codec)
+
+            # Transaction fail :(
+            # repeat it
+            return defer.fail(TransactionAborted())
+
+        def _got_ids(bulk_result, redis):
+            """
+            Called when we have the available ids
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            ids = bulk_result[-1][1]
+            if not ids:
+                return redis.unwatch().addCallback(lambda x: [])
+            # the next item is at tail
+            ids.reverse()
+
+            defers = []
+            # begin transaction
+            defers.append(redis.multi())
+            defers.append(redis.send('LTRIM', self.feed_ids, 0,
+                                     -len(ids) - 1))
+            defers.extend(self._take_commands(redis, ids))
+            # end transaction
+            defers.append(redis.execute())
+
+            d = defer.DeferredList(defers)
+            return d.addCallback(_check_exec, redis, ids)
+
+        def _attempt(redis):
+            defers = []
+            defers.append(redis.watch(self.feed_ids)) #0
+            defers.append(redis.lrange(self.feed_ids, -count, -1)) #1
+            return defer.DeferredList(defers).addCallback(_got_ids, redis)
+
+        return pub.transaction(self.name, _attempt)
+
+    def _pop(self, count, timeout):
+        '''
+        Remove up to count available items, or wait for one by BRPOP on a
+        connection leased from pub.blocking_pool.
+
+        @param count: max number of items.
+        @param timeout: max seconds to wait, 0 to wait forever.
+        '''
+        from txthoonk.client import QueueEmpty
+        pub = self.pub
+
+        def _popped(id_, redis, codec):
+            """
+            Called when _block returns
+            """
+            if id_ is None:
+                return defer.fail(QueueEmpty())
+            return self._take(redis, [id_], codec)
+
+        def _block(redis, codec):
+            d = self._block(redis, timeout)
+            return d.addCallback(_popped, redis, codec)
+
+        def _drained(entries, codec):
+            """
+            Called when the available items were removed
+            """
+            if entries:
+                return entries
+            return pub.with_blocking_connection(
+                                        lambda redis: _block(redis, codec))
+
+        def _pop(codec):
+            return self._drain(count, codec).addCallback(_drained, codec)
+
+        d = self.get_codec().addCallback(_pop)
+        return d.addCallback(self._result)
+
+    def publish_many(self, items):
+        '''
+        Add many items to the queue, an alias to put_many.
+
+        Ids of queue items are generated, so all ids must be None, otherwise
+        it fails with ValueError.
+
+        @param items: An iterable of (item, id_) tuples, as in
+                      Feed.publish_many.
+        '''
+        items = list(items)
+        if [id_ for item, id_ in items if id_ is not None]:
+            return defer.fail(ValueError("Ids of queue items are generated"))
+        return self.put_many([item for item, id_ in items])
+
+    @measured
+    def retract(self, id_):
+        '''
+        Remove an item from the queue, nothing is done if id_ is not on it.
+
+        @param id_: The ID value of the item to remove.
+        '''
+        return self._retract([id_]).addCallback(lambda x: None)
+
+    @measured
+    def retract_many(self, ids):
+        '''
+        Remove many items from the queue.
+
+        Existing ids are checked by a single HMGET and all of them are
+        removed by a single transaction. Non existing ids are ignored.
+
+        @param ids: An iterable of item IDs.
+
+        @return: A defer witch callback function will have the list of
+                 removed ids as the first argument.
+        '''
+        return self._retract(ids)
+
+    def _retract(self, ids):
+        '''
+        Remove the existing items of ids, see retract_many.
+        '''
+        pub = self.pub
+
+        # unique ids, keeping the order
+        seen = set()
+        unique_ids = []
+        for id_ in ids:
+            id_ = str(id_)
+            if id_ not in seen:
+                seen.add(id_)
+                unique_ids.append(id_)
+        ids = unique_ids
+        if not ids:
+            return defer.succeed([])
+
+        def _check_exec(bulk_result, existing):
+            """
+            Called when redis exec is completed
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            if check_exec(bulk_result[-1][1]):
+                # transaction done :D
+                return existing
+
+            # Transaction fail :(
+            # repeat it
+            return defer.fail(TransactionAborted())
+
+        def _got_items(bulk_result, redis):
+            """
+            Called when we have the items of ids
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            found = bulk_result[-1][1] or {}
+            existing = [id_ for id_ in ids if found.get(id_) is not None]
+            if not existing:
+                return redis.unwatch().addCallback(lambda x: [])
+
+            defers = []
+            # begin transaction
+            defers.append(redis.multi())
+            defers.extend(self._retract_commands(redis, existing))
+            # end transaction
+            defers.append(redis.execute())
+
+            d = defer.DeferredList(defers)
+            return d.addCallback(_check_exec, existing)
+
+        def _attempt(redis):
+            defers = []
+            defers.append(redis.watch(self.feed_items)) #0
+            defers.append(redis.hmget(self.feed_items, ids)) #1
+            return defer.DeferredList(defers).addCallback(_got_items, redis)
+
+        d = pub.transaction(self.name, _attempt)
+        return d.addCallback(self._invalidate_items, ids)
+
+    def _retract_commands(self, redis, ids):
+        '''
+        Send the commands of the retract transaction of existing ids.
+
+        @return: the list of defers of commands.
+        '''
+        defers = []
+        for id_ in ids:
+            defers.append(redis.lrem(self.feed_ids, id_, 1))
+        for pos in range(0, len(ids), 1000):
+            defers.append(redis.send('HDEL', self.feed_items,
+                                     *ids[pos:pos + 1000]))
+        return defers
+
+    def trim(self, max_length=None, chunk=None):
+        '''
+        Queues are unbounded, nothing is removed.
+        '''
+        return defer.succeed(None)
+
+    @measured
+    def get_ids_page(self, cursor=None, count=None):
+        '''
+        Return a page of the IDs of items, the next item last.
+
+        Pages are windowed by index from the first (the last put) item,
+        items put while paging shift the next pages.
+
+        @param cursor: the cursor returned by the previous page, None for
+                       the first page.
+        @param count: the max number of IDs of page, defaults to page_size.
+
+        @return: A defer witch callback function will have a tuple of
+                 (list of ids, next cursor) as the first argument, next
+                 cursor is None on the last page.
+        '''
+        if count is None:
+            count = self.page_size
+        start = cursor or 0
+
+        def _got_page(ids):
+            ids = ids or []
+            if len(ids) < count:
+                return ids, None
+            return ids, start + len(ids)
+
+        d = self.pub.redis.lrange(self.feed_ids, start, start + count - 1)
+        return d.addCallback(_got_page)
+
+    @measured
+    def get_ids(self):
+        '''
+        Return the IDs of all items, the next item last.
+        '''
+        return self.pub.redis.lrange(self.feed_ids, 0, -1)
+
+
+class Job(Queue):
+    """
+    A Thoonk job queue: each job is claimed by a single worker, which must
+    finish, cancel (the job is retried) or stall it.
+
+    Jobs claimed for too long (a lost worker) are cancelled by the
+    maintenance of the job feed, see txthoonk.maintenance.JobMaintenance.
+
+    Redis Keys Used:
+        feed.ids:[feed]       -- A list of available job IDs, the next job at
+                                 tail.
+        feed.items:[feed]     -- A hash table of jobs keyed by ID.
+        feed.config:[feed]    -- Feed configuration data of this feed.
+        feed.publishes:[feed] -- A counter for number of published jobs.
+        feed.published:[feed] -- A sorted set of job IDs by publication time.
+        feed.claimed:[feed]   -- A sorted set of claimed job IDs by claim
+                                 time.
+        feed.cancelled:[feed] -- A hash table of cancel counts keyed by ID.
+        feed.stalled:[feed]   -- A set of stalled job IDs.
+        feed.finishes:[feed]  -- A counter for number of finished jobs.
+        feed.claiming:[feed]  -- A list of job IDs taken by blocking gets
+                                 whose claim is in flight.
+        job.finish:[feed]     -- A pubsub channel for finish notices.
+
+    Thoonk Standard API:
+        put               -- Add a job.
+        get               -- Claim the next job, waiting for one.
+        finish            -- Finish a claimed job.
+        cancel            -- Cancel a claimed job, it is retried.
+        stall             -- Take a claimed job out of the running.
+        retry             -- Retry a stalled job.
+        retract           -- Remove a job.
+        get_ids           -- Return the IDs of all jobs.
+        get_failure_count -- Return the number of cancels of a job.
+
+    Bulk API:
+        put_many     -- Add many jobs.
+        get_batch    -- Claim up to count jobs, waiting for one.
+        retract_many -- Remove many jobs.
+
+    Maintenance API:
+        cancel_claims -- Cancel jobs claimed before a time.
+        requeue_lost  -- Requeue jobs lost between their get and claim.
+    """
+    def __init__(self, pub, name, item_cache=None):
+        '''
+        Create a new Job object for a given Thoonk feed name.
+
+        @param pub: the ThoonkPub object
+        @param name: the name of this feed
+        @param item_cache: an optional txthoonk.cache.ItemCache of items read
+                           by get_item.
+        '''
+        Queue.__init__(self, pub, name, item_cache)
+        self.feed_published = 'feed.published:%s' % name
+        self.feed_claimed = 'feed.claimed:%s' % name
+        self.feed_cancelled = 'feed.cancelled:%s' % name
+        self.feed_stalled = 'feed.stalled:%s' % name
+        self.feed_finishes = 'feed.finishes:%s' % name
+        self.feed_claiming = 'feed.claiming:%s' % name
+        self.channel_finish = 'job.finish:%s' % name
+
+    def _put_commands(self, redis, ids):
+        score = repr(time.time())
+        args = []
+        for id_ in ids:
+            args += [score, id_]
+        return [redis.send('ZADD', self.feed_published, *args)]
+
+    def get(self, timeout=0):
+        '''
+        Claim the next job, waiting for one up to timeout seconds. Fails with
+        QueueEmpty on timeout.
+
+        @param timeout: max seconds to wait, 0 to wait forever.
+
+        @return: A defer witch callback function will have a tuple of
+                 (id, item) as the first argument.
+        '''
+        return Queue.get(self, timeout)
+
+    def get_batch(self, count, timeout=0):
+        '''
+        Claim up to count jobs, waiting for one up to timeout seconds. Fails
+        with QueueEmpty on timeout.
+
+        @param count: max number of jobs.
+        @param timeout: max seconds to wait, 0 to wait forever.
+
+        @return: A defer witch callback function will have the list of
+                 (id, item), in queue order, as the first argument.
+        '''
+        return Queue.get_batch(self, count, timeout)
+
+    def _take_commands(self, redis, ids):
+        '''
+        Claim the jobs of ids and read their items.
+        '''
+        score = repr(time.time())
+        args = []
+        for id_ in ids:
+            args += [score, id_]
+
+        defers = []
+        defers.append(redis.hmget(self.feed_items, ids))
+        defers.append(redis.send('ZADD', self.feed_claimed, *args))
+        return defers
+
+    def _block(self, redis, timeout):
+        '''
+        Wait by BRPOPLPUSH for the next job id, up to timeout seconds. The id
+        is kept on feed.claiming until the claim transaction, so a job of a
+        worker lost meanwhile is found by requeue_lost.
+        '''
+        return redis.send('BRPOPLPUSH', self.feed_ids, self.feed_claiming,
+                          timeout)
+
+    def _blocked_commands(self, redis, ids):
+        defers = []
+        for id_ in ids:
+            defers.append(redis.lrem(self.feed_claiming, id_, 1))
+        return defers
+
+    def _taken(self, redis, replies, ids, codec):
+        entries = Queue._taken(self, redis, replies, ids, codec)
+        if len(entries) == len(ids):
+            return entries
+
+        # retracted meanwhile
+        missing = set(ids) - set(id_ for id_, item in entries)
+        d = redis.send('ZREM', self.feed_claimed, *missing)
+        return d.addCallback(lambda x: entries)
+
+    def _take_script(self, count):
+        keys = [self.feed_ids, self.feed_items, self.feed_claimed]
+        return self.pub.run_script(scripts.JOB_CLAIM, keys,
+                                   [count, repr(time.time())])
+
+    def _result(self, entries):
+        return entries
+
+    def _change(self, id_, watch, check, commands, error):
+        '''
+        Change a job by an optimistic transaction.
+
+        @param id_: The id of the job.
+        @param watch: the key watched by transaction.
+        @param check: a function receiving the connection and returning a
+                      defer, the job is changed if its result is true.
+        @param commands: a function receiving the connection and returning
+                         the list of defers of the commands of transaction.
+        @param error: the exception raised if check fails.
+        '''
+        def _check_exec(bulk_result):
+            """
+            Called when redis exec is completed
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            if check_exec(bulk_result[-1][1]):
+                # Transaction done :D
+                return id_
+
+            # Transaction fail :(
+            # repeat it
+            return defer.fail(TransactionAborted())
+
+        def _checked(bulk_result, redis):
+            """
+            Called when we know if the job may be changed
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            if not bulk_result[-1][1]:
+                d = redis.unwatch()
+                return d.addCallback(lambda x: defer.fail(error))
+
+            defers = []
+            # begin transaction
+            defers.append(redis.multi())
+            defers.extend(commands(redis))
+            # end transaction
+            defers.append(redis.execute())
+
+            return defer.DeferredList(defers).addCallback(_check_exec)
+
+        def _attempt(redis):
+            defers = []
+            defers.append(redis.watch(watch)) #0
+            defers.append(check(redis)) #1
+            return defer.DeferredList(defers).addCallback(_checked, redis)
+
+        return self.pub.transaction(self.name, _attempt)
+
+    def _is_claimed(self, id_):
+        return lambda redis: redis.send('ZSCORE', self.feed_claimed, id_)
+
+    @measured
+    def finish(self, id_, result=None):
+        '''
+        Finish a claimed job, fails with JobNotClaimed if id_ is not claimed.
+
+        @param id_: The id of the job.
+        @param result: an optional result (a string), sent by a finish
+                       notice.
+        '''
+        from txthoonk.client import JobNotClaimed
+        pub = self.pub
+        id_ = str(id_)
+
+        def _commands(redis):
+            defers = []
+            defers.append(redis.send('ZREM', self.feed_claimed, id_))
+            defers.append(redis.hdel(self.feed_cancelled, id_))
+            defers.append(redis.send('ZREM', self.feed_published, id_))
+            defers.append(redis.incr(self.feed_finishes))
+            if result is not None:
+                defers.append(pub.publish_channel(self.channel_finish, id_,
+                                                  result, redis=redis))
+            defers.append(redis.hdel(self.feed_items, id_))
+            return defers
+
+        d = self._change(id_, self.feed_claimed, self._is_claimed(id_),
+                         _commands, JobNotClaimed(id_))
+        return d.addCallback(self._invalidate_items, [id_])
+
+    @measured
+    def cancel(self, id_):
+        '''
+        Cancel a claimed job, it is put back to be retried. Fails with
+        JobNotClaimed if id_ is not claimed.
+
+        @param id_: The id of the job.
+        '''
+        from txthoonk.client import JobNotClaimed
+        id_ = str(id_)
+
+        def _commands(redis):
+            defers = []
+            defers.append(redis.send('HINCRBY', self.feed_cancelled, id_, 1))
+            defers.append(redis.lpush(self.feed_ids, id_))
+            defers.append(redis.send('ZREM', self.feed_claimed, id_))
+            return defers
+
+        return self._change(id_, self.feed_claimed, self._is_claimed(id_),
+                            _commands, JobNotClaimed(id_))
+
+    @measured
+    def stall(self, id_):
+        '''
+        Take a claimed job out of the running, without deleting it. Fails
+        with JobNotClaimed if id_ is not claimed.
+
+        @param id_: The id of the job.
+        '''
+        from txthoonk.client import JobNotClaimed
+        id_ = str(id_)
+
+        def _commands(redis):
+            defers = []
+            defers.append(redis.send('ZREM', self.feed_claimed, id_))
+            defers.append(redis.hdel(self.feed_cancelled, id_))
+            defers.append(redis.sadd(self.feed_stalled, id_))
+            defers.append(redis.send('ZREM', self.feed_published, id_))
+            return defers
+
+        return self._change(id_, self.feed_claimed, self._is_claimed(id_),
+                            _commands, JobNotClaimed(id_))
+
+    @measured
+    def retry(self, id_):
+        '''
+        Put a stalled job back to be retried. Fails with JobNotStalled if
+        id_ is not stalled.
+
+        @param id_: The id of the job.
+        '''
+        from txthoonk.client import JobNotStalled
+        id_ = str(id_)
+
+        def _check(redis):
+            return redis.sismember(self.feed_stalled, id_)
+
+        def _commands(redis):
+            defers = []
+            defers.append(redis.srem(self.feed_stalled, id_))
+            defers.append(redis.lpush(self.feed_ids, id_))
+            defers.append(redis.zadd(self.feed_published, id_,
+                                     repr(time.time())))
+            return defers
+
+        return self._change(id_, self.feed_stalled, _check, _commands,
+                            JobNotStalled(id_))
+
+    @measured
+    def retract(self, id_):
+        '''
+        Remove a job, fails with ItemDoesNotExist if id_ is not on feed.
+
+        @param id_: The id of the job.
+        '''
+        from txthoonk.client import ItemDoesNotExist
+        id_ = str(id_)
+
+        def _check(redis):
+            return redis.hexists(self.feed_items, id_)
+
+        def _commands(redis):
+            defers = []
+            defers.append(redis.hdel(self.feed_items, id_))
+            defers.append(redis.hdel(self.feed_cancelled, id_))
+            defers.append(redis.send('ZREM', self.feed_published, id_))
+            defers.append(redis.srem(self.feed_stalled, id_))
+            defers.append(redis.send('ZREM', self.feed_claimed, id_))
+            defers.append(redis.lrem(self.feed_ids, id_, 1))
+            defers.append(redis.lrem(self.feed_claiming, id_, 1))
+            return defers
+
+        d = self._change(id_, self.feed_items, _check, _commands,
+                         ItemDoesNotExist(id_))
+        return d.addCallback(self._invalidate_items, [id_])
+
+    @measured
+    def get_ids(self):
+        '''
+        Return the IDs of all jobs.
+        '''
+        return self.pub.redis.hkeys(self.feed_items)
+
+    def _retract_commands(self, redis, ids):
+        defers = Queue._retract_commands(self, redis, ids)
+        defers.append(redis.send('HDEL', self.feed_cancelled, *ids))
+        defers.append(redis.send('ZREM', self.feed_published, *ids))
+        defers.append(redis.send('SREM', self.feed_stalled, *ids))
+        defers.append(redis.send('ZREM', self.feed_claimed, *ids))
+        for id_ in ids:
+            defers.append(redis.lrem(self.feed_claiming, id_, 1))
+        return defers
+
+    @measured
+    def get_ids_page(self, cursor=None, count=None):
+        '''
+        Return a page of the IDs of all jobs.
+
+        IDs are iterated by HSCAN (redis >= 2.8), they are not ordered and
+        an ID may be returned more than once.
+
+        @param cursor: the cursor returned by the previous page, None for
+                       the first page.
+        @param count: the hint of the number of IDs of page, defaults to
+                      page_size.
+
+        @return: A defer witch callback function will have a tuple of
+                 (list of ids, next cursor) as the first argument, next
+                 cursor is None on the last page.
+        '''
+        if count is None:
+            count = self.page_size
+
+        def _got_page(reply):
+            cursor, items = reply
+            return list(items), cursor or None
+
+        d = self.pub.redis.hscan(self.feed_items, cursor or 0, count=count)
+        return d.addCallback(_got_page)
+
+    @measured
+    def get_failure_count(self, id_):
+        '''
+        Return the number of times a job was cancelled.
+
+        @param id_: The id of the job.
+        '''
+        d = self.pub.redis.hget(self.feed_cancelled, str(id_))
+        return d.addCallback(lambda ret: int((ret or {}).get(str(id_)) or 0))
+
+    @measured
+    def cancel_claims(self, claimed_before, count=1000, max_failures=None):
+        '''
+        Cancel jobs claimed before a time, eg. by a lost worker.
+
+        Jobs are found by a score range query on feed.claimed, at most count
+        jobs are cancelled by a single transaction.
+
+        @param claimed_before: the claim time (seconds since epoch).
+        @param count: max number of jobs.
+        @param max_failures: if given, jobs already cancelled max_failures
+                             times are stalled instead.
+
+        @return: A defer witch callback function will have a tuple of
+                 (cancelled ids, stalled ids) as the first argument.
+        '''
+        def _check_exec(bulk_result, cancelled, stalled):
+            """
+            Called when redis exec is completed
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            if check_exec(bulk_result[-1][1]):
+                # Transaction done :D
+                return cancelled, stalled
+
+            # Transaction fail :(
+            # repeat it
+            return defer.fail(TransactionAborted())
+
+        def _do_cancel(failures, ids, redis):
+            """
+            Called when we have the cancel counts of ids
+            """
+            stalled = []
+            if max_failures is not None:
+                stalled = [id_ for id_ in ids
+                           if int(failures.get(id_) or 0) >= max_failures]
+            stalled_set = set(stalled)
+            cancelled = [id_ for id_ in ids if id_ not in stalled_set]
+
+            defers = []
+            # begin transaction
+            defers.append(redis.multi())
+            for id_ in cancelled:
+                defers.append(redis.send('HINCRBY', self.feed_cancelled, id_,
+                                         1))
+            if cancelled:
+                defers.append(redis.send('LPUSH', self.feed_ids, *cancelled))
+            if stalled:
+                defers.append(redis.send('HDEL', self.feed_cancelled,
+                                         *stalled))
+                defers.append(redis.send('SADD', self.feed_stalled, *stalled))
+                defers.append(redis.send('ZREM', self.feed_published,
+                                         *stalled))
+            defers.append(redis.send('ZREM', self.feed_claimed, *ids))
+            # end transaction
+            defers.append(redis.execute())
+
+            d = defer.DeferredList(defers)
+            return d.addCallback(_check_exec, cancelled, stalled)
+
+        def _got_ids(bulk_result, redis):
+            """
+            Called when we have the ids claimed before claimed_before
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            ids = bulk_result[-1][1]
+            if not ids:
+                return redis.unwatch().addCallback(lambda x: ([], []))
+            if max_failures is None:
+                return _do_cancel({}, ids, redis)
+
+            d = redis.hmget(self.feed_cancelled, ids)
+            return d.addCallback(lambda found: _do_cancel(found or {}, ids,
+                                                          redis))
+
+        def _attempt(redis):
+            defers = []
+            defers.append(redis.watch(self.feed_claimed)) #0
+            defers.append(redis.send('ZRANGEBYSCORE', self.feed_claimed,
+                                     '-inf', repr(claimed_before), 'LIMIT',
+                                     0, count)) #1
+            return defer.DeferredList(defers).addCallback(_got_ids, redis)
+
+        return self.pub.transaction(self.name, _attempt)
+
+    @measured
+    def requeue_lost(self, previous=()):
+        '''
+        Put back jobs taken by a blocking get of a worker lost before
+        claiming them.
+
+        A blocking get moves the job id from feed.ids to feed.claiming by
+        BRPOPLPUSH, and the claim transaction removes it, so only feed.claiming
+        is read, it holds the claims in flight only. A job is requeued only if
+        it was already on feed.claiming on the previous call, so a claim in
+        flight is not requeued.
+
+        @param previous: the unaccounted ids returned by the previous call.
+
+        @return: A defer witch callback function will have a tuple of
+                 (requeued ids, unaccounted ids) as the first argument.
+        '''
+        previous = set(previous)
+
+        def _check_exec(bulk_result, requeued, unaccounted):
+            """
+            Called when redis exec is completed
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            if check_exec(bulk_result[-1][1]):
+                # Transaction done :D
+                return requeued, unaccounted
+
+            # Transaction fail :(
+            # repeat it
+            return defer.fail(TransactionAborted())
+
+        def _got_ids(bulk_result, redis):
+            """
+            Called when we have the ids of claims in flight
+            """
+            # All defers must be succeed
+            assert all([a[0] for a in bulk_result])
+
+            unaccounted = set(bulk_result[1][1] or [])
+            requeued = sorted(unaccounted & previous)
+            if not requeued:
+                d = redis.unwatch()
+                return d.addCallback(lambda x: ([], unaccounted))
+
+            defers = []
+            # begin transaction
+            defers.append(redis.multi())
+            for id_ in requeued:
+                defers.append(redis.lrem(self.feed_claiming, id_, 1))
+            # back at tail, as they were taken
+            defers.append(redis.send('RPUSH', self.feed_ids, *requeued))
+            # end transaction
+            defers.append(redis.execute())
+
+            d = defer.DeferredList(defers)
+            return d.addCallback(_check_exec, requeued,
+                                 unaccounted - set(requeued))
+
+        def _attempt(redis):
+            defers = []
+            defers.append(redis.watch(self.feed_claiming)) #0
+            defers.append(redis.lrange(self.feed_claiming, 0, -1)) #1
+            return defer.DeferredList(defers).addCallback(_got_ids, redis)
+
+        return self.pub.transaction(self.name, _attempt)